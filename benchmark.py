@@ -0,0 +1,272 @@
+# Benchmark of the telemetry -> scene path in viser_keyboard.py, no drone needed.
+# Drives DroneVisualizer's telemetry callback (scan matching, pose graph,
+# mapping and the pose feeds) with synthetic flight data from the sim://
+# kinematic model and writes the results as JSON so runs can be compared
+# across versions. Map tiles go to a temporary directory:
+#   python benchmark.py                          full run, results in ./bench_results
+#   python benchmark.py --rates 100 --duration 5 --flight-minutes 5
+#   python benchmark.py --compare bench_results/old.json
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+import viser_keyboard
+from perf_stats import RollingStats
+from replay_link import KinematicModel, ModelSource
+
+RESULTS_DIR = "./bench_results"
+DEFAULT_RATES = (100, 500, 1000)
+ROOM = (6.0, 4.0, 3.0)
+
+
+class SyntheticFlight:
+    """Circle inside a box room, producing pose and range log packets"""
+
+    def __init__(self, radius=1.2, speed=0.5, height=1.0):
+        self.model = KinematicModel()
+        self.source = ModelSource(self.model, ROOM)
+        self.radius = radius
+        self.omega = speed / radius
+        self.height = height
+
+    def packets(self, t):
+        angle = self.omega * t
+        self.model.position[:] = (
+            self.radius * math.cos(angle),
+            self.radius * math.sin(angle),
+            self.height,
+        )
+        self.model.yaw = math.degrees(angle) + 90.0
+        values = self.source.sample()
+        timestamp = int(t * 1000) & 0xFFFFFFFF
+        return timestamp, values
+
+
+def _rss_mb():
+    """Current resident set size, falling back to the peak where unavailable"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _visualizer(map_dir):
+    """DroneVisualizer with its workers running and map tiles in map_dir"""
+    viser_keyboard.MAP_PATH = map_dir
+    visualizer = viser_keyboard.DroneVisualizer("sim://")
+    if visualizer.scan_matcher:
+        visualizer.scan_matcher.start()
+    if visualizer.pose_graph is not None:
+        visualizer.pose_graph.start()
+    return visualizer
+
+
+def _close(visualizer):
+    if visualizer.scan_matcher:
+        visualizer.scan_matcher.stop()
+    if visualizer.pose_graph is not None:
+        visualizer.pose_graph.stop()
+    visualizer.server.stop()
+
+
+def _timed_flush(visualizer, stats):
+    """Wrap the mapping flush so its time and CPU are reported separately"""
+    flush = visualizer.mapping.flush
+
+    def timed():
+        cpu = time.thread_time()
+        start = time.perf_counter()
+        result = flush()
+        stats["time"].add(time.perf_counter() - start)
+        stats["cpu"] += time.thread_time() - cpu
+        return result
+
+    visualizer.mapping.flush = timed
+
+
+def run_rate(visualizer, rate, duration):
+    """Feed pose + range packets at `rate` Hz in real time for `duration` s"""
+    flight = SyntheticFlight()
+    callback_time = RollingStats(capacity=1 << 16)
+    mapping = {"time": RollingStats(), "cpu": 0.0}
+    _timed_flush(visualizer, mapping)
+
+    scheduler = visualizer.scheduler
+    scheduler.start()
+    start_stats = scheduler.stats()
+    cpu_start = time.thread_time()
+    period = 1.0 / rate
+    start = deadline = time.monotonic()
+    missed = 0
+    n = 0
+    while deadline - start < duration:
+        timestamp, values = flight.packets(n * period)
+        t0 = time.perf_counter()
+        visualizer._telemetry_callback(timestamp, values, None)
+        callback_time.add(time.perf_counter() - t0)
+        n += 1
+
+        deadline += period
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            missed += 1
+    elapsed = time.monotonic() - start
+    callback_cpu = time.thread_time() - cpu_start
+    time.sleep(0.2)  # Let the scheduler publish the last sample
+    scheduler.stop()
+    del visualizer.mapping.flush
+
+    stats = scheduler.stats()
+    return {
+        "rate_hz": rate,
+        "samples": n,
+        "achieved_hz": n / elapsed,
+        "missed_deadlines": missed,
+        "callback_us": callback_time.summary(1e6),
+        "sample_to_scene_ms": stats["latency_ms"],
+        "render_ms": stats["render_ms"],
+        "mapping_flush_ms": mapping["time"].summary(1000.0),
+        "coalesced": stats["coalesced"] - start_stats["coalesced"],
+        "rendered": stats["rendered"] - start_stats["rendered"],
+        "cpu_percent": {
+            "callbacks": 100.0 * callback_cpu / elapsed,
+            "render": 100.0 * (stats["cpu_s"] - start_stats["cpu_s"]) / elapsed,
+            "mapping": 100.0 * mapping["cpu"] / elapsed,
+        },
+        "scan_match": (
+            visualizer.scan_matcher.stats() if visualizer.scan_matcher else None
+        ),
+        "pose_graph": (
+            visualizer.pose_graph.stats() if visualizer.pose_graph is not None else None
+        ),
+    }
+
+
+def run_memory(visualizer, minutes, rate=100, checkpoint_minutes=1.0):
+    """Simulate a long flight as fast as possible and track structure sizes"""
+    flight = SyntheticFlight()
+    flushes_per_second = 30  # Matches the default render rate
+    samples = int(minutes * 60 * rate)
+    per_flush = max(1, rate // flushes_per_second)
+    per_checkpoint = int(checkpoint_minutes * 60 * rate)
+
+    checkpoints = []
+    start = time.perf_counter()
+    for n in range(samples):
+        timestamp, values = flight.packets(n / rate)
+        visualizer._telemetry_callback(timestamp, values, None)
+        if n % per_flush == 0:
+            visualizer.mapping.flush()
+        if (n + 1) % per_checkpoint == 0:
+            checkpoints.append(
+                {
+                    "flight_minutes": (n + 1) / rate / 60.0,
+                    "trajectory_points": len(visualizer.trajectory),
+                    "map_points": len(visualizer.mapping.store),
+                    "map_mb": visualizer.mapping.store.nbytes / 1e6,
+                    "occupancy_blocks": len(visualizer.occupancy.blocks),
+                    "occupancy_mb": visualizer.occupancy.memory_bytes / 1e6,
+                    "rss_mb": _rss_mb(),
+                }
+            )
+    return {
+        "flight_minutes": minutes,
+        "samples": samples,
+        "wall_seconds": time.perf_counter() - start,
+        "checkpoints": checkpoints,
+    }
+
+
+def compare(current, previous):
+    """Print the change in headline numbers against an earlier result file"""
+    old_rates = {r["rate_hz"]: r for r in previous.get("rates", [])}
+    print(f"\n[INFO] Compared with {previous.get('revision')} ({previous.get('date')})")
+    for result in current["rates"]:
+        old = old_rates.get(result["rate_hz"])
+        if old is None:
+            continue
+        for key in ("callback_us", "sample_to_scene_ms", "render_ms"):
+            new_p99, old_p99 = result[key]["p99"], old[key]["p99"]
+            change = 100.0 * (new_p99 - old_p99) / old_p99 if old_p99 else 0.0
+            print(
+                f"  {result['rate_hz']:>5} Hz {key:<20} p99 {old_p99:9.2f} -> "
+                f"{new_p99:9.2f} ({change:+.1f}%)"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telemetry-to-scene benchmark")
+    parser.add_argument("--rates", type=int, nargs="+", default=list(DEFAULT_RATES))
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per rate")
+    parser.add_argument("--flight-minutes", type=float, default=30.0)
+    parser.add_argument("--output", default=None, help="JSON output path")
+    parser.add_argument("--compare", default=None, help="Earlier JSON result")
+    args = parser.parse_args()
+
+    scratch = tempfile.TemporaryDirectory(prefix="bench-maps-")
+    visualizer = _visualizer(os.path.join(scratch.name, "rates"))
+    results = {
+        "revision": _git_revision(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "rates": [],
+    }
+    for rate in args.rates:
+        print(f"[INFO] Driving callbacks at {rate} Hz for {args.duration:.0f} s...")
+        results["rates"].append(run_rate(visualizer, rate, args.duration))
+
+    # Start the long-flight run from empty structures
+    _close(visualizer)
+    visualizer = _visualizer(os.path.join(scratch.name, "memory"))
+    print(f"[INFO] Simulating a {args.flight_minutes:.0f} min flight...")
+    results["memory"] = run_memory(visualizer, args.flight_minutes)
+    _close(visualizer)
+    scratch.cleanup()
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"bench-{stamp}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"[INFO] Results written to {output}")
+
+    for result in results["rates"]:
+        print(
+            f"  {result['rate_hz']:>5} Hz: callback p99 "
+            f"{result['callback_us']['p99']:.1f} us, sample->scene p99 "
+            f"{result['sample_to_scene_ms']['p99']:.1f} ms, "
+            f"achieved {result['achieved_hz']:.0f} Hz"
+        )
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,557 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from perf_stats import RollingStats
+
+# Adaptive streaming
+TARGET_SEND_TIME = 0.15  # Seconds a frame may take to go out before degrading
+CHANGE_THRESHOLD = 6.0  # Largest 8x8 block-mean difference (0-255) that still matches
+
+
+class ServiceStartup:
+    """Run startup steps concurrently, time them and track readiness
+
+    Times are seconds since t0 (pass the time taken at the top of the
+    script so import time is included).
+    """
+
+    def __init__(self, t0=None):
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self.phases = {}  # name -> (start, end)
+        self.events = {}  # name -> seconds since t0
+        self.error = None
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter() - self.t0
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = (start, time.perf_counter() - self.t0)
+
+    def mark(self, name):
+        """Record a one-off milestone, e.g. the first annotated frame"""
+        elapsed = time.perf_counter() - self.t0
+        with self._lock:
+            self.events[name] = elapsed
+        return elapsed
+
+    def run_parallel(self, steps):
+        """Run steps (name -> fn()) on threads; returns name -> result"""
+        results, errors = {}, []
+
+        def run(name, fn):
+            try:
+                with self.phase(name):
+                    results[name] = fn()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=run, args=item, name=f"startup-{item[0]}")
+            for item in steps.items()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def status(self):
+        with self._lock:
+            return {
+                "ready": self.ready.is_set(),
+                "error": str(self.error) if self.error else None,
+                "uptime_s": time.perf_counter() - self.t0,
+                "phases_s": {
+                    name: {"start": start, "end": end}
+                    for name, (start, end) in self.phases.items()
+                },
+                "events_s": dict(self.events),
+            }
+
+
+class Frame:
+    """A captured image with its sequence number and capture time"""
+
+    def __init__(self, seq, image, captured, wall=None):
+        self.seq = seq
+        self.image = image
+        self.captured = captured  # time.monotonic()
+        self.wall = time.time() if wall is None else wall  # For other hosts
+
+    @property
+    def age(self):
+        return time.monotonic() - self.captured
+
+
+class LatestSlot:
+    """Single-value slot that keeps only the newest item
+
+    Producers overwrite; consumers wait for an item newer than the one they
+    last saw, so anything older is dropped without ever being queued.
+    """
+
+    def __init__(self):
+        self._item = None
+        self._seq = 0
+        self._cond = threading.Condition()
+        self.puts = 0
+        self.overwritten = 0  # Items replaced before any consumer read them
+        self._read_seq = 0
+
+    def put(self, item):
+        with self._cond:
+            if self._seq > self._read_seq:
+                self.overwritten += 1
+            self._item = item
+            self._seq += 1
+            self.puts += 1
+            self._cond.notify_all()
+
+    def latest(self):
+        """Return (seq, item) without waiting; item is None before the first put"""
+        with self._cond:
+            return self._seq, self._item
+
+    def wait_newer(self, seq, timeout=None):
+        """Return (seq, item) for the first item after seq
+
+        On timeout returns (current seq, None), so a client holding a seq
+        from before a restart sees the counter go backwards.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > seq, timeout):
+                return self._seq, None
+            self._read_seq = self._seq
+            return self._seq, self._item
+
+
+class RateMeter:
+    """Events per second over the last `window` seconds"""
+
+    def __init__(self, window=2.0):
+        self.window = window
+        self._times = deque()
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def tick(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.count += 1
+            self._times.append(now)
+            cutoff = now - self.window
+            while self._times and self._times[0] < cutoff:
+                self._times.popleft()
+
+    def rate(self):
+        with self._lock:
+            if len(self._times) < 2:
+                return 0.0
+            span = self._times[-1] - self._times[0]
+            return (len(self._times) - 1) / span if span > 0 else 0.0
+
+
+class CaptureStage:
+    """Capture frames on a thread and publish only the newest one"""
+
+    def __init__(self, capture_fn, name="capture"):
+        self.capture_fn = capture_fn
+        self.frames = LatestSlot()
+        self.fps = RateMeter()
+        self.errors = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join(1.0)
+
+    def _run(self):
+        seq = 0
+        while not self._stop_event.is_set():
+            try:
+                image = self.capture_fn()
+            except Exception as e:
+                self.errors += 1
+                print(f"[ERROR] Capture failed: {e}")
+                time.sleep(0.1)
+                continue
+            seq += 1
+            self.frames.put(Frame(seq, image, time.monotonic()))
+            self.fps.tick()
+
+
+class InferenceWorker:
+    """Run inference on the newest captured frame, dropping stale ones
+
+    Inference runs flat out by default. A max_busy below 1 makes the worker
+    rest in proportion to each inference time, capping it at that share of
+    wall time to leave CPU for capture and encoding on a loaded or hot Pi.
+    """
+
+    def __init__(self, infer_fn, frames, max_busy=1.0, name="inference"):
+        self.infer_fn = infer_fn
+        self.frames = frames
+        self.max_busy = max_busy
+        self.results = LatestSlot()  # (Frame, result) of the latest inference
+        self.fps = RateMeter()
+        self.infer_time = RollingStats(capacity=256)
+        self.skipped = 0  # Captured frames never inferred
+        self.errors = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join(2.0)
+
+    def _run(self):
+        last_frame_seq = 0
+        seq = 0
+        while not self._stop_event.is_set():
+            seq, frame = self.frames.wait_newer(seq, timeout=0.5)
+            if frame is None:
+                continue
+            if last_frame_seq:
+                self.skipped += max(0, frame.seq - last_frame_seq - 1)
+            last_frame_seq = frame.seq
+
+            start = time.perf_counter()
+            try:
+                result = self.infer_fn(frame.image)
+            except Exception as e:
+                self.errors += 1
+                print(f"[ERROR] Inference failed: {e}")
+                continue
+            elapsed = time.perf_counter() - start
+            self.infer_time.add(elapsed)
+            self.results.put((frame, result))
+            self.fps.tick()
+
+            if self.max_busy < 1.0:
+                self._stop_event.wait(elapsed * (1.0 / self.max_busy - 1.0))
+
+
+class PipelineStats:
+    """Per-stage FPS and frame ages, printed about once a second"""
+
+    def __init__(self, capture, inference, interval=1.0):
+        self.capture = capture
+        self.inference = inference
+        self.interval = interval
+        self.display_fps = RateMeter()
+        self.frame_age = RollingStats(capacity=256)  # Capture -> display (s)
+        self.detection_age = RollingStats(capacity=256)  # Inferred frame age (s)
+        self._last_print = time.monotonic()
+
+    def displayed(self, frame, detected_frame=None):
+        self.display_fps.tick()
+        self.frame_age.add(frame.age)
+        if detected_frame is not None:
+            self.detection_age.add(detected_frame.age)
+
+    def snapshot(self):
+        infer = self.inference.infer_time.summary(1000.0)
+        capture_fps = self.capture.fps.rate()
+        inference_fps = self.inference.fps.rate()
+        return {
+            "capture_fps": capture_fps,
+            "inference_fps": inference_fps,
+            "display_fps": self.display_fps.rate(),
+            "inference_ms": infer,
+            "frame_age_ms": self.frame_age.summary(1000.0),
+            "detection_age_ms": self.detection_age.summary(1000.0),
+            "frames_per_inference": (
+                capture_fps / inference_fps if inference_fps else 0.0
+            ),
+            "skipped": self.inference.skipped,
+        }
+
+    def maybe_print(self):
+        now = time.monotonic()
+        if now - self._last_print < self.interval:
+            return
+        self._last_print = now
+        s = self.snapshot()
+        print(
+            f"[INFO] capture {s['capture_fps']:.1f} fps | inference "
+            f"{s['inference_fps']:.1f} fps ({s['inference_ms']['p50']:.0f} ms, "
+            f"1 in {s['frames_per_inference']:.1f} frames) | display "
+            f"{s['display_fps']:.1f} fps | frame age p50 "
+            f"{s['frame_age_ms']['p50']:.0f} ms, detections "
+            f"{s['detection_age_ms']['p50']:.0f} ms"
+        )
+
+
+def _block_means(image, block=8):
+    """Downsample an image by averaging block x block tiles"""
+    h, w = image.shape[0] // block * block, image.shape[1] // block * block
+    tiles = np.asarray(image[:h, :w], dtype=np.float32)
+    return tiles.reshape(h // block, block, w // block, block, -1).mean(axis=(1, 3))
+
+
+def mjpeg_part(jpeg):
+    """Wrap one JPEG as a multipart/x-mixed-replace part"""
+    return b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + jpeg + b"\r\n"
+
+
+class QualityLevel:
+    """One step of the stream quality ladder"""
+
+    def __init__(self, scale, jpeg_quality, max_fps):
+        self.scale = scale  # Output size relative to the camera frame
+        self.jpeg_quality = jpeg_quality
+        self.max_fps = max_fps
+
+    def as_dict(self):
+        return {
+            "scale": self.scale,
+            "jpeg_quality": self.jpeg_quality,
+            "max_fps": self.max_fps,
+        }
+
+
+# Best first; adaptive clients move down the ladder when sends back up
+QUALITY_LEVELS = [
+    QualityLevel(1.0, 80, 30.0),
+    QualityLevel(1.0, 60, 20.0),
+    QualityLevel(0.75, 50, 15.0),
+    QualityLevel(0.5, 45, 10.0),
+    QualityLevel(0.5, 30, 5.0),
+    QualityLevel(0.25, 30, 2.0),
+]
+
+
+class StreamClient:
+    """Send statistics and quality level of one connected viewer"""
+
+    def __init__(self, client_id, level, adaptive):
+        self.id = client_id
+        self.level = level
+        self.adaptive = adaptive
+        self.connected = time.monotonic()
+        self.sent = 0
+        self.dropped = 0  # Frames published while this client was still sending
+        self.bytes = 0
+        self.send_time = 0.0  # Smoothed seconds a yield blocked (backpressure)
+        self.throughput = 0.0  # Smoothed bytes per second while sending
+        self.level_changed = self.connected
+
+    def record_send(self, nbytes, seconds, alpha=0.2):
+        self.sent += 1
+        self.bytes += nbytes
+        self.send_time += alpha * (seconds - self.send_time)
+        rate = nbytes / max(seconds, 1e-4)
+        self.throughput += alpha * (rate - self.throughput)
+
+
+class QualityController:
+    """Pick a quality level per client from how long its sends block
+
+    A client whose frames take longer than target_send_time to go out is
+    stepped down straight away; one that stays well below the target for
+    hold seconds is stepped back up one level.
+    """
+
+    def __init__(
+        self, levels=QUALITY_LEVELS, target_send_time=TARGET_SEND_TIME, hold=3.0
+    ):
+        self.levels = levels
+        self.target_send_time = target_send_time
+        self.hold = hold
+
+    def update(self, client, now=None):
+        now = time.monotonic() if now is None else now
+        since_change = now - client.level_changed
+        if client.send_time > self.target_send_time and since_change > 0.5:
+            if client.level < len(self.levels) - 1:
+                client.level += 1
+                client.level_changed = now
+        elif (
+            client.send_time < 0.3 * self.target_send_time and since_change > self.hold
+        ):
+            if client.level > 0:
+                client.level -= 1
+                client.level_changed = now
+        return self.levels[client.level]
+
+
+class MjpegHub:
+    """Render each annotated frame once and fan it out to every HTTP client
+
+    One producer thread takes the newest captured frame and draws the latest
+    detections on it; frames that look the same as the previous one are not
+    published at all. Clients send the newest frame, encoded at most once
+    per quality level, paced to their level's max_fps, so a slow client
+    simply skips frames instead of queueing them or slowing the others.
+    Adaptive clients move along the quality ladder with their backpressure.
+    """
+
+    def __init__(self, capture, inference, render_fn, encode_fn, levels=QUALITY_LEVELS):
+        self.capture = capture
+        self.inference = inference
+        self.render_fn = render_fn  # (Frame, detection or None) -> image
+        self.encode_fn = encode_fn  # (image, QualityLevel) -> JPEG bytes
+        self.levels = levels
+        self.controller = QualityController(levels)
+        self.frames = LatestSlot()  # (Frame, annotated image)
+        self.render_fps = RateMeter()
+        self.encode_time = RollingStats(capacity=256)
+        self.encodes = 0
+        self.unchanged = 0  # Frames not published because nothing changed
+        self.clients = {}
+        self._next_id = 0
+        self._cache = {}  # level index -> multipart bytes for _cache_seq
+        self._cache_seq = 0
+        self._cache_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._has_clients = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mjpeg-hub", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._has_clients.set()
+        self._thread.join(2.0)
+
+    def _run(self):
+        seq = 0
+        last_thumb = None
+        last_detection_seq = 0
+        while not self._stop_event.is_set():
+            self._has_clients.wait()
+            seq, frame = self.capture.frames.wait_newer(seq, timeout=0.5)
+            if frame is None:
+                continue
+            detection_seq, detection = self.inference.results.latest()
+            try:
+                image = self.render_fn(frame, detection)
+            except Exception as e:
+                print(f"[ERROR] Rendering failed: {e}")
+                continue
+
+            # Skip frames that match the last one (static scene, same
+            # detections). A new inference result is always published; for
+            # the image, the largest block difference decides, so a small
+            # object or box that moved is not averaged away by the rest.
+            thumb = _block_means(image)
+            if (
+                detection_seq == last_detection_seq
+                and last_thumb is not None
+                and thumb.shape == last_thumb.shape
+                and np.abs(thumb - last_thumb).max() < CHANGE_THRESHOLD
+            ):
+                self.unchanged += 1
+                continue
+            last_thumb = thumb
+            last_detection_seq = detection_seq
+            self.frames.put((frame, image))
+            self.render_fps.tick()
+
+    def _encoded(self, seq, image, level):
+        """Multipart chunk of frame seq at a quality level, encoded once"""
+        with self._cache_lock:
+            if seq != self._cache_seq:
+                self._cache = {}
+                self._cache_seq = seq
+            part = self._cache.get(level)
+            if part is None:
+                start = time.perf_counter()
+                part = mjpeg_part(self.encode_fn(image, self.levels[level]))
+                self.encode_time.add(time.perf_counter() - start)
+                self.encodes += 1
+                self._cache[level] = part
+            return part
+
+    def stream(self, adaptive=False, level=0):
+        """Generator of multipart chunks for one HTTP client"""
+        with self._lock:
+            client = StreamClient(self._next_id, level, adaptive)
+            self._next_id += 1
+            self.clients[client.id] = client
+            self._has_clients.set()
+        try:
+            seq, _ = self.frames.latest()
+            seq = max(0, seq - 1)  # Start with the current frame
+            deadline = time.monotonic()
+            while not self._stop_event.is_set():
+                new_seq, item = self.frames.wait_newer(seq, timeout=1.0)
+                if item is None:
+                    continue
+                if seq:
+                    client.dropped += max(0, new_seq - seq - 1)
+                seq = new_seq
+                part = self._encoded(seq, item[1], client.level)
+
+                # The yield returns once the server has written the chunk, so
+                # its duration is the backpressure from this client's link
+                start = time.monotonic()
+                yield part
+                now = time.monotonic()
+                client.record_send(len(part), now - start)
+                quality = self.levels[client.level]
+                if client.adaptive:
+                    quality = self.controller.update(client, now)
+
+                deadline = max(deadline + 1.0 / quality.max_fps, now)
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            with self._lock:
+                del self.clients[client.id]
+                if not self.clients:
+                    self._has_clients.clear()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            clients = list(self.clients.values())
+        return {
+            "clients": len(clients),
+            "render_fps": self.render_fps.rate(),
+            "unchanged_frames": self.unchanged,
+            "encodes": self.encodes,
+            "encode_ms": self.encode_time.summary(1000.0),
+            "per_client": [
+                {
+                    "id": c.id,
+                    "adaptive": c.adaptive,
+                    "level": c.level,
+                    "quality": self.levels[c.level].as_dict(),
+                    "sent": c.sent,
+                    "dropped": c.dropped,
+                    "fps": c.sent / max(now - c.connected, 1e-9),
+                    "send_ms": c.send_time * 1000.0,
+                    "throughput_kbps": c.throughput * 8.0 / 1000.0,
+                    "average_kbps": 8.0
+                    * c.bytes
+                    / max(now - c.connected, 1e-9)
+                    / 1000.0,
+                }
+                for c in clients
+            ],
+        }
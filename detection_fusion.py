@@ -0,0 +1,245 @@
+import json
+import threading
+import time
+import urllib.request
+import zlib
+
+import numpy as np
+
+from mapping import MAX_RANGE, rotation_matrices, voxel_keys
+
+# Pi camera v2 looking along the body x axis; the image is 640x480
+CAMERA_HFOV = 62.2  # Degrees
+DEFAULT_DEPTH = 1.5  # Metres along the optical axis when the front ranger has no return
+MIN_CONFIDENCE = 0.5
+MERGE_RADIUS = 0.5  # Same-label sightings closer than this are one object
+POLL_TIMEOUT = 2.0  # Seconds; the endpoint long-polls for up to 1 s
+LABEL_HEIGHT = 0.12  # Metres above the marker
+MARKER_SIZE = 0.08
+
+MARKER_COLORS = [
+    (230, 25, 75),
+    (60, 180, 75),
+    (255, 225, 25),
+    (0, 130, 200),
+    (245, 130, 48),
+    (145, 30, 180),
+    (70, 240, 240),
+    (240, 50, 230),
+]
+
+
+def label_color(label):
+    """Stable colour per class name"""
+    return MARKER_COLORS[zlib.crc32(label.encode()) % len(MARKER_COLORS)]
+
+
+def project_boxes(pose, boxes, width, height, hfov=CAMERA_HFOV):
+    """World-frame points (N, 3) at the centre of each box (N, 4 xyxy pixels)
+
+    pose is a PoseHistory row. The depth comes from the front ranger, which
+    looks along the optical axis, and falls back to DEFAULT_DEPTH.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    focal = (width / 2.0) / np.tan(np.radians(hfov) / 2.0)
+    u = (boxes[:, 0] + boxes[:, 2]) / 2.0
+    v = (boxes[:, 1] + boxes[:, 3]) / 2.0
+    # Image right is body -y, image down is body -z; rays have unit x
+    rays = np.stack(
+        [
+            np.ones_like(u),
+            -(u - width / 2.0) / focal,
+            -(v - height / 2.0) / focal,
+        ],
+        axis=1,
+    )
+
+    depth = pose[6]
+    if not np.isfinite(depth) or depth >= MAX_RANGE:
+        depth = DEFAULT_DEPTH
+    rot = rotation_matrices(pose[3], -pose[4], pose[5])
+    return pose[:3] + (rays * depth) @ rot.T
+
+
+class MarkerIndex:
+    """Merged object markers behind a voxel-hash spatial index
+
+    A sighting within merge_radius of a marker with the same label updates
+    that marker's running mean instead of adding a new one; only the 27
+    cells around the sighting are searched.
+    """
+
+    def __init__(self, merge_radius=MERGE_RADIUS):
+        self.merge_radius = merge_radius
+        self.positions = []  # (3,) arrays, one per marker
+        self.labels = []
+        self.counts = []
+        self.confidences = []  # Best confidence seen
+        self._cells = {}  # voxel key -> marker ids
+        self._neighbours = np.stack(
+            np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing="ij"), axis=-1
+        ).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _cell(self, point):
+        return np.floor(np.asarray(point) / self.merge_radius).astype(np.int64)
+
+    def _key(self, point):
+        return int(voxel_keys(self._cell(point)[None])[0])
+
+    def nearest(self, point, label):
+        """Id of the closest same-label marker within merge_radius, or None"""
+        keys = voxel_keys(self._cell(point) + self._neighbours)
+        best, best_dist = None, self.merge_radius
+        for key in keys.tolist():
+            for i in self._cells.get(key, ()):
+                if self.labels[i] != label:
+                    continue
+                dist = np.linalg.norm(self.positions[i] - point)
+                if dist <= best_dist:
+                    best, best_dist = i, dist
+        return best
+
+    def add(self, point, label, confidence):
+        """Merge one sighting; returns (marker id, True if it is new)"""
+        point = np.asarray(point, dtype=np.float64)
+        i = self.nearest(point, label)
+        if i is None:
+            i = len(self.positions)
+            self.positions.append(point)
+            self.labels.append(label)
+            self.counts.append(1)
+            self.confidences.append(confidence)
+            self._cells.setdefault(self._key(point), []).append(i)
+            return i, True
+
+        old_key = self._key(self.positions[i])
+        self.counts[i] += 1
+        self.positions[i] = (
+            self.positions[i] + (point - self.positions[i]) / self.counts[i]
+        )
+        self.confidences[i] = max(self.confidences[i], confidence)
+        new_key = self._key(self.positions[i])
+        if new_key != old_key:
+            self._cells[old_key].remove(i)
+            self._cells.setdefault(new_key, []).append(i)
+        return i, False
+
+
+class DetectionFusion:
+    """Place camera detections in the world using the pose at capture time
+
+    Detections come from the /detections endpoint of
+    raspicam_detection_wireless.py (or add_detections()). Each frame's
+    wall-clock capture time is looked up in a PoseHistory, so both hosts
+    need synced clocks (NTP). Markers are drawn as one point cloud plus a
+    label per object, refreshed by render().
+    """
+
+    def __init__(self, scene, poses, url=None, merge_radius=MERGE_RADIUS):
+        self.scene = scene
+        self.poses = poses
+        self.url = url
+        self.markers = MarkerIndex(merge_radius)
+        self._lock = threading.Lock()
+        self._dirty = set()  # Marker ids changed since the last render
+        self._thread = None
+        self._stop = threading.Event()
+        self._last_seq = 0
+        self.frames = 0
+        self.sightings = 0
+        self.no_pose = 0
+        self.errors = 0
+        self.latency = 0.0  # Seconds from capture to fusion, last frame
+
+    def add_detections(self, captured, boxes, width, height):
+        """Fuse one frame's boxes ([{"xyxy", "conf", "label"}, ...])"""
+        self.frames += 1
+        boxes = [b for b in boxes if b["conf"] >= MIN_CONFIDENCE]
+        if not boxes:
+            return 0
+        pose = self.poses.lookup(captured)
+        if pose is None:
+            self.no_pose += 1
+            return 0
+        points = project_boxes(pose, [b["xyxy"] for b in boxes], width, height)
+        with self._lock:
+            for box, point in zip(boxes, points):
+                i, _ = self.markers.add(point, box["label"], box["conf"])
+                self._dirty.add(i)
+        self.sightings += len(boxes)
+        self.latency = time.time() - captured
+        return len(boxes)
+
+    def start(self):
+        if self.url and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._poll, name="detection-fusion", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=POLL_TIMEOUT)
+            self._thread = None
+
+    def _poll(self):
+        while not self._stop.is_set():
+            try:
+                url = f"{self.url}?after={self._last_seq}"
+                with urllib.request.urlopen(url, timeout=POLL_TIMEOUT) as response:
+                    reply = json.load(response)
+            except Exception as e:
+                # Camera not up yet (503) or unreachable; retry shortly
+                self.errors += 1
+                if self.errors == 1:
+                    print(f"[WARNING] Detections unavailable from {self.url}: {e}")
+                self._stop.wait(1.0)
+                continue
+            if reply["seq"] < self._last_seq:
+                self._last_seq = 0  # Camera service restarted
+                continue
+            if reply["seq"] == self._last_seq or "captured" not in reply:
+                continue
+            self._last_seq = reply["seq"]
+            self.add_detections(
+                reply["captured"], reply["boxes"], reply["width"], reply["height"]
+            )
+
+    def render(self):
+        """Redraw markers and update the labels of changed ones"""
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            points = np.array(self.markers.positions, dtype=np.float32)
+            labels = list(self.markers.labels)
+            counts = list(self.markers.counts)
+        colors = np.array([label_color(label) for label in labels], dtype=np.uint8)
+        self.scene.add_point_cloud(
+            "/detections/markers",
+            points=points,
+            colors=colors,
+            point_size=MARKER_SIZE,
+            point_shape="circle",
+        )
+        for i in dirty:
+            self.scene.add_label(
+                f"/detections/label_{i}",
+                f"{labels[i]} ({counts[i]})",
+                position=tuple(points[i] + (0.0, 0.0, LABEL_HEIGHT)),
+            )
+
+    def stats(self):
+        return {
+            "markers": len(self.markers),
+            "frames": self.frames,
+            "sightings": self.sightings,
+            "no_pose": self.no_pose,
+            "errors": self.errors,
+            "latency_ms": self.latency * 1000.0,
+        }
@@ -0,0 +1,595 @@
+import math
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from mapping import unpack_voxel_keys, voxel_keys
+from occupancy import L_OCCUPIED
+from perf_stats import RollingStats
+
+UNKNOWN, FREE, OCCUPIED = 0, 1, 2  # Cell states of the flight-height slice
+
+# Frontier tracking
+BAND = 0.2  # Metres above and below the flight height that count
+MAX_TILES = 64  # Tile columns re-classified per update (bounds update time)
+MIN_CLUSTER = 8  # Frontier cells; smaller clusters are gaps between rays
+
+# Goal selection and planning
+PLAN_POOL = 2  # Occupancy cells per planning cell edge
+INFLATION = 0.25  # Clearance kept from occupied cells (m)
+COST_RATE = 0.5  # Utility = frontier length * exp(-COST_RATE * path length)
+HYSTERESIS = 1.5  # A new goal must beat the current one by this factor
+BLACKLIST_RADIUS = 0.3  # Goals near one given up on are skipped (m)
+
+# Following
+CONTROL_RATE = 10.0  # Setpoint updates per second
+REPLAN_INTERVAL = 1.0  # Seconds between replans while the map changes
+COMMAND_TIMEOUT = 0.3  # Each setpoint expires unless renewed (s)
+SPEED = 0.3  # m/s
+LOOKAHEAD = 0.3  # Distance along the path to steer towards (m)
+GOAL_RADIUS = 0.25  # m
+GOAL_TIMEOUT = 30.0  # Seconds before a goal is given up on
+YAW_SWEEP = 30.0  # Turn rate while exploring, sweeps the rangers (deg/s)
+IDLE_TIMEOUT = 15.0  # Seconds without a reachable frontier before finishing
+HEIGHT_GAIN = 1.0  # Vertical speed per metre of height error (1/s)
+MAX_VZ = 0.2  # m/s
+
+# Octagonal wavefront: alternating 8- and 4-connected steps give a step
+# count within about 6% of the Euclidean distance in cells
+_NEIGHBOURS_4 = ((1, 0), (-1, 0), (0, 1), (0, -1))
+_NEIGHBOURS_8 = _NEIGHBOURS_4 + ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+
+def dilate(mask, offsets):
+    """OR of mask shifted by each (dx, dy) offset"""
+    reach = max(max(abs(dx), abs(dy)) for dx, dy in offsets)
+    padded = np.pad(mask, reach)
+    out = np.zeros_like(mask)
+    w, h = mask.shape
+    for dx, dy in offsets:
+        out |= padded[reach - dx : reach - dx + w, reach - dy : reach - dy + h]
+    return out
+
+
+def disk_offsets(radius):
+    """Integer offsets within radius cells of the origin"""
+    r = int(math.ceil(radius))
+    return [
+        (dx, dy)
+        for dx in range(-r, r + 1)
+        for dy in range(-r, r + 1)
+        if dx * dx + dy * dy <= radius * radius
+    ]
+
+
+def wavefront(passable, start, max_steps=None):
+    """Distance in steps from start over passable cells (inf where unreached)
+
+    Grows the whole wave front in one array operation per step, so the
+    cost is (path length) x (grid size) in numpy rather than per-cell Python.
+    """
+    dist = np.full(passable.shape, np.inf)
+    wave = np.zeros(passable.shape, dtype=bool)
+    wave[start] = True
+    dist[start] = 0
+    reached = wave.copy()
+    step = 0
+    while wave.any() and (max_steps is None or step < max_steps):
+        step += 1
+        grown = dilate(wave, _NEIGHBOURS_8 if step % 2 else _NEIGHBOURS_4)
+        wave = grown & passable & ~reached
+        dist[wave] = step
+        reached |= wave
+    return dist
+
+
+def descend(dist, goal):
+    """Cells from the wavefront start to goal, following dist downhill"""
+    w, h = dist.shape
+    path = [goal]
+    x, y = goal
+    while dist[x, y] > 0:
+        best = None
+        for dx, dy in _NEIGHBOURS_8:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < w and 0 <= ny < h and dist[nx, ny] < dist[x, y]:
+                if best is None or dist[nx, ny] < dist[best]:
+                    best = (nx, ny)
+        if best is None:
+            break
+        x, y = best
+        path.append(best)
+    path.reverse()
+    return path
+
+
+def cluster_cells(cells):
+    """Split (N, 2) integer cells into 8-connected clusters (lists of rows)"""
+    unvisited = {cell: i for i, cell in enumerate(map(tuple, cells.tolist()))}
+    clusters = []
+    while unvisited:
+        cell, i = unvisited.popitem()
+        members = [i]
+        queue = deque([cell])
+        while queue:
+            x, y = queue.popleft()
+            for dx, dy in _NEIGHBOURS_8:
+                i = unvisited.pop((x + dx, y + dy), None)
+                if i is not None:
+                    members.append(i)
+                    queue.append((x + dx, y + dy))
+        clusters.append(members)
+    return clusters
+
+
+class FrontierTracker:
+    """Frontier cells of the occupancy map at flight height, kept up to date
+
+    The occupancy grid is sliced into a 2D map: a column of voxels within
+    BAND of the flight height is occupied if any voxel is, free if any was
+    seen free, unknown otherwise. Tiles are the columns of occupancy
+    blocks, and only tiles under blocks that changed are re-classified, at
+    most max_tiles per update(). A frontier cell is a free cell next to an
+    unknown one; frontiers are recomputed for changed tiles and their four
+    neighbours only, so an update never rescans the map.
+    """
+
+    def __init__(self, occupancy, height, band=BAND, max_tiles=MAX_TILES):
+        self.occupancy = occupancy
+        self.resolution = occupancy.resolution
+        self.block = occupancy.block_size
+        self.band = band
+        self.max_tiles = max_tiles
+        self._watcher = occupancy.watch()
+        self._states = {}  # (bx, by) -> (b, b) uint8 cell states
+        self._frontier = {}  # (bx, by) -> (b, b) bool, tiles with frontier only
+        self._pending = set()  # Tile columns waiting to be re-classified
+        self._watchers = []  # Per watcher: tiles changed since take_changed()
+        self._lock = threading.Lock()
+        self._z = None
+        self.height = height
+        self._slice(height)
+
+        self.version = 0  # Changes whenever a frontier changes
+        self.tiles_updated = 0
+        self.update_time = RollingStats()
+
+    def set_height(self, height):
+        """Slice at another flight height from the next update() on"""
+        self.height = height
+
+    def _slice(self, height):
+        lo = int(math.floor((height - self.band) / self.resolution))
+        hi = int(math.floor((height + self.band) / self.resolution))
+        if (lo, hi) == self._z:
+            return
+        self._z = (lo, hi)
+        self._blocks = range(lo // self.block, hi // self.block + 1)
+        keys = np.fromiter(self.occupancy.block_keys(), dtype=np.int64)
+        self._pending.update(map(tuple, unpack_voxel_keys(keys)[:, :2].tolist()))
+
+    def update(self):
+        """Re-classify tiles under changed blocks (render thread)
+
+        Returns the number of tiles re-classified; tiles beyond max_tiles
+        wait for the next call.
+        """
+        start = time.perf_counter()
+        self._slice(self.height)
+        keys = np.fromiter(self.occupancy.take_dirty(self._watcher), dtype=np.int64)
+        if len(keys):
+            idx = unpack_voxel_keys(keys)
+            bz = idx[:, 2]
+            idx = idx[(bz >= self._blocks.start) & (bz < self._blocks.stop)]
+            self._pending.update(map(tuple, idx[:, :2].tolist()))
+        if not self._pending:
+            return 0
+
+        tiles = [
+            self._pending.pop() for _ in range(min(self.max_tiles, len(self._pending)))
+        ]
+        states = self._classify(tiles)
+        changed = {
+            t for t in tiles if not np.array_equal(states[t], self._states.get(t))
+        }
+        with self._lock:
+            for tile in changed:
+                self._states[tile] = states[tile]
+            for watched in self._watchers:
+                watched.update(changed)
+            around = set(changed)
+            for bx, by in changed:
+                around.update(((bx + 1, by), (bx - 1, by), (bx, by + 1), (bx, by - 1)))
+            for tile in around:
+                if tile in self._states:
+                    self._update_frontier(tile)
+        self.tiles_updated += len(tiles)
+        self.update_time.add(time.perf_counter() - start)
+        return len(tiles)
+
+    def _classify(self, tiles):
+        b = self.block
+        lo, hi = self._z
+        columns = np.array(tiles, dtype=np.int64)
+        layers = np.array(self._blocks, dtype=np.int64)
+        idx = np.empty((len(columns), len(layers), 3), dtype=np.int64)
+        idx[:, :, :2] = columns[:, None, :]
+        idx[:, :, 2] = layers[None, :]
+        keys = voxel_keys(idx.reshape(-1, 3)).reshape(len(columns), len(layers))
+        blocks = self.occupancy.copy_blocks(keys.reshape(-1).tolist())
+
+        states = {}
+        for tile, column in zip(tiles, keys.tolist()):
+            occupied = np.zeros((b, b), dtype=bool)
+            free = np.zeros((b, b), dtype=bool)
+            for bz, key in zip(self._blocks, column):
+                block = blocks.get(key)
+                if block is None:
+                    continue
+                # z cells of this block that fall inside the band
+                z0 = max(lo - bz * b, 0)
+                z1 = min(hi - bz * b + 1, b)
+                values = block.reshape(b, b, b)[:, :, z0:z1]
+                occupied |= (values > L_OCCUPIED).any(axis=2)
+                free |= (values < 0.0).any(axis=2)
+            states[tile] = np.where(
+                occupied, OCCUPIED, np.where(free, FREE, UNKNOWN)
+            ).astype(np.uint8)
+        return states
+
+    def _update_frontier(self, tile):
+        b = self.block
+        bx, by = tile
+        state = self._states[tile]
+        padded = np.zeros((b + 2, b + 2), dtype=np.uint8)  # Missing = unknown
+        padded[1:-1, 1:-1] = state
+        side = self._states.get((bx - 1, by))
+        if side is not None:
+            padded[0, 1:-1] = side[-1, :]
+        side = self._states.get((bx + 1, by))
+        if side is not None:
+            padded[-1, 1:-1] = side[0, :]
+        side = self._states.get((bx, by - 1))
+        if side is not None:
+            padded[1:-1, 0] = side[:, -1]
+        side = self._states.get((bx, by + 1))
+        if side is not None:
+            padded[1:-1, -1] = side[:, 0]
+        frontier = (state == FREE) & (
+            (padded[:-2, 1:-1] == UNKNOWN)
+            | (padded[2:, 1:-1] == UNKNOWN)
+            | (padded[1:-1, :-2] == UNKNOWN)
+            | (padded[1:-1, 2:] == UNKNOWN)
+        )
+        old = self._frontier.get(tile)
+        if frontier.any():
+            if old is None or not np.array_equal(old, frontier):
+                self._frontier[tile] = frontier
+                self.version += 1
+        elif old is not None:
+            del self._frontier[tile]
+            self.version += 1
+
+    def watch(self):
+        """Register a reader of changed tiles; returns its take_changed() id
+
+        A new watcher starts with every tile marked changed.
+        """
+        with self._lock:
+            self._watchers.append(set(self._states))
+            return len(self._watchers) - 1
+
+    def take_changed(self, watcher):
+        """Cell states {tile: (b, b) array} of tiles changed since the last call"""
+        with self._lock:
+            changed, self._watchers[watcher] = self._watchers[watcher], set()
+            return {tile: self._states[tile] for tile in changed}
+
+    def snapshot(self):
+        """Dense copy of the tracked area: (origin cell, states, frontier)
+
+        states and frontier are (W, H) arrays indexed from the origin cell
+        (ix, iy); None when nothing has been mapped at flight height yet.
+        """
+        with self._lock:
+            # Tile arrays are replaced, never modified, so references suffice
+            states = list(self._states.items())
+            frontier = list(self._frontier.items())
+        if not states:
+            return None
+        b = self.block
+        tiles = np.array([t for t, _ in states])
+        lo = tiles.min(axis=0)
+        w, h = (tiles.max(axis=0) - lo + 1) * b
+        grid = np.zeros((w, h), dtype=np.uint8)
+        front = np.zeros((w, h), dtype=bool)
+        for items, out in ((states, grid), (frontier, front)):
+            for (bx, by), cells in items:
+                x, y = (bx - lo[0]) * b, (by - lo[1]) * b
+                out[x : x + b, y : y + b] = cells
+        return lo * b, grid, front
+
+    def cells(self):
+        """World-frame centres (N, 3) of all frontier cells at flight height"""
+        with self._lock:
+            frontier = list(self._frontier.items())
+        if not frontier:
+            return np.zeros((0, 3), dtype=np.float32)
+        b = self.block
+        centers = []
+        for (bx, by), cells in frontier:
+            centers.append(np.argwhere(cells) + (bx * b, by * b))
+        xy = (np.concatenate(centers) + 0.5) * self.resolution
+        z = np.full((len(xy), 1), self.height)
+        return np.hstack((xy, z)).astype(np.float32)
+
+    def stats(self):
+        with self._lock:
+            cells = sum(int(f.sum()) for f in self._frontier.values())
+            tiles = len(self._states)
+        return {
+            "tiles": tiles,
+            "frontier_cells": cells,
+            "pending_tiles": len(self._pending),
+            "tiles_updated": self.tiles_updated,
+            "update_ms": self.update_time.summary(1000.0),
+        }
+
+
+class Explorer:
+    """Fly to frontier clusters until none is left
+
+    A control thread renews a short velocity setpoint CONTROL_RATE times a
+    second through the SetpointStreamer, so the drone stops on its own if
+    the thread stalls. Goals are replanned when reached, given up on, or
+    every REPLAN_INTERVAL while the frontiers change: one wavefront from
+    the drone over known free space (obstacles inflated) gives the path
+    length to every frontier cell at once, and each cluster is scored by
+    its length times exp(-COST_RATE * path length). The drone follows the
+    path with a lookahead point and sweeps its yaw so the four rangers
+    cover the space between them.
+    """
+
+    def __init__(self, frontiers, setpoints, speed=SPEED):
+        self.frontiers = frontiers
+        self.setpoints = setpoints
+        self.speed = speed
+        self.height = frontiers.height
+        self._pose = None  # Latest (x, y, z, yaw deg) in the map frame
+        self._path = None  # (N, 2) waypoints to the goal
+        self._goal = None
+        self._utility = 0.0
+        self._goal_since = 0.0
+        self._planned_at = float("-inf")
+        self._planned_version = -1
+        self._idle_since = None  # No reachable frontier since then
+        self._blacklist = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.state = "idle"
+
+        self.plans = 0
+        self.clusters = 0
+        self.goals_reached = 0
+        self.goals_abandoned = 0
+        self.plan_time = RollingStats(capacity=256)
+
+    @property
+    def active(self):
+        return self._thread is not None
+
+    def set_pose(self, x, y, z, yaw):
+        """Latest map-frame pose (runs on the radio thread)"""
+        self._pose = (x, y, z, yaw)
+
+    def start(self, height):
+        if self._thread is not None:
+            return
+        self.height = height
+        self.frontiers.set_height(height)
+        self._goal = self._path = None
+        self._planned_at = float("-inf")
+        self._planned_version = -1
+        self._idle_since = None
+        self._stop_event.clear()
+        self.state = "exploring"
+        self._thread = threading.Thread(target=self._run, name="explorer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop exploring and hover (the setpoint stream sends a zero)"""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stop_event.set()
+        if thread is not threading.current_thread():
+            thread.join()
+        self._thread = None
+        self.setpoints.cancel()
+        with self._lock:
+            self._path = None
+        if self.state == "exploring":
+            self.state = "idle"
+
+    def path(self):
+        """Waypoints (N, 3) to the current goal, or None"""
+        with self._lock:
+            path = self._path
+        if path is None:
+            return None
+        return np.hstack((path, np.full((len(path), 1), self.height)))
+
+    def _run(self):
+        period = 1.0 / CONTROL_RATE
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                if self._tick(time.monotonic()):
+                    print(
+                        f"[INFO] Exploration complete: {self.goals_reached} goals "
+                        f"reached, {self.goals_abandoned} given up"
+                    )
+                    self.state = "done"
+                    break
+            except Exception as e:
+                print(f"[ERROR] Exploration stopped: {e}")
+                self.state = "error"
+                break
+            deadline += period
+            self._stop_event.wait(max(0.0, deadline - time.monotonic()))
+        if not self._stop_event.is_set():
+            self.setpoints.cancel()
+            self._thread = None
+
+    def _tick(self, now):
+        """One control step; returns True when nothing is left to explore"""
+        if self._pose is None:
+            return False
+        x, y, z, yaw = self._pose
+        xy = np.array((x, y))
+        if self._goal is not None:
+            if np.hypot(*(self._goal - xy)) < GOAL_RADIUS:
+                self.goals_reached += 1
+                self._goal = None
+            elif now - self._goal_since > GOAL_TIMEOUT:
+                print(f"[WARNING] Exploration goal {self._goal.round(2)} given up")
+                self._blacklist.append(self._goal)
+                self.goals_abandoned += 1
+                self._goal = None
+        changed = self.frontiers.version != self._planned_version
+        if (self._goal is None and changed) or (
+            now - self._planned_at >= REPLAN_INTERVAL
+            and (changed or self._goal is None)
+        ):
+            self._plan(xy, now)
+        if self._goal is not None:
+            self._idle_since = None
+        elif self._idle_since is None:
+            self._idle_since = now
+        elif now - self._idle_since > IDLE_TIMEOUT:
+            return True
+
+        vx = vy = 0.0
+        if self._goal is not None:
+            vx, vy = self._follow(xy)
+        # Body frame: x forward, y left
+        c, s = math.cos(math.radians(yaw)), math.sin(math.radians(yaw))
+        vz = float(np.clip(HEIGHT_GAIN * (self.height - z), -MAX_VZ, MAX_VZ))
+        self.setpoints.submit(
+            c * vx + s * vy,
+            -s * vx + c * vy,
+            vz,
+            YAW_SWEEP,
+            duration=COMMAND_TIMEOUT,
+            mode="replace",
+        )
+        return False
+
+    def _follow(self, xy):
+        path = self._path
+        distance = np.hypot(*(path - xy).T)
+        ahead = int(np.argmin(distance))
+        while ahead < len(path) - 1 and distance[ahead] < LOOKAHEAD:
+            ahead += 1
+        step = path[ahead] - xy
+        length = np.hypot(*step)
+        if length < 1e-6:
+            return 0.0, 0.0
+        # Slow down over the last half metre
+        speed = self.speed * min(1.0, np.hypot(*(self._goal - xy)) / 0.5)
+        return tuple(step / length * max(speed, 0.05))
+
+    def _plan(self, xy, now):
+        """Pick the best frontier cluster and a path to it; False if none"""
+        start = time.perf_counter()
+        self._planned_at = now
+        self._planned_version = self.frontiers.version
+        snapshot = self.frontiers.snapshot()
+        if snapshot is None:
+            return False
+        origin, states, frontier = snapshot
+        res = self.frontiers.resolution
+        cell = res * PLAN_POOL
+
+        # Pool to planning cells: occupied if any cell is, free if any was
+        # seen free
+        w, h = -(-np.array(states.shape) // PLAN_POOL) * PLAN_POOL
+        pooled = np.zeros((w, h), dtype=np.uint8)
+        pooled[: states.shape[0], : states.shape[1]] = states
+        pooled = pooled.reshape(w // PLAN_POOL, PLAN_POOL, h // PLAN_POOL, PLAN_POOL)
+        occupied = (pooled == OCCUPIED).any(axis=(1, 3))
+        free = (pooled == FREE).any(axis=(1, 3))
+
+        begin = tuple(((np.floor(xy / res) - origin) // PLAN_POOL).astype(int))
+        if not all(0 <= b < n for b, n in zip(begin, occupied.shape)):
+            return False
+        # Clearance from the edge of occupied cells, not their centres
+        clearance = disk_offsets(INFLATION / cell + 0.5)
+        passable = free & ~dilate(occupied, clearance)
+        # Frontier cells without clearance (e.g. along the unseen inside of
+        # an obstacle) are not worth flying to
+        cells = np.argwhere(frontier)
+        cells = cells[passable[cells[:, 0] // PLAN_POOL, cells[:, 1] // PLAN_POOL]]
+        # The drone may already be closer to a wall than the clearance
+        near = np.zeros_like(passable)
+        near[begin] = True
+        passable |= dilate(near, clearance) & ~occupied
+        dist = wavefront(passable, begin)
+
+        clusters = cluster_cells(cells)
+        best = None
+        current = 0.0
+        for members in clusters:
+            if len(members) < MIN_CLUSTER:
+                continue
+            members = cells[members]
+            costs = dist[members[:, 0] // PLAN_POOL, members[:, 1] // PLAN_POOL]
+            reachable = np.isfinite(costs)
+            if not reachable.any():
+                continue
+            members, costs = members[reachable], costs[reachable]
+            centroid = members.mean(axis=0)
+            i = int(np.argmin(np.hypot(*(members - centroid).T)))
+            goal = (members[i] + origin + 0.5) * res
+            if any(np.hypot(*(goal - b)) < BLACKLIST_RADIUS for b in self._blacklist):
+                continue
+            utility = len(members) * res * math.exp(-COST_RATE * costs[i] * cell)
+            if self._goal is not None:
+                world = (members + origin + 0.5) * res
+                if np.hypot(*(world - self._goal).T).min() < BLACKLIST_RADIUS:
+                    current = max(current, utility)
+            if best is None or utility > best[0]:
+                best = (utility, goal, members[i] // PLAN_POOL)
+
+        self.plans += 1
+        self.clusters = len(clusters)
+        if best is not None and (self._goal is None or best[0] > HYSTERESIS * current):
+            utility, goal, target = best
+            path = np.array(descend(dist, tuple(target)), dtype=np.float64)
+            path = (path * PLAN_POOL + origin + PLAN_POOL / 2.0) * res
+            path[-1] = goal
+            if self._goal is None or np.hypot(*(goal - self._goal)) > GOAL_RADIUS:
+                self._goal_since = now
+            self._goal, self._utility = goal, utility
+            with self._lock:
+                self._path = path
+        elif best is None:
+            self._goal = None
+            with self._lock:
+                self._path = None
+        self.plan_time.add(time.perf_counter() - start)
+        return best is not None
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "goal": None if self._goal is None else self._goal.round(2).tolist(),
+            "clusters": self.clusters,
+            "plans": self.plans,
+            "goals_reached": self.goals_reached,
+            "goals_abandoned": self.goals_abandoned,
+            "plan_ms": self.plan_time.summary(1000.0),
+        }
@@ -0,0 +1,210 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import cflib.crtp
+
+from replay_link import is_simulated, open_link
+
+CACHE_DIR = "./cache"
+DECK_TIMEOUT = 5.0  # Seconds to wait for the deck parameters
+REQUIRED_DECKS = (("deck", "bcFlow2"),)  # Flowdeck V2
+
+
+def validate_cache(directory=CACHE_DIR):
+    """Check the TOC cache files and set aside the ones cflib cannot load
+
+    cflib only logs a warning for an unreadable cache file and then downloads
+    the whole TOC again on every connect, so broken files are renamed to
+    *.bad. Reading the files here also pre-warms the OS file cache.
+    """
+    os.makedirs(directory, exist_ok=True)
+    stats = {"files": 0, "valid": 0, "invalid": 0, "bytes": 0}
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        stats["files"] += 1
+        try:
+            with open(path) as f:
+                data = f.read()
+            stats["bytes"] += len(data)
+            toc = json.loads(data)
+            elements = [e for group in toc.values() for e in group.values()]
+            if not elements or not all("__class__" in e for e in elements):
+                raise ValueError("no TOC elements")
+            stats["valid"] += 1
+        except (OSError, ValueError, AttributeError) as e:
+            stats["invalid"] += 1
+            print(f"[WARNING] Ignoring broken TOC cache file {path}: {e}")
+            os.replace(path, path + ".bad")
+    return stats
+
+
+class FastConnect:
+    """Bring the link up with the independent startup steps overlapped
+
+    start() validates the TOC cache, initialises the drivers and opens the
+    link on a background thread, so the caller can build the GUI meanwhile.
+    ready() then runs the deck check and the caller's setup tasks (e.g. log
+    configs) concurrently. Every step is timed for report().
+    """
+
+    def __init__(
+        self,
+        uri,
+        rw_cache=CACHE_DIR,
+        decks=REQUIRED_DECKS,
+        deck_timeout=DECK_TIMEOUT,
+        prepare=True,
+    ):
+        self.uri = uri
+        self.prepare = prepare  # False when the caller already did cache + drivers
+        self.rw_cache = rw_cache
+        self.decks = decks
+        self.deck_timeout = deck_timeout
+        self.scf = None
+        self.cache_stats = {}
+        self.phases = {}  # name -> (start, end) in seconds since t0
+        self.t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._link_ready = threading.Event()
+        self._link_error = None
+        self._thread = None
+
+    @contextmanager
+    def phase(self, name):
+        """Time a startup step; steps may overlap"""
+        start = time.perf_counter() - self.t0
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = (start, time.perf_counter() - self.t0)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._open, name="fast-connect", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def _open(self):
+        try:
+            if self.prepare:
+                self.prepare_links([self.uri])
+            with self.phase("link"):
+                scf = open_link(self.uri, rw_cache=self.rw_cache)
+                scf.open_link()
+            self.scf = scf
+        except Exception as e:
+            self._link_error = e
+        finally:
+            self._link_ready.set()
+
+    def prepare_links(self, uris):
+        """Validate the TOC cache and initialise the drivers once for uris"""
+        if not all(is_simulated(uri) for uri in uris):
+            with self.phase("cache"):
+                self.cache_stats = validate_cache(self.rw_cache)
+            if not self.cache_stats["valid"]:
+                print(
+                    "[WARNING] TOC cache is empty; the first connect "
+                    "downloads the full TOC"
+                )
+        with self.phase("drivers"):
+            cflib.crtp.init_drivers()
+
+    def wait_link(self, timeout=None):
+        """Return the open SyncCrazyflie, raising if connecting failed"""
+        self.start()
+        if not self._link_ready.wait(timeout):
+            raise TimeoutError(f"Timed out connecting to {self.uri}")
+        if self._link_error is not None:
+            raise self._link_error
+        return self.scf
+
+    def ready(self, tasks=None):
+        """Run the deck check and tasks (name -> fn(scf)) concurrently
+
+        Returns True when every required deck is attached. Exceptions from
+        tasks are re-raised after all of them have finished.
+        """
+        scf = self.wait_link()
+        errors = []
+
+        def run(name, fn):
+            try:
+                with self.phase(name):
+                    fn(scf)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=run, args=(name, fn), name=f"startup-{name}")
+            for name, fn in (tasks or {}).items()
+        ]
+        for thread in threads:
+            thread.start()
+        with self.phase("decks"):
+            decks_ok = self._check_decks(scf)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return decks_ok
+
+    def _check_decks(self, scf):
+        param = scf.cf.param
+        pending = {f"{group}.{name}": threading.Event() for group, name in self.decks}
+        attached = {}
+
+        def deck_updated(complete_name, value_str):
+            attached[complete_name] = bool(int(value_str))
+            pending[complete_name].set()
+
+        for group, name in self.decks:
+            complete_name = f"{group}.{name}"
+            param.add_update_callback(group=group, name=name, cb=deck_updated)
+            # The values may already be in if the parameter download finished
+            if getattr(param, "is_updated", False):
+                deck_updated(complete_name, param.values[group][name])
+
+        deadline = time.monotonic() + self.deck_timeout
+        for complete_name, event in pending.items():
+            if not event.wait(max(0.0, deadline - time.monotonic())):
+                print(f"[ERROR] No value for {complete_name} (deck not detected)")
+                return False
+            if not attached[complete_name]:
+                print(f"[WARNING] {complete_name} is NOT attached!")
+                return False
+        print("[INFO] Decks attached: " + ", ".join(pending))
+        return True
+
+    def close(self):
+        if self._thread is not None:
+            self._link_ready.wait()
+        if self.scf is not None:
+            self.scf.close_link()
+            self.scf = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def time_to_ready(self):
+        return max((end for _, end in self.phases.values()), default=0.0)
+
+    def report(self):
+        """Print when each startup step ran and the total time to ready"""
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda item: item[1][0])
+        serial = sum(end - start for _, (start, end) in phases)
+        total = self.time_to_ready()
+        print(f"[INFO] Ready in {total:.2f} s (steps add up to {serial:.2f} s)")
+        for name, (start, end) in phases:
+            print(f"  {name:<10} {start:6.2f} -> {end:6.2f} s  ({end - start:.2f} s)")
+        return {name: end - start for name, (start, end) in phases}
@@ -0,0 +1,248 @@
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+# File layout: fixed-size header followed by packed fixed-width records.
+# Header: magic (8s) | version (u4) | header size (u4) | record count (u8) |
+#         schema length (u4) | JSON schema, zero padded to HEADER_SIZE.
+MAGIC = b"CFREC\x00\x00\x01"
+VERSION = 1
+HEADER_SIZE = 4096
+_HEADER_FMT = "<8sIIQI"
+_COUNT_OFFSET = struct.calcsize("<8sII")
+
+RECORD_DIR = "./flights"
+FILE_SUFFIX = ".cfrec"
+
+# Crazyflie log types -> little-endian NumPy types (FP16 arrives decoded)
+LOG_TYPES = {
+    "uint8_t": "<u1",
+    "uint16_t": "<u2",
+    "uint32_t": "<u4",
+    "int8_t": "<i1",
+    "int16_t": "<i2",
+    "int32_t": "<i4",
+    "float": "<f4",
+    "FP16": "<f4",
+}
+
+
+def record_dtype(variables):
+    """Packed structured dtype for [(name, log type), ...] plus timestamp"""
+    fields = [("timestamp", "<u4")]
+    fields += [(name, LOG_TYPES[ctype]) for name, ctype in variables]
+    return np.dtype(fields)
+
+
+def logconf_variables(logconf):
+    """Return [(name, log type), ...] for a LogConfig added to a Crazyflie"""
+    return [(v.name, v.fetch_as_string) for v in logconf.variables]
+
+
+class LogStreamWriter:
+    """Append-only, memory-mapped writer for one LogConfig stream
+
+    Samples are copied into a preallocated staging batch; full batches are
+    copied into the mapped file in one slice assignment and the record
+    count in the header is updated. The file grows in chunks.
+    """
+
+    def __init__(
+        self,
+        path,
+        name,
+        variables,
+        period_in_ms=None,
+        batch_size=128,
+        chunk_records=1 << 16,
+    ):
+        self.path = path
+        self.name = name
+        self.names = [n for n, _ in variables]
+        self.dtype = record_dtype(variables)
+        self.batch_size = batch_size
+        self.chunk_records = chunk_records
+        self.count = 0
+
+        schema = {
+            "name": name,
+            "period_in_ms": period_in_ms,
+            "created": time.time(),
+            "fields": [[n, t] for n, t in variables],
+            "dtype": self.dtype.descr,
+        }
+        schema_bytes = json.dumps(schema).encode()
+        if struct.calcsize(_HEADER_FMT) + len(schema_bytes) > HEADER_SIZE:
+            raise ValueError(f"Schema for '{name}' does not fit in the header")
+
+        self._file = open(path, "w+b")
+        self._file.write(
+            struct.pack(_HEADER_FMT, MAGIC, VERSION, HEADER_SIZE, 0, len(schema_bytes))
+        )
+        self._file.write(schema_bytes)
+        self._capacity = 0
+        self._mm = None
+        self._records = None
+        self._grow(chunk_records)
+
+        # Staging batch and per-field column views, allocated once
+        self._batch = np.zeros(batch_size, dtype=self.dtype)
+        self._timestamps = self._batch["timestamp"]
+        self._columns = [(n, self._batch[n]) for n in self.names]
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def callback(self, timestamp, data, logconf):
+        """LogConfig.data_received_cb compatible entry point"""
+        self.write(timestamp, data)
+
+    def write(self, timestamp, data):
+        with self._lock:
+            if self._closed:
+                return
+            i = self._pending
+            self._timestamps[i] = timestamp
+            for name, column in self._columns:
+                column[i] = data.get(name, 0)
+            self._pending = i + 1
+            if self._pending == self.batch_size:
+                self._flush_batch()
+
+    def flush(self):
+        with self._lock:
+            if not self._closed:
+                self._flush_batch()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._flush_batch()
+            self._closed = True
+            self._release()
+            self._file.truncate(HEADER_SIZE + self.count * self.dtype.itemsize)
+            self._file.close()
+
+    def _flush_batch(self):
+        n = self._pending
+        if n == 0:
+            return
+        if self.count + n > self._capacity:
+            self._grow(self._capacity + self.chunk_records)
+        self._records[self.count : self.count + n] = self._batch[:n]
+        self.count += n
+        self._pending = 0
+        struct.pack_into("<Q", self._mm, _COUNT_OFFSET, self.count)
+
+    def _grow(self, capacity):
+        self._release()
+        self._file.truncate(HEADER_SIZE + capacity * self.dtype.itemsize)
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        self._records = np.ndarray(
+            (capacity,), dtype=self.dtype, buffer=self._mm, offset=HEADER_SIZE
+        )
+        self._capacity = capacity
+
+    def _release(self):
+        if self._mm is None:
+            return
+        self._records = None  # Drop the exported buffer before closing
+        self._mm.flush()
+        self._mm.close()
+        self._mm = None
+
+
+class FlightRecorder:
+    """Record every subscribed LogConfig into one session directory"""
+
+    def __init__(self, directory=RECORD_DIR, batch_size=128):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.directory = os.path.join(directory, f"flight-{stamp}")
+        os.makedirs(self.directory, exist_ok=True)
+        self.batch_size = batch_size
+        self.streams = {}
+
+    def subscribe(self, logconf):
+        """Start recording a LogConfig (call after cf.log.add_config)"""
+        filename = re.sub(r"[^A-Za-z0-9_.-]+", "_", logconf.name) + FILE_SUFFIX
+        stream = LogStreamWriter(
+            os.path.join(self.directory, filename),
+            logconf.name,
+            logconf_variables(logconf),
+            period_in_ms=logconf.period_in_ms,
+            batch_size=self.batch_size,
+        )
+        self.streams[logconf.name] = stream
+        logconf.data_received_cb.add_callback(stream.callback)
+        return stream
+
+    def flush(self):
+        for stream in self.streams.values():
+            stream.flush()
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.close()
+        total = sum(stream.count for stream in self.streams.values())
+        print(f"[INFO] Recorded {total} samples to {self.directory}")
+
+
+def read_header(path):
+    """Return (schema dict, record count) for a recording file"""
+    with open(path, "rb") as f:
+        raw = f.read(HEADER_SIZE)
+    magic, version, header_size, count, schema_len = struct.unpack_from(
+        _HEADER_FMT, raw
+    )
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a flight recording")
+    if version != VERSION or header_size != HEADER_SIZE:
+        raise ValueError(f"Unsupported recording version {version} in {path}")
+    start = struct.calcsize(_HEADER_FMT)
+    schema = json.loads(raw[start : start + schema_len])
+    return schema, count
+
+
+def load_recording(path):
+    """Map a recording as a read-only structured array (zero-copy)
+
+    Returns (schema, records) where records has a 'timestamp' field plus one
+    field per logged variable.
+    """
+    schema, count = read_header(path)
+    dtype = record_dtype([tuple(f) for f in schema["fields"]])
+    if count == 0:
+        return schema, np.zeros(0, dtype=dtype)
+    records = np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+    return schema, records
+
+
+def load_session(directory):
+    """Load every recording in a session directory, keyed by LogConfig name"""
+    streams = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(FILE_SUFFIX):
+            schema, records = load_recording(os.path.join(directory, filename))
+            streams[schema["name"]] = records
+    return streams
+
+
+if __name__ == "__main__":
+    # Summarize a recorded session: python flight_recorder.py flights/flight-...
+    for name, records in load_session(sys.argv[1]).items():
+        if len(records):
+            duration = (
+                int(records["timestamp"][-1]) - int(records["timestamp"][0])
+            ) / 1000
+        else:
+            duration = 0.0
+        print(f"{name}: {len(records)} samples over {duration:.1f} s")
+        print(f"  fields: {', '.join(records.dtype.names[1:])}")
@@ -0,0 +1,222 @@
+# YOLO detector behind one interface, running through PyTorch, ONNX Runtime or
+# OpenVINO on the CPU. Exported models are cached under yolo_models/exports so
+# the (slow) export only happens once per backend / image size / precision.
+#   python inference_backend.py                                  benchmark all
+#   python inference_backend.py --backends torch openvino --imgsz 256 320 --int8
+#   python inference_backend.py --images my_frames/ --data coco8.yaml
+import argparse
+import glob
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from perf_stats import RollingStats
+
+MODEL_PATH = "yolo_models/yolo11n.pt"
+EXPORT_DIR = "yolo_models/exports"
+BACKENDS = ("torch", "onnx", "openvino")
+DEFAULT_IMGSZ = 320
+RESULTS_DIR = "./bench_results"
+BENCH_DATA = "coco8.yaml"  # Ultralytics sample set, downloaded on first use
+
+
+class DetectorBackend:
+    """YOLO detector running through the selected CPU backend
+
+    Calling the detector returns the ultralytics Results of one image, so
+    callers can keep using result.plot() whatever the backend.
+    """
+
+    def __init__(
+        self,
+        backend="torch",
+        imgsz=DEFAULT_IMGSZ,
+        int8=False,
+        model_path=MODEL_PATH,
+        export_dir=EXPORT_DIR,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+        self.backend = backend
+        self.imgsz = imgsz
+        self.int8 = int8 and backend != "torch"
+        self.model_path = model_path
+        self.export_dir = export_dir
+        self.model = None
+
+    @property
+    def name(self):
+        return f"{self.backend}-{self.imgsz}" + ("-int8" if self.int8 else "")
+
+    def load(self):
+        """Export (if not cached) and load the model; returns self"""
+        from ultralytics import YOLO  # Deferred: importing torch takes seconds
+
+        self.model = YOLO(self.artifact(), task="detect")
+        return self
+
+    def __call__(self, image):
+        return self.model(image, imgsz=self.imgsz, device="cpu", verbose=False)[0]
+
+    def warmup(self, runs=2, shape=(480, 640, 3)):
+        """Run dummy frames through the model to take the first-call cost now"""
+        dummy = np.zeros(shape, dtype=np.uint8)
+        for _ in range(runs):
+            self(dummy)
+
+    def artifact(self):
+        """Path of the model file for this backend, exporting it if needed"""
+        if self.backend == "torch":
+            return self.model_path
+        stem = os.path.splitext(os.path.basename(self.model_path))[0]
+        suffix = ".onnx" if self.backend == "onnx" else "_openvino_model"
+        path = os.path.join(self.export_dir, f"{stem}-{self.name}{suffix}")
+        if self._cached(path):
+            return path
+
+        print(f"[INFO] Exporting {self.model_path} for {self.name} (cached after this)")
+        start = time.perf_counter()
+        os.makedirs(self.export_dir, exist_ok=True)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        if self.backend == "onnx":
+            exported = self._export(format="onnx", simplify=True)
+            if self.int8:
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+
+                quantize_dynamic(exported, path, weight_type=QuantType.QUInt8)
+                os.remove(exported)
+            else:
+                shutil.move(exported, path)
+        else:
+            shutil.move(self._export(format="openvino", int8=self.int8), path)
+        with open(path + ".json", "w") as f:
+            json.dump(self._source_signature(), f)
+        print(f"[INFO] Export done in {time.perf_counter() - start:.1f} s: {path}")
+        return path
+
+    def _export(self, **kwargs):
+        from ultralytics import YOLO
+
+        return YOLO(self.model_path).export(imgsz=self.imgsz, device="cpu", **kwargs)
+
+    def _source_signature(self):
+        stat = os.stat(self.model_path)
+        return {"source": self.model_path, "size": stat.st_size, "mtime": stat.st_mtime}
+
+    def _cached(self, path):
+        """True when path exists and was exported from the current weights"""
+        try:
+            with open(path + ".json") as f:
+                return os.path.exists(path) and json.load(f) == self._source_signature()
+        except (OSError, ValueError):
+            return False
+
+
+def load_images(directory):
+    """Benchmark frames from a directory (BGR, like the camera), or a synthetic one"""
+    import cv2
+
+    images = []
+    for pattern in ("*.jpg", "*.jpeg", "*.png"):
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            image = cv2.imread(path)
+            if image is not None:
+                images.append(cv2.resize(image, (640, 480)))
+    if not images:
+        print(f"[WARNING] No images in {directory}, using a synthetic frame")
+        rng = np.random.default_rng(0)
+        images.append(rng.integers(0, 255, (480, 640, 3), dtype=np.uint8))
+    return images
+
+
+def benchmark(detector, images, runs=50, data=None):
+    """Latency, throughput and (with data) mAP of one loaded detector"""
+    detector.warmup()
+    latency = RollingStats(capacity=runs)
+    start = time.perf_counter()
+    for i in range(runs):
+        t0 = time.perf_counter()
+        detector(images[i % len(images)])
+        latency.add(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "backend": detector.backend,
+        "imgsz": detector.imgsz,
+        "int8": detector.int8,
+        "latency_ms": latency.summary(1000.0),
+        "throughput_fps": runs / elapsed,
+    }
+    if data:
+        metrics = detector.model.val(
+            data=data,
+            imgsz=detector.imgsz,
+            batch=1,
+            device="cpu",
+            plots=False,
+            verbose=False,
+        )
+        result["map50"] = float(metrics.box.map50)
+        result["map50_95"] = float(metrics.box.map)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU inference backend benchmark")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS))
+    parser.add_argument("--imgsz", type=int, nargs="+", default=[256, 320])
+    parser.add_argument("--int8", action="store_true", help="Also try int8 models")
+    parser.add_argument("--images", default="yolo_models/bench_images")
+    parser.add_argument(
+        "--data", default=BENCH_DATA, help="Dataset yaml for mAP ('' to skip)"
+    )
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--output", default=None, help="JSON output path")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    results = []
+    for backend in args.backends:
+        for imgsz in args.imgsz:
+            for int8 in (False, True) if args.int8 and backend != "torch" else (False,):
+                detector = DetectorBackend(backend, imgsz, int8)
+                print(f"[INFO] Benchmarking {detector.name}...")
+                try:
+                    results.append(
+                        benchmark(detector.load(), images, args.runs, args.data)
+                    )
+                except Exception as e:
+                    print(f"[ERROR] {detector.name} failed: {e}")
+
+    print(f"\n  {'backend':<22}{'p50 ms':>9}{'p99 ms':>9}{'fps':>8}{'mAP50':>8}")
+    for r in results:
+        name = f"{r['backend']}-{r['imgsz']}" + ("-int8" if r["int8"] else "")
+        map50 = f"{r['map50']:.3f}" if "map50" in r else "-"
+        print(
+            f"  {name:<22}{r['latency_ms']['p50']:9.1f}{r['latency_ms']['p99']:9.1f}"
+            f"{r['throughput_fps']:8.1f}{map50:>8}"
+        )
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(
+            RESULTS_DIR, f"inference-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        )
+    with open(output, "w") as f:
+        json.dump(
+            {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results},
+            f,
+            indent=2,
+        )
+    print(f"[INFO] Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from perf_stats import RollingStats
+
+PANEL_INTERVAL = 1.0  # Seconds between GUI panel refreshes
+
+
+class Instrumentation:
+    """Lightweight counters, timers and gauges for the ground station
+
+    Counters are turned into rates between snapshots, timers keep rolling
+    p50/p99 and providers are callables whose dicts are merged into each
+    snapshot (e.g. scheduler or map statistics).
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.gauges = {}
+        self.providers = {}
+        self._lock = threading.Lock()
+        self._last_counts = {}
+        self._last_snapshot = time.monotonic()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            with self._lock:
+                timer = self.timers.setdefault(name, RollingStats(capacity=1024))
+        timer.add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name, fn):
+        """Wrap fn so every call is counted and timed under name"""
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+                self.count(name)
+
+        return wrapper
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def add_provider(self, name, fn):
+        self.providers[name] = fn
+
+    def snapshot(self):
+        """Return all metrics as a plain dict (for the GUI or headless runs)"""
+        now = time.monotonic()
+        with self._lock:
+            counters = dict(self.counters)
+            elapsed = max(now - self._last_snapshot, 1e-9)
+            rates = {
+                name: (value - self._last_counts.get(name, 0)) / elapsed
+                for name, value in counters.items()
+            }
+            self._last_counts = counters
+            self._last_snapshot = now
+            timers = dict(self.timers)
+
+        snapshot = {
+            "counters": counters,
+            "rates_hz": rates,
+            "timers_ms": {name: t.summary(1000.0) for name, t in timers.items()},
+            "gauges": dict(self.gauges),
+        }
+        for name, fn in list(self.providers.items()):
+            try:
+                snapshot[name] = fn()
+            except Exception as e:
+                snapshot[name] = {"error": str(e)}
+        return snapshot
+
+
+class PerfPanel:
+    """Viser GUI folder showing an Instrumentation snapshot about once a second
+
+    expected_rates maps counter names to their configured rate in Hz so the
+    panel can show received vs expected log packets.
+    """
+
+    def __init__(self, server, perf, expected_rates=None, interval=PANEL_INTERVAL):
+        self.perf = perf
+        self.expected_rates = expected_rates if expected_rates is not None else {}
+        self.interval = interval
+        self.last_snapshot = {}
+        with server.gui.add_folder("Performance", order=100, expand_by_default=False):
+            self.text = server.gui.add_markdown("_Waiting for data..._")
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="perf-panel", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.last_snapshot = self.perf.snapshot()
+            self.text.content = self.format(self.last_snapshot)
+
+    def format(self, snapshot):
+        lines = ["| Metric | Value |", "| --- | --- |"]
+        for name, expected in self.expected_rates.items():
+            rate = snapshot["rates_hz"].get(name, 0.0)
+            lines.append(f"| {name} | {rate:.0f} / {expected:.0f} Hz |")
+        for name, value in snapshot["gauges"].items():
+            lines.append(f"| {name} | {_format_value(value)} |")
+        for name, t in snapshot["timers_ms"].items():
+            lines.append(f"| {name} p50/p99 | {t['p50']:.2f} / {t['p99']:.2f} ms |")
+        for provider in self.perf.providers:
+            for key, value in snapshot.get(provider, {}).items():
+                if not isinstance(value, dict):
+                    lines.append(f"| {provider}.{key} | {_format_value(value)} |")
+        return "\n".join(lines)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
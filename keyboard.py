@@ -5,20 +5,22 @@ import threading
 import time
 from threading import Event
 
-import cflib
-import cflib.crtp
-from cflib.crazyflie import Crazyflie
 from cflib.crazyflie.log import LogConfig
-from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
-from cflib.positioning.motion_commander import MotionCommander
+from cflib.utils import uri_helper
 from pynput import keyboard
 
+from fast_connect import FastConnect
+from flight_recorder import RECORD_DIR, FlightRecorder
+from perf_stats import Histogram
+from replay_link import make_motion_commander
+
 # Configure logging to show only errors
 logging.basicConfig(level=logging.ERROR)
 
 # Connection URI and flight control constants
 # Uniform Resource Identifier, InterfaceType://InterfaceId/InterfaceChannel/InterfaceSpeed Change to match your Crazyflies URI
-URI = "radio://0/80/2M/E7E7E7E7E7"
+# Set CFLIB_URI to replay://<flight dir>?speed=N or sim:// to fly without hardware
+URI = uri_helper.uri_from_env(default="radio://0/80/2M/E7E7E7E7E7")
 DEFAULT_HEIGHT = 0.5        # Sets the default height for takeoff range: 0.2 <= X <= 3.0 meters, limited by the ranged of optical sensor on flowdeck V2. Flight above 3m will be unstable
 BASE_SPEED = 0.35           # Sets the base speed of the drone in m/s range: 0 <= X <= 1 m/s by default you can change this limit with the parameter posCtlPid.xyVelMax in cfclient. Max speed ~3m/s, depending on whats attached to your crazyflie.
 SPEED_STEP = 0.05           # Changes the crazyflies speed by 0.05 m/s. As long as the cf wont be past max or min BASE_SPEED once executed this number can be anything.
@@ -27,6 +29,7 @@ RUNNING = True              # Helps in the launch process
 motors_on = False           # Helps in the launch process
 speed = BASE_SPEED          # Sets the speed to the Base speed by default
 turn_speed = 500            # Sets the turn speed to 90 deg/s range: 0 <= X <= 500. As you approach 500 deg/sec, the cf becomes more and more unstable. 480 deg/sec is max for sustained yaw rotation.
+KEEPALIVE_INTERVAL = 0.1    # Re-sends the unchanged setpoint every 0.1 s, well inside the firmware's 500 ms setpoint watchdog.
 
 # Adjust speed and yaw rate
 def adjust_speed(increase=True):
@@ -39,9 +42,6 @@ def adjust_speed(increase=True):
         turn_speed = max(5, turn_speed - TURN_STEP)
     print(f"[INFO] Speed adjusted: {speed:.2f}, Turn step: {turn_speed}")
 
-# Track Flowdeck presence
-deck_attached_event = Event()
-
 # Keyboard state
 key_states = {
     "w": False, "s": False, "a": False, "d": False,
@@ -50,8 +50,17 @@ key_states = {
 }
 
 mc_instance = None
+recorder = None
 vx, vy, vz, yaw_rate = 0.0, 0.0, 0.0, 0.0
 
+# Input change notification for the control loop
+input_event = Event()
+input_time = 0.0            # time.monotonic() of the latest input change
+
+# Loop timing statistics (milliseconds)
+loop_period_hist = Histogram(low=1.0, high=1000.0, bins=30)
+key_latency_hist = Histogram(low=0.01, high=100.0, bins=30)
+
 def print_controls():
     print("\n[INFO] Crazyflie Drone Controls:")
     print("  W / S - Move Forward / Backward")
@@ -62,28 +71,73 @@ def print_controls():
     print("  `      - Toggle Motors ON/OFF (Takeoff/Land)")
     print("  ESC    - Emergency Stop\n")
 
-def param_deck_flow(_, value_str):
-    if int(value_str):
-        deck_attached_event.set()
-        print('[INFO] Flowdeck is attached.')
-    else:
-        print('[WARNING] Flowdeck is NOT attached!')
+def setup_recording(scf):
+    # Records the state estimate to ./flights instead of discarding it
+    global recorder
+    recorder = FlightRecorder(RECORD_DIR)
+    lg_state = LogConfig(name="State Estimate", period_in_ms=10)
+    for name in ("stateEstimate.x", "stateEstimate.y", "stateEstimate.z",
+                 "stabilizer.roll", "stabilizer.pitch", "stabilizer.yaw"):
+        lg_state.add_variable(name, "float")
+    scf.cf.log.add_config(lg_state)
+    recorder.subscribe(lg_state)
+    lg_state.start()
+
+def notify_input():
+    # Wakes the control loop so a key change is sent right away
+    global input_time
+    input_time = time.monotonic()
+    input_event.set()
+
+def current_setpoint():
+    vx = speed if key_states["w"] else -speed if key_states["s"] else 0.0
+    vy = speed if key_states["a"] else -speed if key_states["d"] else 0.0
+    vz = speed if key_states["space"] else -speed if key_states["ctrl"] else 0.0
+    yaw_rate = turn_speed if key_states["right"] else -turn_speed if key_states["left"] else 0.0
+    return vx, vy, vz, yaw_rate
 
 def control_loop():
-    global RUNNING, motors_on, speed, turn_speed, mc_instance, vx, vy, vz, yaw_rate
+    # Sends immediately when the keys change, otherwise only a keep-alive on absolute monotonic deadlines
+    global vx, vy, vz, yaw_rate
+    last_sent = None
+    next_keepalive = time.monotonic()
+    last_keepalive = None
     while RUNNING:
+        now = time.monotonic()
         if motors_on and mc_instance:
-            try:
-                vx = speed if key_states["w"] else -speed if key_states["s"] else 0.0
-                vy = speed if key_states["a"] else -speed if key_states["d"] else 0.0
-                vz = speed if key_states["space"] else -speed if key_states["ctrl"] else 0.0
-                yaw_rate = turn_speed if key_states["right"] else -turn_speed if key_states["left"] else 0.0
-
-                mc_instance._set_vel_setpoint(vx, vy, vz, yaw_rate)
-
-            except Exception as e:
-                print(f"[ERROR] Motion error: {e}")
-        time.sleep(0.01)
+            setpoint = current_setpoint()
+            changed = setpoint != last_sent
+            if changed or now >= next_keepalive:
+                try:
+                    mc_instance._set_vel_setpoint(*setpoint)
+                    vx, vy, vz, yaw_rate = setpoint
+                    if changed and input_time:
+                        key_latency_hist.add((time.monotonic() - input_time) * 1000.0)
+                    elif last_keepalive is not None:
+                        loop_period_hist.add((now - last_keepalive) * 1000.0)
+                    if not changed:
+                        last_keepalive = now
+                    last_sent = setpoint
+                except Exception as e:
+                    print(f"[ERROR] Motion error: {e}")
+                next_keepalive += KEEPALIVE_INTERVAL
+                if next_keepalive <= now:
+                    next_keepalive = now + KEEPALIVE_INTERVAL
+        else:
+            last_sent = None
+            last_keepalive = None
+            next_keepalive = now + KEEPALIVE_INTERVAL
+
+        input_event.wait(max(0.0, next_keepalive - time.monotonic()))
+        input_event.clear()
+
+def print_loop_stats():
+    for title, hist in (("Keep-alive period", loop_period_hist), ("Key-to-radio latency", key_latency_hist)):
+        stats = hist.summary()
+        if stats["count"]:
+            print(f"[INFO] {title}: n={stats['count']}, p50 {stats['p50']:.2f} ms, "
+                  f"p99 {stats['p99']:.2f} ms, max {stats['max']:.2f} ms")
+            print(hist.format())
 
 def safe_stop():
     global RUNNING, motors_on
@@ -129,6 +183,7 @@ def on_press(key):
                 adjust_speed(True)
             elif lowered == '-':
                 adjust_speed(False)
+        notify_input()
     except Exception as e:
         print(f"[ERROR] on_press: {e}")
 
@@ -146,24 +201,28 @@ def on_release(key):
             lowered = key.char.lower()
             if lowered in key_states:
                 key_states[lowered] = False
+        notify_input()
     except Exception as e:
         print(f"[ERROR] on_release: {e}")
 
 
 def main():
     global RUNNING, mc_instance
+    startup = FastConnect(URI).start()     # Connects while the controls are printed
     print_controls()
-    cflib.crtp.init_drivers()
 
-    with SyncCrazyflie(URI, cf=Crazyflie(rw_cache="./cache")) as scf:
-        scf.cf.param.add_update_callback(group="deck", name="bcFlow2", cb=param_deck_flow)
-        print("[INFO] Waiting for Flowdeck...")
-        if not deck_attached_event.wait(timeout=5):
+    with startup:
+        scf = startup.wait_link()
+        # Recording starts while the deck parameters come in
+        if not startup.ready({"recording": setup_recording}):
             print("[ERROR] No Flowdeck detected!")
+            if recorder:
+                recorder.close()
             return
 
-        mc_instance = MotionCommander(scf, default_height=DEFAULT_HEIGHT)
+        mc_instance = make_motion_commander(scf, default_height=DEFAULT_HEIGHT)
         print("[INFO] Connected to Crazyflie!")
+        startup.report()
 
         listener = keyboard.Listener(on_press=on_press, on_release=on_release)
         listener.start()
@@ -178,6 +237,8 @@ def main():
         except Exception as e:
             print(f"[ERROR] During shutdown landing: {e}")
 
+        recorder.close()
+        print_loop_stats()
         print("\n[INFO] Flight Ended. Shutdown complete.")
 
 if __name__ == "__main__":
@@ -0,0 +1,215 @@
+import math
+import threading
+
+from cflib.crazyflie.log import LogConfig
+
+MAX_BLOCK_BYTES = 26  # Log data bytes that fit in one CRTP log packet
+MIN_PERIOD_MS = 10  # Log periods are set in 10 ms units
+
+TYPE_SIZES = {
+    "uint8_t": 1,
+    "int8_t": 1,
+    "uint16_t": 2,
+    "int16_t": 2,
+    "FP16": 2,
+    "uint32_t": 4,
+    "int32_t": 4,
+    "float": 4,
+}
+
+# Compressed firmware variables (stateEstimateZ.* are int16 in milli-units)
+COMPRESSED = {}
+for _axis in ("x", "y", "z"):
+    COMPRESSED[f"stateEstimate.{_axis}"] = (f"stateEstimateZ.{_axis}", 0.001)
+    COMPRESSED[f"stateEstimate.v{_axis}"] = (f"stateEstimateZ.v{_axis}", 0.001)
+    COMPRESSED[f"stateEstimate.a{_axis}"] = (f"stateEstimateZ.a{_axis}", 0.001)
+
+
+class VariableRequest:
+    """A variable the application wants, with its rate and accuracy needs
+
+    precision is the largest acceptable quantization step in the variable's
+    own units; max_abs bounds its magnitude (used to decide if FP16 fits).
+    """
+
+    def __init__(self, name, rate_hz, precision=None, max_abs=None, ctype="float"):
+        self.name = name
+        self.rate_hz = rate_hz
+        self.precision = precision
+        self.max_abs = max_abs
+        self.ctype = ctype
+
+
+class Encoding:
+    """How one requested variable is fetched: log name, type and scale"""
+
+    def __init__(self, name, log_name, ctype, scale=1.0):
+        self.name = name
+        self.log_name = log_name
+        self.ctype = ctype
+        self.scale = scale
+        self.size = TYPE_SIZES[ctype]
+
+
+class LogBlock:
+    """One planned LogConfig: a period and the encodings packed into it"""
+
+    def __init__(self, name, period_in_ms):
+        self.name = name
+        self.period_in_ms = period_in_ms
+        self.encodings = []
+        self.logconf = None
+
+    @property
+    def size(self):
+        return sum(e.size for e in self.encodings)
+
+    def create_logconf(self):
+        self.logconf = LogConfig(name=self.name, period_in_ms=self.period_in_ms)
+        for e in self.encodings:
+            self.logconf.add_variable(e.log_name, e.ctype)
+        return self.logconf
+
+
+def fp16_step(max_abs):
+    """Quantization step of an IEEE half float at magnitude max_abs"""
+    if max_abs <= 0:
+        return 0.0
+    return 2.0 ** (math.floor(math.log2(max_abs)) - 10)
+
+
+def choose_encoding(request):
+    """Pick the smallest encoding that meets the request's precision"""
+    native = Encoding(request.name, request.name, request.ctype)
+    if request.precision is None or request.ctype != "float":
+        return native
+
+    candidates = []
+    if request.name in COMPRESSED:
+        log_name, scale = COMPRESSED[request.name]
+        # int16 milli-units: 1e-3 resolution, +-32.767 range
+        if scale <= request.precision and (request.max_abs or 0) <= 32767 * scale:
+            candidates.append(Encoding(request.name, log_name, "int16_t", scale))
+    if request.max_abs is not None and request.max_abs < 65504:
+        if fp16_step(request.max_abs) <= request.precision:
+            candidates.append(Encoding(request.name, request.name, "FP16"))
+    candidates.append(native)
+    return min(candidates, key=lambda e: e.size)
+
+
+def period_for_rate(rate_hz):
+    period = int(round(1000.0 / rate_hz / MIN_PERIOD_MS)) * MIN_PERIOD_MS
+    return max(MIN_PERIOD_MS, period)
+
+
+class LogPlan:
+    """Pack variable requests into the fewest LogConfig blocks
+
+    Requests are grouped by log period and packed first-fit decreasing into
+    blocks of at most MAX_BLOCK_BYTES.
+    """
+
+    def __init__(self, requests, name="Plan"):
+        self.requests = list(requests)
+        self.blocks = []
+        groups = {}
+        for request in self.requests:
+            period = period_for_rate(request.rate_hz)
+            groups.setdefault(period, []).append(choose_encoding(request))
+
+        for period in sorted(groups):
+            blocks = []
+            for encoding in sorted(groups[period], key=lambda e: -e.size):
+                block = next(
+                    (b for b in blocks if b.size + encoding.size <= MAX_BLOCK_BYTES),
+                    None,
+                )
+                if block is None:
+                    block = LogBlock(f"{name} {period}ms #{len(blocks) + 1}", period)
+                    blocks.append(block)
+                block.encodings.append(encoding)
+            self.blocks.extend(blocks)
+
+    @property
+    def bytes_per_second(self):
+        return sum(b.size * 1000.0 / b.period_in_ms for b in self.blocks)
+
+    def create_logconfs(self):
+        return [block.create_logconf() for block in self.blocks]
+
+    def describe(self):
+        lines = [f"[INFO] Log plan: {len(self.blocks)} block(s)"]
+        for block in self.blocks:
+            names = ", ".join(f"{e.log_name}:{e.ctype}" for e in block.encodings)
+            lines.append(
+                f"  {block.name}: {block.size}/{MAX_BLOCK_BYTES} bytes "
+                f"every {block.period_in_ms} ms ({names})"
+            )
+        return "\n".join(lines)
+
+
+class StreamMerger:
+    """Merge the planned blocks back into one timestamp-aligned record
+
+    Values are decoded to the requested names and units. A record is emitted
+    once every block of the fastest period has reported for the same tick;
+    slower variables hold their latest value.
+    """
+
+    def __init__(self, plan, callback):
+        self.plan = plan
+        self.callback = callback
+        self._latest = {}
+        self._lock = threading.Lock()
+
+        self._fast_period = min(b.period_in_ms for b in plan.blocks)
+        self._fast_blocks = {
+            b.name for b in plan.blocks if b.period_in_ms == self._fast_period
+        }
+        self._tick = None
+        self._seen = set()
+
+        self.merged = 0
+        self.incomplete = 0
+
+    def attach(self):
+        """Register on the LogConfigs created by plan.create_logconfs()"""
+        for block in self.plan.blocks:
+            block.logconf.data_received_cb.add_callback(self._make_callback(block))
+
+    def _make_callback(self, block):
+        def callback(timestamp, data, logconf):
+            self._on_block(block, timestamp, data)
+
+        return callback
+
+    def _on_block(self, block, timestamp, data):
+        records = []
+        with self._lock:
+            for e in block.encodings:
+                value = data.get(e.log_name)
+                if value is not None:
+                    self._latest[e.name] = value * e.scale if e.scale != 1.0 else value
+            if block.name not in self._fast_blocks:
+                return
+
+            # Blocks of the same tick arrive within half a period of each other
+            if (
+                self._tick is None
+                or abs(timestamp - self._tick) > self._fast_period / 2
+            ):
+                if self._seen:
+                    # A packet of the previous tick was lost; emit what we have
+                    self.incomplete += 1
+                    records.append((self._tick, dict(self._latest)))
+                self._tick = timestamp
+                self._seen = set()
+            self._seen.add(block.name)
+            if self._seen == self._fast_blocks:
+                records.append((self._tick, dict(self._latest)))
+                self._tick = None
+                self._seen = set()
+            self.merged += len(records)
+
+        for tick, record in records:
+            self.callback(tick, record, None)
@@ -0,0 +1,602 @@
+# Tiled on-disk map storage. A map directory holds index.json plus one
+# compressed .npz per fixed-size spatial tile (points and occupancy blocks).
+# Tiles are written in the background while flying, loaded lazily and
+# dropped again when far away, so a map can be resumed or browsed with
+# bounded memory:
+#   python map_tiles.py maps/map-20250101-120000      viewer-only mode
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import viser
+
+from mapping import MAX_RANGE, VOXEL_SIZE, height_colors, unpack_voxel_keys
+from occupancy import BLOCK_SIZE, RESOLUTION
+
+MAP_DIR = "./maps"
+INDEX_FILE = "index.json"
+TILE_DIR = "tiles"
+FORMAT_VERSION = 1
+TILE_BLOCKS = 4  # Occupancy blocks per tile edge (1.6 m tiles by default)
+SAVE_INTERVAL = 5.0  # Seconds between background saves
+LOAD_MARGIN = 1.0  # Metres beyond sensor range to load saved tiles
+CACHE_TILES = 256  # Decoded tiles kept in memory by TileCache
+LIVE_TILES = 512  # Saved tiles kept merged in the live map before evicting
+EVICT_FRACTION = 0.25  # Share of LIVE_TILES freed per eviction
+VIEW_RADIUS = 8.0  # Metres around the viewer's camera target
+VIEW_INTERVAL = 0.5  # Seconds between viewer tile updates
+VIEW_POINT_SIZE = 0.03
+
+
+def tile_name(tile):
+    return "_".join(str(int(i)) for i in tile)
+
+
+def parse_tile_name(name):
+    return tuple(int(i) for i in name.split("_"))
+
+
+def write_tile(path, points, blocks):
+    """Write points (N, 3) and occupancy blocks {key: array} atomically"""
+    keys = np.fromiter(blocks.keys(), dtype=np.int64, count=len(blocks))
+    values = (
+        np.stack(list(blocks.values()))
+        if blocks
+        else np.zeros((0, BLOCK_SIZE**3), dtype=np.float32)
+    )
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(
+            f,
+            points=np.asarray(points, dtype=np.float32).reshape(-1, 3),
+            block_keys=keys,
+            blocks=values.astype(np.float32),
+        )
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+
+def read_tile(path):
+    """Return (points (N, 3), {block key: array}) of a tile file"""
+    with np.load(path) as data:
+        points = data["points"]
+        blocks = dict(zip(data["block_keys"].tolist(), data["blocks"]))
+    return points, blocks
+
+
+class MapArchive:
+    """One map directory: tile files plus an index of what they contain
+
+    The tile layout (voxel and block sizes, tiles per edge) is stored in the
+    index, so an existing map is always reopened with its own layout.
+    """
+
+    def __init__(
+        self,
+        directory,
+        resolution=RESOLUTION,
+        block_size=BLOCK_SIZE,
+        voxel_size=VOXEL_SIZE,
+        tile_blocks=TILE_BLOCKS,
+    ):
+        self.directory = directory
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self._lock = threading.Lock()
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {
+                "version": FORMAT_VERSION,
+                "resolution": resolution,
+                "block_size": block_size,
+                "voxel_size": voxel_size,
+                "tile_blocks": tile_blocks,
+                "tiles": {},
+            }
+        os.makedirs(os.path.join(directory, TILE_DIR), exist_ok=True)
+        self.block_size = self.index["block_size"]
+        self.tile_blocks = self.index["tile_blocks"]
+        self.tile_edge = self.index["resolution"] * self.block_size * self.tile_blocks
+
+    def __len__(self):
+        return len(self.index["tiles"])
+
+    def __contains__(self, tile):
+        return tile_name(tile) in self.index["tiles"]
+
+    def matches(self, occupancy, store):
+        """True when the live map uses the same voxel sizes as this archive"""
+        return (
+            np.isclose(self.index["resolution"], occupancy.resolution)
+            and self.block_size == occupancy.block_size
+            and np.isclose(self.index["voxel_size"], store.voxel_size)
+        )
+
+    def tiles_of_points(self, points):
+        return np.floor(np.asarray(points) / self.tile_edge).astype(np.int64)
+
+    def tiles_of_blocks(self, block_keys):
+        return unpack_voxel_keys(block_keys) // self.tile_blocks
+
+    def tiles_near(self, center, radius):
+        """Saved tiles overlapping the box of half-size radius, nearest first"""
+        center = np.asarray(center, dtype=np.float64)
+        lo = self.tiles_of_points(center - radius)
+        hi = self.tiles_of_points(center + radius)
+        with self._lock:
+            names = self.index["tiles"]
+            found = [
+                (x, y, z)
+                for x in range(lo[0], hi[0] + 1)
+                for y in range(lo[1], hi[1] + 1)
+                for z in range(lo[2], hi[2] + 1)
+                if f"{x}_{y}_{z}" in names
+            ]
+        mid = (np.array(found, dtype=np.float64).reshape(-1, 3) + 0.5) * self.tile_edge
+        order = np.argsort(np.linalg.norm(mid - center, axis=1))
+        return [found[i] for i in order]
+
+    def path(self, tile):
+        return os.path.join(self.directory, TILE_DIR, tile_name(tile) + ".npz")
+
+    def read(self, tile):
+        return read_tile(self.path(tile))
+
+    def write(self, tile, points, blocks):
+        size = write_tile(self.path(tile), points, blocks)
+        with self._lock:
+            self.index["tiles"][tile_name(tile)] = {
+                "points": len(points),
+                "blocks": len(blocks),
+                "bytes": size,
+                "saved": time.time(),
+            }
+        return size
+
+    def save_index(self):
+        with self._lock:
+            data = json.dumps(self.index, indent=1)
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.index_path)
+
+    def bounds(self):
+        """(min, max) corners of all saved tiles, or None for an empty map"""
+        with self._lock:
+            names = list(self.index["tiles"])
+        if not names:
+            return None
+        tiles = np.array([parse_tile_name(n) for n in names], dtype=np.float64)
+        return (
+            tiles.min(axis=0) * self.tile_edge,
+            (tiles.max(axis=0) + 1) * self.tile_edge,
+        )
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(t["bytes"] for t in self.index["tiles"].values())
+
+
+class TileCache:
+    """LRU-bounded cache of decoded tiles, loaded from the archive on demand"""
+
+    def __init__(self, archive, capacity=CACHE_TILES):
+        self.archive = archive
+        self.capacity = capacity
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, tile):
+        """(points, blocks) of a saved tile"""
+        with self._lock:
+            if tile in self._tiles:
+                self._tiles.move_to_end(tile)
+                self.hits += 1
+                return self._tiles[tile]
+        data = self.archive.read(tile)
+        with self._lock:
+            self.misses += 1
+            self._tiles[tile] = data
+            while len(self._tiles) > self.capacity:
+                self._tiles.popitem(last=False)
+                self.evictions += 1
+        return data
+
+    def stats(self):
+        with self._lock:
+            points = sum(len(p) for p, _ in self._tiles.values())
+            return {
+                "tiles": len(self._tiles),
+                "points": points,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class MapSession:
+    """Persist a live map as tiles and load saved tiles around the drone
+
+    The saver thread assigns new store points and changed occupancy blocks
+    to tiles and rewrites only the tiles that changed. Saved tiles are
+    merged into the live map when the drone comes within sensor range of
+    them (load_around), so resuming a large map only loads what is needed.
+    Loading and saving both run on the saver thread; a changed tile that was
+    never loaded is merged before it is written, so saved content is never
+    overwritten.
+
+    Tile contents are read back from the store and the occupancy grid when
+    written; the session only keeps which store rows and blocks each tile
+    has. Once more than live_tiles saved tiles are loaded, the least
+    recently approached ones away from the drone are dropped from the live
+    map again (points and blocks). Tiles this flight has added to are kept:
+    their points may still be moved by the pose graph and their rays are
+    replayed when the occupancy grid is rebuilt, neither of which could be
+    done to a copy on disk. Eviction rewrites the store, so the LOD view
+    rebuilds in the background afterwards.
+    """
+
+    def __init__(
+        self,
+        directory,
+        store,
+        occupancy,
+        save_interval=SAVE_INTERVAL,
+        load_radius=MAX_RANGE + LOAD_MARGIN,
+        live_tiles=LIVE_TILES,
+    ):
+        self.archive = MapArchive(
+            directory, occupancy.resolution, occupancy.block_size, store.voxel_size
+        )
+        if not self.archive.matches(occupancy, store):
+            raise ValueError(f"Map in {directory} uses different voxel sizes")
+        self.store = store
+        self.occupancy = occupancy
+        self.save_interval = save_interval
+        self.load_radius = load_radius
+        self.live_tiles = live_tiles
+        self.resumed = len(self.archive)
+
+        self._saved_points = 0  # Store points already assigned to tiles
+        self._generation = store.generation
+        self._tile_rows = {}  # tile -> list of store row arrays
+        self._tile_blocks = {}  # tile -> set of occupancy block keys
+        self._dirty = set()
+        self._loaded = set()  # Saved tiles merged into the live map
+        self._recent = OrderedDict()  # Merged saved tiles, least recently near first
+        self._unchanged = {}  # tile -> loaded points not to count as changes
+        self._lock = threading.Lock()
+        self._last_tile = None
+        self._load_center = None
+        self._center = None  # Position of the last load_around() that moved tiles
+        self._wake = threading.Event()
+        self._thread = None
+        self._stop = threading.Event()
+
+        self.saves = 0
+        self.tiles_written = 0
+        self.bytes_written = 0
+        self.last_save_ms = 0.0
+        self.evicted = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="map-saver", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the saver and write everything that is still pending"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.save()
+        print(
+            f"[INFO] Map saved to {self.archive.directory}: {len(self.archive)} tiles, "
+            f"{self.archive.total_bytes() / 1e6:.1f} MB"
+        )
+
+    def load_around(self, position):
+        """Ask for the saved tiles around position to be merged
+
+        Only does work when the drone enters another tile; the tiles are
+        read on the saver thread.
+        """
+        if not self.resumed:
+            return
+        tile = tuple(self.archive.tiles_of_points(position).tolist())
+        if tile != self._last_tile:
+            self._last_tile = tile
+            self._center = np.array(position, dtype=np.float64)
+            self._load_center = self._center
+            self._wake.set()
+
+    def _load_pending(self):
+        center, self._load_center = self._load_center, None
+        if center is None:
+            return 0
+        return sum(
+            self._merge(tile)
+            for tile in self.archive.tiles_near(center, self.load_radius)
+        )
+
+    def _merge(self, tile):
+        with self._lock:
+            if tile in self._loaded:
+                if tile in self._recent:
+                    self._recent.move_to_end(tile)
+                return 0
+            self._loaded.add(tile)
+        points, blocks = self.archive.read(tile)
+        added = self.store.add(points)
+        self.occupancy.merge_blocks(blocks)
+        # Blocks go into the tile index directly; points come back through
+        # the store on the next _collect() and should not mark it changed
+        with self._lock:
+            self._tile_blocks.setdefault(tile, set()).update(blocks)
+            self._unchanged[tile] = self._unchanged.get(tile, 0) + added
+            self._recent[tile] = None
+        return 1
+
+    def _evict(self):
+        """Drop far saved tiles once more than live_tiles are loaded (saver thread)"""
+        with self._lock:
+            excess = len(self._recent) - self.live_tiles
+            if excess <= 0:
+                return 0
+            candidates = [t for t in self._recent if t not in self._dirty]
+        excess += int(self.live_tiles * EVICT_FRACTION)
+        near = set()
+        if self._center is not None:
+            near.update(self.archive.tiles_near(self._center, self.load_radius))
+
+        generation = self._generation
+        evicted, rows = [], []
+        for tile in candidates:
+            if len(evicted) >= excess:
+                break
+            if tile in near:
+                continue
+            chunks = self._tile_rows.get(tile)
+            tile_rows = np.concatenate(chunks) if chunks else np.zeros(0, np.int64)
+            taken = self.store.take(tile_rows, generation)
+            if taken is None:
+                break  # Store rewritten; _collect() reassigns first
+            if (taken[1] >= 0).any():
+                continue  # Points this flight's pose graph may still move
+            with self._lock:
+                keys = list(self._tile_blocks.get(tile, ()))
+            if not self.occupancy.drop_blocks(keys):
+                continue
+            evicted.append(tile)
+            rows.append(tile_rows)
+        if not evicted:
+            return 0
+
+        removed = np.sort(np.concatenate(rows))
+        generation = self.store.remove(removed, generation)
+        if generation is not None:
+            # Rows after the removed ones move down; a failed removal leaves
+            # the points to be reassigned when _collect() sees the rewrite
+            self._generation = generation
+            self._saved_points -= len(removed)
+            for tile in evicted:
+                self._tile_rows.pop(tile, None)
+            for tile, chunks in self._tile_rows.items():
+                tile_rows = np.concatenate(chunks) if chunks else np.zeros(0, np.int64)
+                self._tile_rows[tile] = [
+                    tile_rows - np.searchsorted(removed, tile_rows)
+                ]
+        with self._lock:
+            for tile in evicted:
+                self._loaded.discard(tile)
+                self._recent.pop(tile, None)
+                self._unchanged.pop(tile, None)
+                self._tile_blocks.pop(tile, None)
+        self.evicted += len(evicted)
+        return len(evicted)
+
+    def _run(self):
+        next_save = time.monotonic() + self.save_interval
+        while not self._stop.is_set():
+            self._wake.wait(max(0.0, next_save - time.monotonic()))
+            self._wake.clear()
+            try:
+                self._load_pending()
+                if time.monotonic() >= next_save:
+                    next_save = time.monotonic() + self.save_interval
+                    self.save()
+                    self._evict()
+            except OSError as e:
+                print(f"[ERROR] Map tile I/O failed: {e}")
+
+    def _collect(self):
+        """Assign new points and changed blocks to tiles (saver thread)"""
+        generation = self.store.generation
+        if generation != self._generation:
+            # The store was rewritten: reassign every point, and rewrite the
+            # tiles that had points too, as some may now be empty
+            self._generation = generation
+            self._saved_points = 0
+            with self._lock:
+                self._dirty.update(self._tile_rows)
+                self._unchanged.clear()
+            self._tile_rows = {}
+        start = self._saved_points
+        count = len(self.store)
+        points = self.store.slice(start, count)
+        if self.store.generation != generation:
+            return  # Rewritten while slicing; start over on the next save
+        self._saved_points = start + len(points)
+        if len(points):
+            tiles, inverse = np.unique(
+                self.archive.tiles_of_points(points), axis=0, return_inverse=True
+            )
+            inverse = inverse.reshape(-1)
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.searchsorted(inverse[order], np.arange(len(tiles) + 1))
+            for i, tile in enumerate(map(tuple, tiles.tolist())):
+                chunk = start + order[bounds[i] : bounds[i + 1]]
+                self._tile_rows.setdefault(tile, []).append(chunk)
+                with self._lock:
+                    unchanged = self._unchanged.pop(tile, 0)
+                    if len(chunk) > unchanged:
+                        self._dirty.add(tile)
+                    elif len(chunk) < unchanged:
+                        self._unchanged[tile] = unchanged - len(chunk)
+
+        keys = np.fromiter(self.occupancy.take_dirty(), dtype=np.int64)
+        if len(keys):
+            tiles = map(tuple, self.archive.tiles_of_blocks(keys).tolist())
+            with self._lock:
+                for tile, key in zip(tiles, keys.tolist()):
+                    self._tile_blocks.setdefault(tile, set()).add(key)
+                    self._dirty.add(tile)
+
+    def save(self):
+        """Write every changed tile and the index; returns tiles written"""
+        start = time.perf_counter()
+        self._collect()
+        with self._lock:
+            unloaded = [
+                t for t in self._dirty if t in self.archive and t not in self._loaded
+            ]
+        if unloaded:
+            for tile in unloaded:
+                self._merge(tile)
+            self._collect()
+        if not self._dirty:
+            return 0
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        written = set()
+        for tile in dirty:
+            chunks = self._tile_rows.get(tile)
+            rows = np.concatenate(chunks) if chunks else np.zeros(0, np.int64)
+            self._tile_rows[tile] = [rows]
+            taken = self.store.take(rows, self._generation)
+            if taken is None:
+                # Store rewritten since _collect(); the next save reassigns
+                with self._lock:
+                    self._dirty.update(dirty - written)
+                break
+            with self._lock:
+                keys = list(self._tile_blocks.get(tile, ()))
+            blocks = self.occupancy.copy_blocks(keys)
+            self.bytes_written += self.archive.write(tile, taken[0], blocks)
+            written.add(tile)
+        self.archive.save_index()
+        with self._lock:
+            self._loaded.update(written)
+
+        self.saves += 1
+        self.tiles_written += len(written)
+        self.last_save_ms = (time.perf_counter() - start) * 1000.0
+        return len(written)
+
+    def stats(self):
+        return {
+            "tiles": len(self.archive),
+            "loaded": len(self._loaded),
+            "resident": len(self._recent),
+            "evicted": self.evicted,
+            "saves": self.saves,
+            "tiles_written": self.tiles_written,
+            "mb_written": self.bytes_written / 1e6,
+            "save_ms": self.last_save_ms,
+        }
+
+
+class MapViewer:
+    """Browse a saved map without a drone, loading tiles around each camera
+
+    Every browser tab gets the tiles around its own camera target; tiles
+    that fall out of range are removed from that tab's scene, and decoded
+    tiles are shared through one LRU TileCache.
+    """
+
+    def __init__(self, directory, radius=VIEW_RADIUS, cache_tiles=CACHE_TILES):
+        if not os.path.exists(os.path.join(directory, INDEX_FILE)):
+            raise FileNotFoundError(f"No map index in {directory}")
+        self.archive = MapArchive(directory)
+        self.cache = TileCache(self.archive, cache_tiles)
+        self.radius = radius
+        self.server = viser.ViserServer()
+        self._shown = {}  # client id -> {tile: point cloud handle}
+        self.server.on_client_connect(self._on_connect)
+        self.server.on_client_disconnect(
+            lambda client: self._shown.pop(client.client_id, None)
+        )
+
+    def _on_connect(self, client):
+        self._shown[client.client_id] = {}
+        bounds = self.archive.bounds()
+        if bounds is not None:
+            lo, hi = bounds
+            center = (lo + hi) / 2.0
+            center[2] = lo[2]
+            client.camera.look_at = tuple(center)
+            client.camera.position = tuple(center + (-self.radius, 0.0, self.radius))
+
+    def update(self):
+        for client_id, client in self.server.get_clients().items():
+            shown = self._shown.get(client_id)
+            if shown is None:
+                continue
+            center = np.asarray(client.camera.look_at, dtype=np.float64)
+            wanted = self.archive.tiles_near(center, self.radius)
+            wanted = wanted[: self.cache.capacity]
+            for tile in set(shown) - set(wanted):
+                shown.pop(tile).remove()
+            for tile in wanted:
+                if tile in shown:
+                    continue
+                points, _ = self.cache.get(tile)
+                if len(points) == 0:
+                    continue
+                shown[tile] = client.scene.add_point_cloud(
+                    f"/tiles/{tile_name(tile)}",
+                    points=points,
+                    colors=height_colors(points[:, 2]),
+                    point_size=VIEW_POINT_SIZE,
+                )
+
+    def run(self):
+        print(
+            f"[INFO] Viewing {self.archive.directory}: {len(self.archive)} tiles, "
+            f"{self.archive.total_bytes() / 1e6:.1f} MB on disk"
+        )
+        print("  Open http://localhost:8080; tiles load around the camera target")
+        try:
+            while True:
+                self.update()
+                time.sleep(VIEW_INTERVAL)
+        except KeyboardInterrupt:
+            print(f"\n[INFO] Tile cache: {self.cache.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="View a saved tiled map")
+    parser.add_argument("directory", help="Map directory (contains index.json)")
+    parser.add_argument("--radius", type=float, default=VIEW_RADIUS)
+    parser.add_argument("--cache-tiles", type=int, default=CACHE_TILES)
+    args = parser.parse_args()
+    MapViewer(args.directory, args.radius, args.cache_tiles).run()
+
+
+if __name__ == "__main__":
+    main()
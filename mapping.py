@@ -0,0 +1,349 @@
+import threading
+
+import numpy as np
+
+# Multiranger + Flowdeck distance sensors, logged as uint16 millimetres
+RANGE_VARIABLES = [
+    "range.front",
+    "range.back",
+    "range.left",
+    "range.right",
+    "range.up",
+    "range.zrange",
+]
+
+# Unit vector of each sensor in the body frame (x forward, y left, z up)
+RANGE_DIRECTIONS = np.array(
+    [
+        [1.0, 0.0, 0.0],  # front
+        [-1.0, 0.0, 0.0],  # back
+        [0.0, 1.0, 0.0],  # left
+        [0.0, -1.0, 0.0],  # right
+        [0.0, 0.0, 1.0],  # up
+        [0.0, 0.0, -1.0],  # zrange (down)
+    ],
+    dtype=np.float64,
+)
+
+POSE_VARIABLES = ["stateEstimate.x", "stateEstimate.y", "stateEstimate.z"]
+ATTITUDE_VARIABLES = ["stabilizer.roll", "stabilizer.pitch", "stabilizer.yaw"]
+
+MAX_RANGE = 4.0  # VL53L1x returns at or beyond this are "no hit"
+MIN_RANGE = 0.02
+VOXEL_SIZE = 0.05
+FULL_REMAP_FRACTION = 0.25  # Moved share of points above which remap rehashes all
+
+# Voxel keys pack three signed 21-bit indices into one int64
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+_KEY_MASK = (1 << _KEY_BITS) - 1
+
+
+def rotation_matrices(roll, pitch, yaw):
+    """Body-to-world rotations (N, 3, 3) from angles in degrees
+
+    Uses the ZYX convention R = Rz(yaw) Ry(pitch) Rx(roll). Note that
+    stabilizer.pitch is logged with an inverted sign by the firmware, so
+    callers should pass -stabilizer.pitch.
+    """
+    r, p, y = (np.radians(np.asarray(a, dtype=np.float64)) for a in (roll, pitch, yaw))
+    cr, sr = np.cos(r), np.sin(r)
+    cp, sp = np.cos(p), np.sin(p)
+    cy, sy = np.cos(y), np.sin(y)
+
+    rot = np.empty(r.shape + (3, 3), dtype=np.float64)
+    rot[..., 0, 0] = cy * cp
+    rot[..., 0, 1] = cy * sp * sr - sy * cr
+    rot[..., 0, 2] = cy * sp * cr + sy * sr
+    rot[..., 1, 0] = sy * cp
+    rot[..., 1, 1] = sy * sp * sr + cy * cr
+    rot[..., 1, 2] = sy * sp * cr - cy * sr
+    rot[..., 2, 0] = -sp
+    rot[..., 2, 1] = cp * sr
+    rot[..., 2, 2] = cp * cr
+    return rot
+
+
+def ranges_to_rays(positions, attitudes, ranges_mm, max_range=MAX_RANGE):
+    """Convert a batch of range readings to world-frame rays
+
+    positions: (N, 3) metres, attitudes: (N, 3) roll/pitch/yaw in degrees
+    (pitch already sign-corrected), ranges_mm: (N, 6) in RANGE_VARIABLES order.
+    Returns (origins (M, 3), endpoints (M, 3), hit mask (M,)). Readings
+    below MIN_RANGE are discarded as invalid; rays without a return are
+    clipped to max_range and flagged as misses.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    attitudes = np.asarray(attitudes, dtype=np.float64).reshape(-1, 3)
+    ranges = np.asarray(ranges_mm, dtype=np.float64).reshape(-1, 6) / 1000.0
+
+    valid = (ranges >= MIN_RANGE).reshape(-1)
+    hit = ranges < max_range
+    lengths = np.where(hit, ranges, max_range)
+
+    rot = rotation_matrices(attitudes[:, 0], attitudes[:, 1], attitudes[:, 2])
+    # (N, 6, 3): each sensor direction rotated into the world frame
+    directions = np.einsum("nij,kj->nki", rot, RANGE_DIRECTIONS)
+    endpoints = positions[:, None, :] + directions * lengths[..., None]
+    origins = np.broadcast_to(positions[:, None, :], endpoints.shape)
+    return (
+        origins.reshape(-1, 3)[valid],
+        endpoints.reshape(-1, 3)[valid],
+        hit.reshape(-1)[valid],
+    )
+
+
+def ranges_to_world(positions, attitudes, ranges_mm, max_range=MAX_RANGE):
+    """Return only the world-frame hit points (M, 3) for a batch of readings"""
+    _, endpoints, hit = ranges_to_rays(positions, attitudes, ranges_mm, max_range)
+    return endpoints[hit]
+
+
+def voxel_keys(indices):
+    """Pack integer voxel indices (N, 3) into int64 hash keys"""
+    idx = (np.asarray(indices, dtype=np.int64) + _KEY_OFFSET) & _KEY_MASK
+    return (idx[:, 0] << (2 * _KEY_BITS)) | (idx[:, 1] << _KEY_BITS) | idx[:, 2]
+
+
+def unpack_voxel_keys(keys):
+    """Inverse of voxel_keys: int64 hash keys back to voxel indices (N, 3)"""
+    keys = np.asarray(keys, dtype=np.int64)
+    idx = (
+        np.stack((keys >> (2 * _KEY_BITS), keys >> _KEY_BITS, keys), axis=-1)
+        & _KEY_MASK
+    )
+    return idx - _KEY_OFFSET
+
+
+def height_colors(z, z_min=0.0, z_max=3.0):
+    """Map heights to RGB uint8 colours (blue low, red high)"""
+    t = np.clip((np.asarray(z) - z_min) / (z_max - z_min), 0.0, 1.0)
+    colors = np.empty((len(t), 3), dtype=np.uint8)
+    colors[:, 0] = (255 * t).astype(np.uint8)
+    colors[:, 1] = (255 * (1.0 - np.abs(2.0 * t - 1.0))).astype(np.uint8)
+    colors[:, 2] = (255 * (1.0 - t)).astype(np.uint8)
+    return colors
+
+
+class VoxelPointStore:
+    """Append-only point store keeping at most one point per voxel
+
+    Each point carries an integer tag (the pose-graph keyframe it was seen
+    from, -1 for none) so it can be moved when that keyframe is corrected.
+    remap() and remove() rewrite the arrays and bump generation, which
+    tells readers that track positions in the store to start over.
+    """
+
+    def __init__(self, voxel_size=VOXEL_SIZE, initial_capacity=65536):
+        self.voxel_size = voxel_size
+        self._points = np.zeros((initial_capacity, 3), dtype=np.float32)
+        self._tags = np.full(initial_capacity, -1, dtype=np.int32)
+        self._count = 0
+        self._keys = set()
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return self._points.nbytes
+
+    def add(self, points, tags=-1):
+        """Insert points, skipping voxels that are already occupied
+
+        tags is one tag for all points or one per point. Returns the number
+        of new points stored.
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        if len(points) == 0:
+            return 0
+        tags = np.broadcast_to(np.asarray(tags, dtype=np.int32), len(points))
+        keys = voxel_keys(np.floor(points / self.voxel_size))
+        keys, first = np.unique(keys, return_index=True)
+
+        with self._lock:
+            fresh = np.fromiter(
+                (k not in self._keys for k in keys.tolist()),
+                dtype=bool,
+                count=len(keys),
+            )
+            if not fresh.any():
+                return 0
+            new = first[fresh]
+            self._keys.update(keys[fresh].tolist())
+            self._reserve(self._count + len(new))
+            self._points[self._count : self._count + len(new)] = points[new]
+            self._tags[self._count : self._count + len(new)] = tags[new]
+            self._count += len(new)
+            return len(new)
+
+    def slice(self, start, end=None):
+        """Return a copy of points[start:end]"""
+        with self._lock:
+            end = self._count if end is None else min(end, self._count)
+            return self._points[start:end].copy()
+
+    def tagged(self):
+        """Return copies of (points, tags)"""
+        with self._lock:
+            return self._points[: self._count].copy(), self._tags[: self._count].copy()
+
+    def take(self, rows, generation):
+        """Copies of (points, tags) at rows, or None if generation has passed"""
+        with self._lock:
+            if self.generation != generation:
+                return None
+            return self._points[rows], self._tags[rows]
+
+    def remove(self, rows, generation):
+        """Delete the points at rows and bump generation like remap()
+
+        Returns the new generation, or None without removing anything if
+        the store is no longer at generation.
+        """
+        with self._lock:
+            if self.generation != generation:
+                return None
+            keys = voxel_keys(np.floor(self._points[rows] / self.voxel_size))
+            self._keys.difference_update(keys.tolist())
+            keep = np.ones(self._count, dtype=bool)
+            keep[rows] = False
+            count = int(keep.sum())
+            self._points[:count] = self._points[: self._count][keep]
+            self._tags[:count] = self._tags[: self._count][keep]
+            self._count = count
+            self.generation += 1
+            return self.generation
+
+    def remap(self, fn):
+        """Move every point at once with fn(points, tags) -> points
+
+        When few points moved (a correction near the end of the flight),
+        only those are rehashed and one landing in a voxel that is already
+        taken is dropped; otherwise all points are rehashed and the older
+        of two in a voxel is kept. Returns the number of points after it.
+        """
+        with self._lock:
+            points = self._points[: self._count]
+            tags = self._tags[: self._count]
+            new = np.asarray(fn(points, tags), dtype=np.float32)
+            rows = np.flatnonzero((new != points).any(axis=1))
+            if len(rows) > self._count * FULL_REMAP_FRACTION:
+                keys = voxel_keys(np.floor(new / self.voxel_size))
+                keys, first = np.unique(keys, return_index=True)
+                first.sort()
+                self._keys = set(keys.tolist())
+            elif len(rows):
+                old_keys = voxel_keys(np.floor(points[rows] / self.voxel_size))
+                self._keys.difference_update(old_keys.tolist())
+                keys = voxel_keys(np.floor(new[rows] / self.voxel_size))
+                keys, first = np.unique(keys, return_index=True)
+                fresh = np.fromiter(
+                    (k not in self._keys for k in keys.tolist()),
+                    dtype=bool,
+                    count=len(keys),
+                )
+                self._keys.update(keys[fresh].tolist())
+                dropped = np.ones(len(rows), dtype=bool)
+                dropped[first[fresh]] = False
+                first = np.delete(np.arange(self._count), rows[dropped])
+            else:
+                first = None
+            if first is not None:
+                count = len(first)
+                self._points[:count] = new[first]
+                self._tags[:count] = tags[first]
+                self._count = count
+            self.generation += 1
+            return self._count
+
+    def _reserve(self, size):
+        if size <= len(self._points):
+            return
+        capacity = len(self._points)
+        while capacity < size:
+            capacity *= 2
+        grown = np.zeros((capacity, 3), dtype=np.float32)
+        grown[: self._count] = self._points[: self._count]
+        self._points = grown
+        tags = np.full(capacity, -1, dtype=np.int32)
+        tags[: self._count] = self._tags[: self._count]
+        self._tags = tags
+
+
+class MappingPipeline:
+    """Batch pose + range samples and turn them into a world-frame point cloud
+
+    The log callbacks only copy a few floats into a preallocated batch; the
+    vectorized conversion runs in flush(), which is called off the radio
+    thread (e.g. from the render scheduler).
+    """
+
+    def __init__(
+        self,
+        voxel_size=VOXEL_SIZE,
+        batch_capacity=1024,
+        max_range=MAX_RANGE,
+        occupancy=None,
+        store=None,
+    ):
+        self.max_range = max_range
+        # Pipelines flushed from the same thread may share one store
+        self.store = store if store is not None else VoxelPointStore(voxel_size)
+        self.occupancy = occupancy
+        self._pose = np.zeros(6, dtype=np.float64)  # x, y, z, roll, pitch, yaw
+        self.tag = -1  # Stored with every new point (see VoxelPointStore)
+        # Rows: pose (6), ranges (6), tag
+        self._batch = np.zeros((batch_capacity, 13), dtype=np.float64)
+        self._spare = np.zeros_like(self._batch)
+        self._count = 0
+        self._lock = threading.Lock()
+        self.samples = 0
+        self.overflowed = 0
+
+    def pose_callback(self, timestamp, data, logconf):
+        pose = self._pose
+        pose[0] = data.get("stateEstimate.x", 0)
+        pose[1] = data.get("stateEstimate.y", 0)
+        pose[2] = data.get("stateEstimate.z", 0)
+        pose[3] = data.get("stabilizer.roll", 0)
+        pose[4] = -data.get("stabilizer.pitch", 0)  # Firmware pitch is inverted
+        pose[5] = data.get("stabilizer.yaw", 0)
+
+    def range_callback(self, timestamp, data, logconf):
+        with self._lock:
+            if self._count >= len(self._batch):
+                self.overflowed += 1
+                return
+            row = self._batch[self._count]
+            row[:6] = self._pose
+            for i, name in enumerate(RANGE_VARIABLES):
+                row[6 + i] = data.get(name, 0)
+            row[12] = self.tag
+            self._count += 1
+            self.samples += 1
+
+    def take_batch(self):
+        """Swap out the pending batch and return it as (N, 13) rows"""
+        with self._lock:
+            batch, count = self._batch, self._count
+            self._batch, self._spare = self._spare, batch
+            self._count = 0
+        return batch[:count]
+
+    def flush(self):
+        """Convert pending samples to points; returns the number of new points"""
+        rows = self.take_batch()
+        if len(rows) == 0:
+            return 0
+        origins, endpoints, hits = ranges_to_rays(
+            rows[:, 0:3], rows[:, 3:6], rows[:, 6:12], self.max_range
+        )
+        if self.occupancy is not None:
+            self.occupancy.insert_rays(origins, endpoints, hits)
+        # Same validity test as ranges_to_rays, to line the tags up with rays
+        valid = (rows[:, 6:12] / 1000.0 >= MIN_RANGE).reshape(-1)
+        tags = np.repeat(rows[:, 12], 6)[valid]
+        return self.store.add(endpoints[hits], tags[hits])
@@ -0,0 +1,301 @@
+import threading
+import time
+
+import numpy as np
+
+from mapping import unpack_voxel_keys, voxel_keys
+
+RESOLUTION = 0.05  # Metres per voxel
+REBUILD_CHUNK = 20000  # Rays integrated per batch by rebuild()
+BLOCK_SIZE = 8  # Voxels per block edge (8^3 float32 = 2 KiB per block)
+
+# Log-odds update and clamping constants (OctoMap defaults)
+L_HIT = 0.85
+L_MISS = -0.4
+L_MIN = -2.0
+L_MAX = 3.5
+L_OCCUPIED = 0.0  # Cells above this are reported as occupied
+
+
+def traverse_rays(origins, endpoints, resolution=RESOLUTION):
+    """Vectorized 3D DDA over a batch of rays
+
+    Steps every ray through the grid at once (Amanatides & Woo) and returns
+    the integer indices (M, 3) of all voxels crossed before each endpoint
+    voxel. The endpoint voxels themselves are not included.
+    """
+    o = np.asarray(origins, dtype=np.float64).reshape(-1, 3) / resolution
+    e = np.asarray(endpoints, dtype=np.float64).reshape(-1, 3) / resolution
+    if len(o) == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+
+    cur = np.floor(o).astype(np.int64)
+    end = np.floor(e).astype(np.int64)
+    d = e - o
+    step = np.sign(d).astype(np.int64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_delta = np.where(d != 0, np.abs(1.0 / d), np.inf)
+        boundary = cur + (step > 0)
+        t_max = np.where(d != 0, (boundary - o) / d, np.inf)
+
+    n_steps = np.abs(end - cur).sum(axis=1)
+    visited = []
+    for i in range(int(n_steps.max())):
+        active = np.nonzero(n_steps > i)[0]
+        visited.append(cur[active].copy())
+        axis = np.argmin(t_max[active], axis=1)
+        cur[active, axis] += step[active, axis]
+        t_max[active, axis] += t_delta[active, axis]
+
+    if not visited:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.concatenate(visited)
+
+
+class OccupancyGrid:
+    """Sparse log-odds occupancy map stored as hashed fixed-size voxel blocks
+
+    Only blocks touched by a ray are allocated, so memory follows the
+    explored volume rather than the bounding box of the flight.
+    """
+
+    def __init__(self, resolution=RESOLUTION, block_size=BLOCK_SIZE):
+        if block_size & (block_size - 1):
+            raise ValueError("Block size must be a power of two")
+        self.resolution = resolution
+        self.block_size = block_size
+        self._shift = block_size.bit_length() - 1
+        self.blocks = {}
+        self._lock = threading.Lock()
+        self._dirty = [set()]  # Per watcher: block keys changed since take_dirty()
+        self._base = {}  # Blocks merged from a saved map, kept for rebuild()
+        self._live = set()  # Blocks touched by rays of this session
+        self._journal = None  # Ray batches inserted while a rebuild runs
+
+        # Per-batch and cumulative update statistics
+        self.last_stats = {}
+        self.updates = 0
+        self.total_update_time = 0.0
+
+    @property
+    def memory_bytes(self):
+        return len(self.blocks) * self.block_size**3 * np.dtype(np.float32).itemsize
+
+    def insert_rays(self, origins, endpoints, hits):
+        """Integrate one batch of rays and return its update statistics
+
+        Each voxel is updated at most once per batch; hits take priority over
+        misses so a surface is not erased by rays passing through it.
+        """
+        start = time.perf_counter()
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        endpoints = np.asarray(endpoints, dtype=np.float64).reshape(-1, 3)
+        hits = np.asarray(hits, dtype=bool).reshape(-1)
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((origins, endpoints, hits))
+
+        free = np.unique(voxel_keys(traverse_rays(origins, endpoints, self.resolution)))
+        hit_idx = np.floor(endpoints[hits] / self.resolution).astype(np.int64)
+        occupied = np.unique(voxel_keys(hit_idx))
+        free = free[~np.isin(free, occupied, assume_unique=True)]
+
+        keys = np.concatenate((free, occupied))
+        deltas = np.concatenate(
+            (
+                np.full(len(free), L_MISS, np.float32),
+                np.full(len(occupied), L_HIT, np.float32),
+            )
+        )
+        touched, created = self._apply(keys, deltas)
+
+        elapsed = time.perf_counter() - start
+        self.updates += 1
+        self.total_update_time += elapsed
+        self.last_stats = {
+            "rays": len(origins),
+            "free_voxels": len(free),
+            "hit_voxels": len(occupied),
+            "blocks_touched": touched,
+            "blocks_created": created,
+            "blocks": len(self.blocks),
+            "memory_mb": self.memory_bytes / 1e6,
+            "update_ms": elapsed * 1000.0,
+        }
+        return self.last_stats
+
+    def query(self, points):
+        """Return log-odds at world points (0.0 for unknown space)"""
+        idx = np.floor(
+            np.asarray(points, dtype=np.float64).reshape(-1, 3) / self.resolution
+        )
+        block_keys, local = self._split(idx.astype(np.int64))
+        values = np.zeros(len(idx), dtype=np.float32)
+        with self._lock:
+            for key in np.unique(block_keys).tolist():
+                block = self.blocks.get(key)
+                if block is not None:
+                    mask = block_keys == key
+                    values[mask] = block[local[mask]]
+        return values
+
+    def occupied_centers(self, threshold=L_OCCUPIED):
+        """Return world-frame centres (N, 3) of all occupied voxels"""
+        b = self.block_size
+        local_idx = np.stack(np.unravel_index(np.arange(b**3), (b, b, b)), axis=1)
+        centers = []
+        with self._lock:
+            items = list(self.blocks.items())
+        for key, block in items:
+            cells = np.nonzero(block > threshold)[0]
+            if len(cells):
+                origin = unpack_voxel_keys([key])[0] * b
+                centers.append(origin + local_idx[cells])
+        if not centers:
+            return np.zeros((0, 3), dtype=np.float32)
+        return ((np.concatenate(centers) + 0.5) * self.resolution).astype(np.float32)
+
+    def watch(self):
+        """Register another reader of changed blocks; returns its take_dirty() id
+
+        Watcher 0 always exists. Each watcher sees every change once, so
+        e.g. the tile writer and the frontier tracker don't steal each
+        other's updates. A new watcher starts with every block marked.
+        """
+        with self._lock:
+            self._dirty.append(set(self.blocks))
+            return len(self._dirty) - 1
+
+    def take_dirty(self, watcher=0):
+        """Return and clear the keys of blocks changed since the last call"""
+        with self._lock:
+            dirty, self._dirty[watcher] = self._dirty[watcher], set()
+        return dirty
+
+    def _mark(self, keys, first=0):
+        """Mark blocks changed for watchers from `first` on (caller holds the lock)"""
+        for dirty in self._dirty[first:]:
+            dirty.update(keys)
+
+    def block_keys(self):
+        """Keys of all allocated blocks"""
+        with self._lock:
+            return list(self.blocks)
+
+    def copy_blocks(self, keys):
+        """Copies of the given blocks as {key: array}, skipping missing ones"""
+        with self._lock:
+            return {k: self.blocks[k].copy() for k in keys if k in self.blocks}
+
+    def merge_blocks(self, blocks):
+        """Add previously saved blocks {key: array}
+
+        A block that is already in memory (mapped again before it was
+        loaded) gets the saved log-odds added, as if the saved evidence had
+        been integrated first. New blocks are marked for every watcher but
+        the tile writer (watcher 0), since they are already saved. Returns
+        the number of new blocks.
+        """
+        added = []
+        with self._lock:
+            for key, block in blocks.items():
+                base = self._base.get(key)
+                self._base[key] = block.copy() if base is None else base + block
+                current = self.blocks.get(key)
+                if current is None:
+                    self.blocks[key] = block.astype(np.float32)
+                    added.append(key)
+                else:
+                    np.clip(current + block, L_MIN, L_MAX, out=current)
+                    self._mark((key,))
+            self._mark(added, first=1)
+        return len(added)
+
+    def drop_blocks(self, keys):
+        """Forget saved blocks that no ray of this session touched
+
+        Lets far tiles of a resumed map leave memory; merge_blocks() brings
+        them back. Watchers are not told, so maps derived from the blocks
+        (frontiers, cost map) keep what they had. Returns False and drops
+        nothing if a ray touched one of the blocks or rebuild() is running,
+        as that evidence is only on disk once and would be counted again.
+        """
+        with self._lock:
+            if self._journal is not None or not self._live.isdisjoint(keys):
+                return False
+            for key in keys:
+                self.blocks.pop(key, None)
+                self._base.pop(key, None)
+            for dirty in self._dirty:
+                dirty.difference_update(keys)
+        return True
+
+    def rebuild(self, origins, endpoints, hits, chunk=REBUILD_CHUNK):
+        """Replace the grid with one integrated from the given rays
+
+        Used after the map is re-anchored: the new grid starts from the
+        blocks of the saved map and integrates the rays in batches while
+        the live grid keeps updating. Batches inserted meanwhile are
+        replayed before the swap, so no live update is lost. Returns the
+        number of blocks.
+        """
+        fresh = OccupancyGrid(self.resolution, self.block_size)
+        with self._lock:
+            self._journal = []
+            fresh.blocks = {k: v.copy() for k, v in self._base.items()}
+        try:
+            for i in range(0, len(origins), chunk):
+                fresh.insert_rays(
+                    origins[i : i + chunk],
+                    endpoints[i : i + chunk],
+                    hits[i : i + chunk],
+                )
+            while True:
+                with self._lock:
+                    journal, self._journal = self._journal, []
+                    if not journal:
+                        # Old and new keys both change what is on disk
+                        self._mark(self.blocks)
+                        self._mark(fresh.blocks)
+                        self.blocks = fresh.blocks
+                        self._live = fresh._live
+                        return len(self.blocks)
+                for batch in journal:
+                    fresh.insert_rays(*batch)
+        finally:
+            with self._lock:
+                self._journal = None
+
+    def _split(self, voxel_idx):
+        """Split voxel indices into (block keys, flat index inside the block)"""
+        b = self.block_size
+        block_keys = voxel_keys(voxel_idx >> self._shift)
+        lx, ly, lz = (voxel_idx & (b - 1)).T
+        return block_keys, (lx * b + ly) * b + lz
+
+    def _apply(self, keys, deltas):
+        if len(keys) == 0:
+            return 0, 0
+        block_keys, local = self._split(unpack_voxel_keys(keys))
+        order = np.argsort(block_keys, kind="stable")
+        block_keys, local, deltas = block_keys[order], local[order], deltas[order]
+        uniq, starts = np.unique(block_keys, return_index=True)
+        bounds = np.append(starts, len(block_keys))
+
+        created = 0
+        size = self.block_size**3
+        keys = uniq.tolist()
+        with self._lock:
+            self._mark(keys)
+            self._live.update(keys)
+            for i, key in enumerate(keys):
+                block = self.blocks.get(key)
+                if block is None:
+                    block = self.blocks[key] = np.zeros(size, dtype=np.float32)
+                    created += 1
+                cells = local[bounds[i] : bounds[i + 1]]
+                block[cells] = np.clip(
+                    block[cells] + deltas[bounds[i] : bounds[i + 1]], L_MIN, L_MAX
+                )
+        return len(uniq), created
@@ -0,0 +1,526 @@
+import heapq
+import math
+import threading
+import time
+
+import numpy as np
+
+from exploration import FREE, HEIGHT_GAIN, MAX_VZ, OCCUPIED, PLAN_POOL, disk_offsets
+from perf_stats import RollingStats
+
+# Cell costs (factor on the length of a move into the cell)
+ROBOT_RADIUS = 0.15  # Cells closer than this to an obstacle are never entered (m)
+INFLATION = 0.3  # Cells closer than this cost INFLATED_COST (m)
+FREE_COST = 1
+UNKNOWN_COST = 2  # Unseen cells inside the mapped area: allowed, avoided
+INFLATED_COST = 10
+
+# Replanning
+MAX_TILES = 32  # Changed map tiles applied to the cost map per control step
+MAX_EXPANSIONS = 3000  # D* Lite expansions per control step (bounds latency)
+MAX_PATH = 4000  # Cells
+SNAP_RADIUS = 0.5  # A goal in blocked space moves to the nearest open cell (m)
+NO_PATH_TIMEOUT = 5.0  # Seconds without a path before giving up
+
+# Following
+CONTROL_RATE = 10.0  # Setpoint updates per second
+COMMAND_TIMEOUT = 0.3  # Each setpoint expires unless renewed (s)
+SPEED = 0.3  # m/s
+MAX_ACCEL = 0.5  # Setpoints change by at most this (m/s^2)
+LOOKAHEAD = 1.0  # Steer at the furthest path point in view up to this far (m)
+GOAL_TOLERANCE = 0.1  # m
+
+# Move lengths in tenths of a cell; integers keep the search exact, so
+# equal keys compare equal and ties are broken as D* Lite expects
+_STRAIGHT, _DIAGONAL = 10, 14
+_MOVES = [
+    (dx, dy, _DIAGONAL if dx and dy else _STRAIGHT)
+    for dx in (-1, 0, 1)
+    for dy in (-1, 0, 1)
+    if dx or dy
+]
+
+
+class CostMap:
+    """Planning-cell costs at flight height, kept up to date incrementally
+
+    Built from the FrontierTracker slice, pooled to PLAN_POOL cells. Only
+    tiles the tracker reports as changed are looked at; obstacles keep a
+    count of occupied cells within ROBOT_RADIUS and INFLATION of every
+    cell, so adding or clearing one obstacle touches only the cells
+    around it. update() applies at most max_tiles tiles and returns the
+    cells whose cost changed. Cells outside the mapped tiles are blocked.
+    Not thread-safe; used from the planner thread only.
+    """
+
+    def __init__(self, frontiers, pool=PLAN_POOL, max_tiles=MAX_TILES):
+        self.frontiers = frontiers
+        self.pool = pool
+        self.max_tiles = max_tiles
+        self.resolution = frontiers.resolution * pool
+        self.tile = frontiers.block // pool  # Planning cells per tile edge
+        self._watcher = frontiers.watch()
+        self._pending = {}  # Changed tiles not applied yet (latest states)
+        self._tiles = {}  # (bx, by) -> (occupied, free) (tile, tile) bool
+        self._lethal = {}  # Cell -> occupied cells within ROBOT_RADIUS
+        self._inflated = {}  # Cell -> occupied cells within INFLATION
+        self._lethal_offsets = disk_offsets(ROBOT_RADIUS / self.resolution)
+        self._inflated_offsets = disk_offsets(INFLATION / self.resolution + 0.5)
+
+    def __len__(self):
+        return len(self._tiles) * self.tile**2
+
+    def pending(self):
+        """Changed tiles not applied yet"""
+        return len(self._pending)
+
+    def cell(self, xy):
+        return tuple(np.floor(np.asarray(xy) / self.resolution).astype(int).tolist())
+
+    def center(self, cells):
+        """World xy (N, 2) of cell centres"""
+        return (np.asarray(cells, dtype=np.float64) + 0.5) * self.resolution
+
+    def cost(self, cell):
+        if cell in self._lethal:
+            return math.inf
+        t = self.tile
+        entry = self._tiles.get((cell[0] // t, cell[1] // t))
+        if entry is None:
+            return math.inf
+        if cell in self._inflated:
+            return INFLATED_COST
+        return FREE_COST if entry[1][cell[0] % t, cell[1] % t] else UNKNOWN_COST
+
+    def update(self):
+        """Apply tiles changed in the map; returns the cells whose cost changed"""
+        t, p = self.tile, self.pool
+        self._pending.update(self.frontiers.take_changed(self._watcher))
+        changed = set()
+        for tile in list(self._pending)[: self.max_tiles]:
+            states = self._pending.pop(tile)
+            pooled = states.reshape(t, p, t, p)
+            occupied = (pooled == OCCUPIED).any(axis=(1, 3))
+            free = (pooled == FREE).any(axis=(1, 3)) & ~occupied
+            base = (tile[0] * t, tile[1] * t)
+            old = self._tiles.get(tile)
+            if old is None:
+                # Newly mapped: every cell goes from blocked to open
+                old = (np.zeros_like(occupied), None)
+                changed.update(
+                    (base[0] + x, base[1] + y) for x in range(t) for y in range(t)
+                )
+            else:
+                for x, y in np.argwhere(free != old[1]).tolist():
+                    changed.add((base[0] + x, base[1] + y))
+            self._tiles[tile] = (occupied, free)
+            for x, y in np.argwhere(occupied & ~old[0]).tolist():
+                cell = (base[0] + x, base[1] + y)
+                self._count(cell, self._lethal, self._lethal_offsets, 1, changed)
+                self._count(cell, self._inflated, self._inflated_offsets, 1, changed)
+            for x, y in np.argwhere(old[0] & ~occupied).tolist():
+                cell = (base[0] + x, base[1] + y)
+                self._count(cell, self._lethal, self._lethal_offsets, -1, changed)
+                self._count(cell, self._inflated, self._inflated_offsets, -1, changed)
+        return changed
+
+    @staticmethod
+    def _count(cell, counts, offsets, step, changed):
+        x, y = cell
+        for dx, dy in offsets:
+            near = (x + dx, y + dy)
+            n = counts.get(near, 0) + step
+            if n:
+                counts[near] = n
+            else:
+                del counts[near]
+            if n == 0 or n == step:
+                changed.add(near)
+
+    def snap(self, cell, radius=SNAP_RADIUS):
+        """Nearest cell to cell that is open and not inflated, or None"""
+        if self.cost(cell) <= UNKNOWN_COST:
+            return cell
+        best = None
+        offsets = disk_offsets(radius / self.resolution)
+        for dx, dy in sorted(offsets, key=lambda o: o[0] ** 2 + o[1] ** 2):
+            near = (cell[0] + dx, cell[1] + dy)
+            cost = self.cost(near)
+            if cost <= UNKNOWN_COST:
+                return near
+            if best is None and cost < math.inf:
+                best = near
+        return best
+
+
+class DStarLite:
+    """D* Lite (Koenig & Likhachev) on an 8-connected grid
+
+    Searches from the goal towards the start, so when cell costs change
+    only the part of the search they affect is repaired, and the start
+    can move between repairs. cost(cell) is the factor for moving into a
+    cell (inf = blocked); a move costs its length times that.
+    compute() stops after a number of expansions, so one call has a
+    bounded cost; the search continues on the next call.
+    """
+
+    def __init__(self, cost, start, goal):
+        self.cost = cost
+        self.start = self._last = start
+        self.goal = goal
+        self._g = {}
+        self._rhs = {goal: 0}
+        self._keys = {}  # Cell -> its current queue key
+        self._queue = []
+        self._km = 0
+        self._push(goal)
+        self.expansions = 0
+
+    @staticmethod
+    def _h(a, b):
+        dx, dy = abs(a[0] - b[0]), abs(a[1] - b[1])
+        return _STRAIGHT * max(dx, dy) + (_DIAGONAL - _STRAIGHT) * min(dx, dy)
+
+    def _key(self, cell):
+        m = min(self._g.get(cell, math.inf), self._rhs.get(cell, math.inf))
+        return (m + self._h(self.start, cell) + self._km, m)
+
+    def _push(self, cell):
+        key = self._key(cell)
+        self._keys[cell] = key
+        heapq.heappush(self._queue, (key, cell))
+
+    def _requeue(self, cell):
+        self._keys.pop(cell, None)
+        if self._g.get(cell, math.inf) != self._rhs.get(cell, math.inf):
+            self._push(cell)
+
+    def _update(self, cell):
+        if cell != self.goal:
+            best = math.inf
+            x, y = cell
+            for dx, dy, length in _MOVES:
+                near = (x + dx, y + dy)
+                g = self._g.get(near, math.inf)
+                if g < best:
+                    best = min(best, g + length * self.cost(near))
+            if best < math.inf:
+                self._rhs[cell] = best
+            else:
+                self._rhs.pop(cell, None)
+        self._requeue(cell)
+
+    def move(self, start):
+        """The drone moved; keys stay valid through the km offset"""
+        self._km += self._h(self._last, start)
+        self._last = self.start = start
+
+    def changed(self, cells):
+        """Moving into these cells costs something else now"""
+        for x, y in cells:
+            for dx, dy, _ in _MOVES:
+                self._update((x + dx, y + dy))
+
+    def compute(self, budget=MAX_EXPANSIONS):
+        """Repair the search; True when the start's cost is final"""
+        expanded = 0
+        while self._queue:
+            key, cell = self._queue[0]
+            if self._keys.get(cell) != key:
+                heapq.heappop(self._queue)  # Stale entry
+                continue
+            # Done once the start is consistent and nothing cheaper is queued
+            if key >= self._key(self.start) and self._rhs.get(
+                self.start, math.inf
+            ) == self._g.get(self.start, math.inf):
+                return True
+            if expanded >= budget:
+                return False
+            heapq.heappop(self._queue)
+            expanded += 1
+            self.expansions += 1
+            new = self._key(cell)
+            if key < new:
+                self._keys[cell] = new
+                heapq.heappush(self._queue, (new, cell))
+                continue
+            del self._keys[cell]
+            g, rhs = self._g.get(cell, math.inf), self._rhs.get(cell, math.inf)
+            x, y = cell
+            if g > rhs:
+                self._g[cell] = rhs
+                cost = self.cost(cell)
+                for dx, dy, length in _MOVES:
+                    near = (x + dx, y + dy)
+                    if near != self.goal and rhs + length * cost < self._rhs.get(
+                        near, math.inf
+                    ):
+                        self._rhs[near] = rhs + length * cost
+                        self._requeue(near)
+            else:
+                self._g.pop(cell, None)
+                self._update(cell)
+                for dx, dy, _ in _MOVES:
+                    self._update((x + dx, y + dy))
+        return True
+
+    def path(self, limit=MAX_PATH):
+        """Cells from the start to the goal, or None if there is no path"""
+        if self._g.get(self.start, math.inf) == math.inf:
+            return None
+        cells = [self.start]
+        seen = {self.start}
+        cell = self.start
+        while cell != self.goal and len(cells) < limit:
+            best, best_cost = None, math.inf
+            x, y = cell
+            for dx, dy, length in _MOVES:
+                near = (x + dx, y + dy)
+                total = self._g.get(near, math.inf) + length * self.cost(near)
+                if total < best_cost:
+                    best, best_cost = near, total
+            if best is None or best in seen:
+                return None
+            cell = best
+            cells.append(cell)
+            seen.add(cell)
+        return cells
+
+    def stats(self):
+        return {"cells": len(self._g), "queue": len(self._keys)}
+
+
+class GoToController:
+    """Fly to a point along a D* Lite path over the flight-height map
+
+    A thread runs CONTROL_RATE times a second for the whole session and
+    applies map changes to the cost map (at most MAX_TILES tiles a step),
+    so the cost map is current whenever a goal is given. While flying it
+    also repairs the search (at most MAX_EXPANSIONS expansions, so a step
+    has a bounded cost however large the map is) and steers at the
+    furthest path point in line of sight. Speed is limited to what can be
+    stopped in before the goal and every setpoint differs from the last
+    by at most MAX_ACCEL, so the commands are smooth. Setpoints are short
+    and renewed each step, so the drone stops if the thread stalls.
+    """
+
+    def __init__(self, frontiers, setpoints, speed=SPEED):
+        self.frontiers = frontiers
+        self.costs = CostMap(frontiers)
+        self.setpoints = setpoints
+        self.speed = speed
+        self.height = frontiers.height
+        self._pose = None  # Latest (x, y, z, yaw deg) in the map frame
+        self._request = None  # Goal (x, y) waiting for the control thread
+        self._goal = None
+        self._planner = None  # Set while flying to a goal
+        self._path = None  # (N, 2) waypoints
+        self._velocity = np.zeros(2)
+        self._no_path_since = None
+        self._lock = threading.Lock()  # Held for a whole control step
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.state = "idle"
+
+        self.goals = 0
+        self.goals_reached = 0
+        self.repairs = 0
+        self.expansions = RollingStats(capacity=256)
+        self.map_time = RollingStats(capacity=256)  # Cost map update (s)
+        self.replan_time = RollingStats(capacity=256)  # Search repair (s)
+
+    @property
+    def active(self):
+        return self._planner is not None or self._request is not None
+
+    def set_pose(self, x, y, z, yaw):
+        """Latest map-frame pose (runs on the radio thread)"""
+        self._pose = (x, y, z, yaw)
+
+    def start(self):
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="goto", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self.cancel()
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def go_to(self, x, y, height):
+        """Fly to (x, y) at height; replaces the current goal"""
+        with self._lock:
+            self.height = height
+            self.frontiers.set_height(height)
+            self._request = (x, y)
+
+    def cancel(self):
+        """Stop flying to the goal and hover; no setpoint follows this call"""
+        with self._lock:
+            if self.active:
+                self._finish("idle")
+
+    def path(self):
+        """Waypoints (N, 3) to the goal, or None"""
+        with self._lock:
+            path = self._path
+        if path is None:
+            return None
+        return np.hstack((path, np.full((len(path), 1), self.height)))
+
+    def _run(self):
+        period = 1.0 / CONTROL_RATE
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            with self._lock:
+                try:
+                    self._tick(time.monotonic())
+                except Exception as e:
+                    print(f"[ERROR] Go to stopped: {e}")
+                    self._finish("error")
+            deadline += period
+            if deadline < time.monotonic():
+                deadline = time.monotonic()  # Fell behind; don't burst
+            self._stop_event.wait(deadline - time.monotonic())
+
+    def _finish(self, state):
+        self._planner = self._request = self._path = None
+        self.state = state
+        self.setpoints.cancel()
+
+    def _tick(self, now):
+        begin = time.perf_counter()
+        changed = self.costs.update()
+        self.map_time.add(time.perf_counter() - begin)
+        if self._pose is None:
+            return
+        x, y, z, yaw = self._pose
+        xy = np.array((x, y))
+        start = self.costs.cell(xy)
+        if self._request is not None:
+            request, self._request = self._request, None
+            if not self._new_goal(request, start):
+                return
+        planner = self._planner
+        if planner is None:
+            return
+
+        begin = time.perf_counter()
+        if planner.start != start:
+            planner.move(start)
+        if changed:
+            planner.changed(changed)
+            self.repairs += 1
+        expansions = planner.expansions
+        complete = planner.compute(MAX_EXPANSIONS)
+        self.expansions.add(planner.expansions - expansions)
+        self.replan_time.add(time.perf_counter() - begin)
+
+        if complete:
+            cells = planner.path()
+            self._path = None if cells is None else self.costs.center(cells)
+            if cells is None:
+                if self._no_path_since is None:
+                    print("[WARNING] No path to the goal, waiting for the map")
+                    self._no_path_since = now
+                elif now - self._no_path_since > NO_PATH_TIMEOUT:
+                    print("[WARNING] Goal unreachable, hovering")
+                    self._finish("unreachable")
+                    return
+            else:
+                self._no_path_since = None
+
+        remaining = np.hypot(*(self._goal - xy))
+        if remaining < GOAL_TOLERANCE:
+            print(f"[INFO] Goal {self._goal.round(2)} reached")
+            self.goals_reached += 1
+            self._finish("reached")
+            return
+
+        target = np.zeros(2)
+        if self._path is not None and self._no_path_since is None:
+            target = self._steer(xy, remaining)
+        # Accelerate at most MAX_ACCEL towards the wanted velocity
+        change = target - self._velocity
+        limit = MAX_ACCEL / CONTROL_RATE
+        norm = np.hypot(*change)
+        if norm > limit:
+            change *= limit / norm
+        self._velocity += change
+
+        # Body frame: x forward, y left
+        vx, vy = self._velocity
+        c, s = math.cos(math.radians(yaw)), math.sin(math.radians(yaw))
+        vz = float(np.clip(HEIGHT_GAIN * (self.height - z), -MAX_VZ, MAX_VZ))
+        self.setpoints.submit(
+            c * vx + s * vy,
+            -s * vx + c * vy,
+            vz,
+            0.0,
+            duration=COMMAND_TIMEOUT,
+            mode="replace",
+        )
+
+    def _new_goal(self, request, start):
+        goal = self.costs.snap(self.costs.cell(request))
+        if goal is None and self.costs.pending():
+            self._request = request  # Try again once the cost map caught up
+            return False
+        if goal is None:
+            print(f"[WARNING] Goal {np.round(request, 2)} is not in open mapped space")
+            self._finish("rejected")
+            return False
+        self._goal = np.asarray(request, dtype=np.float64)
+        if goal != self.costs.cell(request):
+            self._goal = self.costs.center(goal)
+        if self._planner is None:
+            self._velocity[:] = 0.0
+        self._planner = DStarLite(self.costs.cost, start, goal)
+        self._path = None
+        self._no_path_since = None
+        self.goals += 1
+        self.state = "flying"
+        return True
+
+    def _steer(self, xy, remaining):
+        """Wanted velocity: towards the furthest path point in line of sight"""
+        path = self._path
+        ahead = min(len(path) - 1, int(LOOKAHEAD / self.costs.resolution))
+        while ahead > 1 and not self._visible(xy, path[ahead]):
+            ahead -= 1
+        target = self._goal if ahead == len(path) - 1 else path[ahead]
+        step = target - xy
+        length = np.hypot(*step)
+        if length < 1e-6:
+            return np.zeros(2)
+        # Slow enough to stop at the goal
+        speed = min(self.speed, math.sqrt(2.0 * MAX_ACCEL * remaining))
+        return step / length * speed
+
+    def _visible(self, a, b):
+        """No inflated or blocked cell on the segment a-b"""
+        steps = max(2, int(2 * np.hypot(*(b - a)) / self.costs.resolution))
+        for point in np.linspace(a, b, steps)[1:]:
+            if self.costs.cost(self.costs.cell(point)) > UNKNOWN_COST:
+                return False
+        return True
+
+    def stats(self):
+        planner = self._planner
+        return {
+            "state": self.state,
+            "goal": None if self._goal is None else self._goal.round(2).tolist(),
+            "goals": self.goals,
+            "goals_reached": self.goals_reached,
+            "repairs": self.repairs,
+            "map_cells": len(self.costs),
+            "pending_tiles": self.costs.pending(),
+            "search": planner.stats() if planner is not None else {},
+            "expansions": self.expansions.summary(),
+            "map_update_ms": self.map_time.summary(1000.0),
+            "replan_ms": self.replan_time.summary(1000.0),
+        }
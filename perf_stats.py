@@ -0,0 +1,105 @@
+import threading
+
+import numpy as np
+
+
+class RollingStats:
+    """Keep the most recent samples of a metric and summarize them"""
+
+    def __init__(self, capacity=4096):
+        self._samples = np.zeros(capacity, dtype=np.float64)
+        self._head = 0
+        self._filled = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            self._samples[self._head] = value
+            self._head = (self._head + 1) % len(self._samples)
+            self._filled = min(self._filled + 1, len(self._samples))
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def values(self):
+        with self._lock:
+            return self._samples[: self._filled].copy()
+
+    def summary(self, scale=1.0):
+        """Return count/mean/p50/p99/max, multiplied by scale (e.g. 1000 for ms)"""
+        recent = self.values()
+        if len(recent) == 0:
+            return {"count": 0, "mean": 0.0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+        p50, p99 = np.percentile(recent, (50, 99))
+        return {
+            "count": self.count,
+            "mean": self.total / self.count * scale,
+            "p50": float(p50) * scale,
+            "p99": float(p99) * scale,
+            "max": self.max * scale,
+        }
+
+
+class Histogram:
+    """Fixed-bin histogram with log-spaced edges (values in any unit)"""
+
+    def __init__(self, low=0.1, high=1000.0, bins=40):
+        self.edges = np.geomspace(low, high, bins + 1)
+        # One underflow bin in front and one overflow bin at the end
+        self.counts = np.zeros(bins + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        i = int(np.searchsorted(self.edges, value, side="right"))
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        """Approximate percentile (upper edge of the bin holding it)"""
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            cumulative = np.cumsum(self.counts)
+        i = int(np.searchsorted(cumulative, q / 100.0 * cumulative[-1]))
+        if i == 0:
+            return float(self.edges[0])
+        if i > len(self.edges) - 1:
+            return self.max
+        return float(self.edges[i])
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+    def format(self, unit="ms", width=40):
+        """Return a text bar chart of the non-empty bins"""
+        lines = []
+        with self._lock:
+            counts = self.counts.copy()
+        peak = counts.max() if counts.any() else 1
+        labels = (
+            [f"< {self.edges[0]:.3g}"]
+            + [f"{lo:.3g}-{hi:.3g}" for lo, hi in zip(self.edges[:-1], self.edges[1:])]
+            + [f">= {self.edges[-1]:.3g}"]
+        )
+        for label, count in zip(labels, counts):
+            if count:
+                bar = "#" * max(1, int(width * count / peak))
+                lines.append(f"  {label:>15} {unit} | {bar} {count}")
+        return "\n".join(lines)
@@ -0,0 +1,351 @@
+import heapq
+import threading
+import time
+
+import numpy as np
+
+from mapping import VOXEL_SIZE, height_colors, voxel_keys
+
+LOD_LEVELS = 6  # Finest level keeps one point per VOXEL_SIZE voxel
+NODE_CELLS = 16  # Voxels per node edge at every level (<= 4096 points per node)
+POINT_BUDGET = 300_000  # Default points shown per browser tab
+MAX_UPDATE_POINTS = 30_000  # Points sent to one client per publish()
+REBUILD_CHUNK = 20_000  # Points added per step when rebuilding in the background
+POINT_SIZE = 0.03
+
+
+class PointOctree:
+    """Multi-resolution point map for level-of-detail rendering
+
+    Level l keeps one representative point per voxel of size
+    voxel_size * 2 ** (levels - 1 - l), grouped into nodes of node_cells
+    voxels per edge, so a node at level l covers exactly 8 nodes at level
+    l + 1. Level 0 is the coarsest. Every node has a version that changes
+    when it gains points. Not thread-safe; add() and select() are called
+    from the render thread.
+    """
+
+    def __init__(self, voxel_size=VOXEL_SIZE, levels=LOD_LEVELS, node_cells=NODE_CELLS):
+        self.levels = levels
+        self.node_cells = node_cells
+        self.voxel_sizes = [voxel_size * 2 ** (levels - 1 - l) for l in range(levels)]
+        self.node_edges = [v * node_cells for v in self.voxel_sizes]
+        self._voxels = [set() for _ in range(levels)]
+        self._chunks = [{} for _ in range(levels)]  # node key -> point arrays
+        self._counts = [{} for _ in range(levels)]
+        self._versions = [{} for _ in range(levels)]
+        self._centers = [{} for _ in range(levels)]
+        self._children = [{} for _ in range(levels)]  # node key -> child keys
+
+    def __len__(self):
+        return len(self._voxels[-1])
+
+    @property
+    def node_count(self):
+        return sum(len(counts) for counts in self._counts)
+
+    def add(self, points):
+        """Insert points; returns the set of (level, node key) that changed"""
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        changed = set()
+        # Finest first: a voxel that is new at a coarse level is new at every
+        # finer level, so each level only needs the previous level's new points
+        for level in range(self.levels - 1, -1, -1):
+            if len(points) == 0:
+                break
+            points = self._add_level(level, points, changed)
+        return changed
+
+    def _add_level(self, level, points, changed):
+        keys = voxel_keys(np.floor(points / self.voxel_sizes[level]))
+        keys, first = np.unique(keys, return_index=True)
+        voxels = self._voxels[level]
+        fresh = np.fromiter(
+            (k not in voxels for k in keys.tolist()), dtype=bool, count=len(keys)
+        )
+        points = points[first[fresh]]
+        voxels.update(keys[fresh].tolist())
+        if len(points) == 0:
+            return points
+
+        node_idx = np.floor(points / self.node_edges[level]).astype(np.int64)
+        node_keys = voxel_keys(node_idx)
+        order = np.argsort(node_keys, kind="stable")
+        uniq, starts = np.unique(node_keys[order], return_index=True)
+        bounds = np.append(starts, len(order))
+        for i, key in enumerate(uniq.tolist()):
+            rows = order[bounds[i] : bounds[i + 1]]
+            if key not in self._counts[level]:
+                self._register(level, key, node_idx[rows[0]])
+            self._chunks[level][key].append(points[rows])
+            self._counts[level][key] += len(rows)
+            self._versions[level][key] += 1
+            changed.add((level, key))
+        return points
+
+    def _register(self, level, key, idx):
+        self._chunks[level][key] = []
+        self._counts[level][key] = 0
+        self._versions[level][key] = 0
+        self._centers[level][key] = (idx + 0.5) * self.node_edges[level]
+        self._children[level].setdefault(key, set())
+        if level > 0:
+            # Finer levels are filled first, so the parent may not exist yet
+            parent = int(voxel_keys((idx >> 1)[None])[0])
+            self._children[level - 1].setdefault(parent, set()).add(key)
+
+    def clear(self, step=REBUILD_CHUNK):
+        """Empty the octree a piece at a time
+
+        Freeing millions of keys in one go holds the GIL for a long time;
+        call it on a spare thread before dropping a large octree.
+        """
+        for table in (
+            self._voxels
+            + self._chunks
+            + self._counts
+            + self._versions
+            + self._centers
+            + self._children
+        ):
+            while table:
+                for _ in range(min(step, len(table))):
+                    table.pop() if isinstance(table, set) else table.popitem()
+
+    def count(self, node):
+        level, key = node
+        return self._counts[level].get(key, 0)
+
+    def version(self, node):
+        level, key = node
+        return self._versions[level][key]
+
+    def points(self, node):
+        """All points of a node as one (N, 3) array"""
+        level, key = node
+        chunks = self._chunks[level][key]
+        if len(chunks) > 1:
+            chunks[:] = [np.concatenate(chunks)]
+        return chunks[0]
+
+    def select(self, camera, budget):
+        """Pick nodes for a camera position within a point budget
+
+        Starts from the coarsest level and refines the node with the largest
+        apparent size (edge / distance) first, as long as swapping it for its
+        children keeps the total under budget. Returns {node: priority}.
+        """
+        camera = np.asarray(camera, dtype=np.float64)
+        selected = {}
+        heap = []
+        total = 0
+        for key in self._counts[0]:
+            node = (0, key)
+            priority = self._priority(node, camera)
+            selected[node] = priority
+            total += self._counts[0][key]
+            heapq.heappush(heap, (-priority, node))
+
+        while heap:
+            _, node = heapq.heappop(heap)
+            level, key = node
+            if level == self.levels - 1:
+                continue
+            children = [(level + 1, k) for k in self._children[level][key]]
+            extra = sum(self.count(c) for c in children) - self.count(node)
+            if total + extra > budget:
+                continue
+            total += extra
+            del selected[node]
+            for child in children:
+                priority = self._priority(child, camera)
+                selected[child] = priority
+                heapq.heappush(heap, (-priority, child))
+        return selected
+
+    def _priority(self, node, camera):
+        level, key = node
+        edge = self.node_edges[level]
+        distance = np.linalg.norm(self._centers[level][key] - camera)
+        return edge / max(distance, 0.5 * edge)
+
+
+class _ClientView:
+    """Nodes currently shown in one browser tab"""
+
+    def __init__(self, client, budget):
+        self.client = client
+        self.budget = client.gui.add_slider(
+            "Point budget (k)",
+            min=50,
+            max=3000,
+            step=50,
+            initial_value=budget // 1000,
+            hint="Map points drawn in this tab; lower it on a slow link",
+        )
+        self.handles = {}  # node -> point cloud handle
+        self.versions = {}  # node -> version sent
+        self.points = 0
+        self.pending = 0
+
+
+class LodStreamer:
+    """Stream a growing VoxelPointStore to each browser tab by level of detail
+
+    New store points go into a PointOctree. For every connected client the
+    nodes fitting its point budget are chosen around its camera, and only
+    nodes that are new or changed since they were sent go out, nearest
+    (largest on screen) first and at most max_update_points per call. Nodes
+    that left the selection are removed once everything selected has been
+    sent, so refining never leaves holes.
+
+    When the store is rewritten (a new generation, e.g. re-anchored after a
+    loop closure) a new octree is built on a background thread while the
+    old one stays on screen; once it is swapped in, its nodes replace the
+    shown ones in place at the same per-call limit.
+    """
+
+    def __init__(
+        self,
+        server,
+        name="/map/points",
+        voxel_size=VOXEL_SIZE,
+        budget=POINT_BUDGET,
+        max_update_points=MAX_UPDATE_POINTS,
+        point_size=POINT_SIZE,
+    ):
+        self.name = name
+        self.budget = budget
+        self.max_update_points = max_update_points
+        self.point_size = point_size
+        self.voxel_size = voxel_size
+        self.octree = PointOctree(voxel_size)
+        self._ingested = 0
+        self._generation = 0
+        self._rebuild = None  # Background octree build for a new generation
+        self._rebuilt = None  # (generation, octree, ingested) once it is done
+        self.rebuilds = 0
+        self.rebuild_time = 0.0  # Seconds the last rebuild took
+        self._views = {}
+        self._lock = threading.Lock()
+        self.points_sent = 0
+        server.on_client_connect(self._on_connect)
+        server.on_client_disconnect(self._on_disconnect)
+
+    def _on_connect(self, client):
+        view = _ClientView(client, self.budget)
+        with self._lock:
+            self._views[client.client_id] = view
+
+    def _on_disconnect(self, client):
+        with self._lock:
+            self._views.pop(client.client_id, None)
+
+    def publish(self, store):
+        """Ingest new store points and send each client its changed nodes"""
+        if self._rebuilt is not None:
+            self._swap(*self._rebuilt)
+        if store.generation != self._generation:
+            # Keep showing the old octree until the new one is built
+            if self._rebuild is None:
+                self._rebuild = threading.Thread(
+                    target=self._build, args=(store,), name="lod-rebuild", daemon=True
+                )
+                self._rebuild.start()
+        else:
+            count = len(store)
+            if count > self._ingested:
+                self.octree.add(store.slice(self._ingested, count))
+                self._ingested = count
+        with self._lock:
+            views = list(self._views.values())
+        for view in views:
+            try:
+                self._update(view)
+            except Exception as e:
+                # The tab may close while we are sending to it
+                print(f"[WARNING] Map update for client {view.client.client_id}: {e}")
+
+    def _build(self, store):
+        """Build an octree of the whole store (rebuild thread)"""
+        start = time.perf_counter()
+        while True:
+            generation = store.generation
+            count = len(store)
+            points = store.slice(0, count)
+            if store.generation == generation:
+                break  # Otherwise rewritten while slicing; take it again
+        octree = PointOctree(self.voxel_size)
+        # In chunks, so no single call holds the GIL long enough to stall
+        # the render thread
+        for i in range(0, len(points), REBUILD_CHUNK):
+            octree.add(points[i : i + REBUILD_CHUNK])
+        self.rebuild_time = time.perf_counter() - start
+        self._rebuilt = (generation, octree, count)
+
+    def _swap(self, generation, octree, ingested):
+        """Show a rebuilt octree (render thread)"""
+        self._rebuilt = self._rebuild = None
+        old, self.octree = self.octree, octree
+        threading.Thread(target=old.clear, name="lod-release", daemon=True).start()
+        del old
+        self._generation = generation
+        self._ingested = ingested
+        self.rebuilds += 1
+        with self._lock:
+            views = list(self._views.values())
+        for view in views:
+            # Every node is sent again and replaces the shown one by name;
+            # nodes the new octree does not select are removed after that
+            view.versions.clear()
+
+    def _update(self, view):
+        camera = view.client.camera.position
+        selected = self.octree.select(camera, view.budget.value * 1000)
+        pending = [
+            node
+            for node in selected
+            if view.versions.get(node) != self.octree.version(node)
+        ]
+        pending.sort(key=selected.get, reverse=True)
+
+        sent = 0
+        for i, node in enumerate(pending):
+            if sent >= self.max_update_points:
+                view.pending = len(pending) - i
+                break
+            points = self.octree.points(node)
+            level, key = node
+            view.handles[node] = view.client.scene.add_point_cloud(
+                f"{self.name}/L{level}/{key:x}",
+                points=points,
+                colors=height_colors(points[:, 2]),
+                # Coarse levels have sparser points, so draw them larger
+                point_size=self.point_size
+                * self.octree.voxel_sizes[level]
+                / self.octree.voxel_sizes[-1],
+            )
+            view.versions[node] = self.octree.version(node)
+            sent += len(points)
+        else:
+            view.pending = 0
+            for node in [n for n in view.handles if n not in selected]:
+                view.handles.pop(node).remove()
+                view.versions.pop(node, None)
+        self.points_sent += sent
+        view.points = sum(self.octree.count(n) for n in view.handles)
+
+    def stats(self):
+        with self._lock:
+            views = list(self._views.values())
+        return {
+            "points": len(self.octree),
+            "nodes": self.octree.node_count,
+            "clients": len(views),
+            "shown_points": max((v.points for v in views), default=0),
+            "pending_nodes": sum(v.pending for v in views),
+            "points_sent": self.points_sent,
+            "rebuilds": self.rebuilds,
+            "rebuilding": self._rebuild is not None,
+            "rebuild_ms": self.rebuild_time * 1000.0,
+        }
@@ -0,0 +1,699 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from perf_stats import RollingStats
+from scan_matching import (
+    KNOWN_LIKELIHOOD,
+    CorrelativeSearch,
+    LikelihoodField,
+    fill_scan_row,
+    rotate,
+    scan_points,
+    thin,
+)
+
+KEYFRAME_DISTANCE = 0.3  # Metres travelled before a new keyframe
+KEYFRAME_YAW = 20.0  # Degrees turned before a new keyframe
+KEYFRAME_SAMPLES = 100  # Samples of range data kept as a keyframe's scan
+
+# Edge noise (1 sigma). Odometry drift grows with the distance travelled;
+# scan-matched odometry and loop closures are bounded by the match accuracy
+ODOMETRY_SIGMA_XY = 0.05  # Metres per metre travelled
+ODOMETRY_SIGMA_YAW = 3.0  # Degrees per metre travelled
+MIN_SIGMA_XY = 0.01  # Metres
+MIN_SIGMA_YAW = 0.5  # Degrees
+SCAN_SIGMA_XY = 0.02
+SCAN_SIGMA_YAW = 0.5
+LOOP_SIGMA_XY = 0.05
+LOOP_SIGMA_YAW = 1.0
+
+# Loop closure: match a new keyframe's scan against the submap around an
+# older keyframe that is close in the current estimate
+LOOP_RADIUS = 1.0  # Metres between keyframes to try a closure
+LOOP_MIN_GAP = 30  # Keyframes between the two ends (~9 m of travel)
+LOOP_COOLDOWN = 3  # Keyframes between accepted closures
+LOOP_SUBMAP = 5  # Keyframes on each side of the old one in its submap
+LOOP_SEARCH_CELLS = 8  # +/- field cells (0.4 m)
+LOOP_SEARCH_YAW = 10.0  # +/- degrees
+LOOP_YAW_STEPS = 11
+LOOP_MIN_POINTS = 60  # Scan points needed to attempt a closure
+LOOP_MIN_SCORE = 0.5  # Mean likelihood of the matched scan
+LOOP_MIN_OVERLAP = 0.6  # Fraction of matched points on submap walls
+LOOP_MAX_SPREAD = 0.1  # Metres; wider match spread means no real constraint
+
+SOLVER_ITERATIONS = 5  # Gauss-Newton iterations per closure
+# Keyframes re-solved at most per closure (~90 m of travel); an older loop
+# end is held fixed with the rest, which bounds every solve
+MAX_WINDOW = 300
+SOLVER_TOLERANCE = 1e-4  # Stop once no pose moves more than this
+CAPACITY = 1024  # Initial keyframe capacity (grows by doubling)
+
+
+def wrap(angle):
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+def compose(a, b):
+    """a then b for 2D poses (..., 3) of x, y, yaw (radians)"""
+    c, s = np.cos(a[..., 2]), np.sin(a[..., 2])
+    return np.stack(
+        (
+            a[..., 0] + c * b[..., 0] - s * b[..., 1],
+            a[..., 1] + s * b[..., 0] + c * b[..., 1],
+            wrap(a[..., 2] + b[..., 2]),
+        ),
+        axis=-1,
+    )
+
+
+def inverse(a):
+    c, s = np.cos(a[..., 2]), np.sin(a[..., 2])
+    return np.stack(
+        (
+            -c * a[..., 0] - s * a[..., 1],
+            s * a[..., 0] - c * a[..., 1],
+            -a[..., 2],
+        ),
+        axis=-1,
+    )
+
+
+def between(a, b):
+    """Pose of b in the frame of a"""
+    return compose(inverse(a), b)
+
+
+def transform_points(pose, points):
+    """Apply one 2D pose (3,) to points (N, 2)"""
+    c, s = np.cos(pose[2]), np.sin(pose[2])
+    return points @ np.array([[c, s], [-s, c]]) + pose[:2]
+
+
+def solve_block_tridiagonal(diag, upper, rhs):
+    """Solve a symmetric block-tridiagonal system
+
+    diag (m, 3, 3) and upper (m - 1, 3, 3) hold the blocks (k, k) and
+    (k, k + 1); rhs is (m, 3, r). Block Thomas algorithm, O(m).
+    """
+    m = len(diag)
+    factors = np.empty((max(m - 1, 0), 3, 3))
+    reduced = np.empty_like(rhs)
+    for k in range(m):
+        d, r = diag[k], rhs[k]
+        if k:
+            lower = upper[k - 1].T
+            d = d - lower @ factors[k - 1]
+            r = r - lower @ reduced[k - 1]
+        d_inv = np.linalg.inv(d)
+        if k < m - 1:
+            factors[k] = d_inv @ upper[k]
+        reduced[k] = d_inv @ r
+    for k in range(m - 2, -1, -1):
+        reduced[k] -= factors[k] @ reduced[k + 1]
+    return reduced
+
+
+def optimize_window(poses, first, edges, iterations=SOLVER_ITERATIONS):
+    """Gauss-Newton over poses[first:] with every earlier pose held fixed
+
+    edges is (i, j, measurement (E, 3), information (E, 3, 3)) with i < j. Keyframes form a chain, so edges between neighbours give a
+    block-tridiagonal system; the few loop edges inside the window are
+    added as a low-rank update (Woodbury identity), and edges to fixed
+    poses only touch the diagonal. Each iteration is O(window size x
+    loops in it), independent of the poses before first.
+    Returns (poses, iterations run).
+    """
+    ei, ej, z, w = edges
+    keep = ej >= first
+    ei, ej, z, w = ei[keep], ej[keep], z[keep], w[keep]
+    x = poses.copy()
+    m = len(x) - first
+    li, lj = ei - first, ej - first
+    free = li >= 0
+    adjacent = free & (lj == li + 1)
+    loops = np.nonzero(free & (lj > li + 1))[0]
+
+    for iteration in range(1, iterations + 1):
+        pi, pj = x[ei], x[ej]
+        c, s = np.cos(pi[:, 2]), np.sin(pi[:, 2])
+        dx, dy = pj[:, 0] - pi[:, 0], pj[:, 1] - pi[:, 1]
+        e = np.stack(
+            (
+                c * dx + s * dy - z[:, 0],
+                -s * dx + c * dy - z[:, 1],
+                wrap(pj[:, 2] - pi[:, 2] - z[:, 2]),
+            ),
+            axis=1,
+        )
+        a = np.zeros((len(ei), 3, 3))
+        a[:, 0, 0], a[:, 0, 1], a[:, 0, 2] = -c, -s, -s * dx + c * dy
+        a[:, 1, 0], a[:, 1, 1], a[:, 1, 2] = s, -c, -c * dx - s * dy
+        a[:, 2, 2] = -1.0
+        b = np.zeros((len(ei), 3, 3))
+        b[:, 0, 0], b[:, 0, 1] = c, s
+        b[:, 1, 0], b[:, 1, 1] = -s, c
+        b[:, 2, 2] = 1.0
+        wa, wb = w @ a, w @ b
+
+        diag = np.zeros((m, 3, 3))
+        upper = np.zeros((max(m - 1, 0), 3, 3))
+        grad = np.zeros((m, 3))
+        chain = np.ones(len(ei), dtype=bool)
+        chain[loops] = False
+        np.add.at(diag, lj[chain], np.einsum("eki,ekj->eij", b, wb)[chain])
+        inner = chain & free
+        np.add.at(diag, li[inner], np.einsum("eki,ekj->eij", a, wa)[inner])
+        np.add.at(upper, li[adjacent], np.einsum("eki,ekj->eij", a, wb)[adjacent])
+        np.add.at(grad, lj, np.einsum("eki,ek->ei", wb, e))
+        np.add.at(grad, li[free], np.einsum("eki,ek->ei", wa, e)[free])
+
+        # H = T + U C U^T with U holding each loop edge's Jacobian blocks
+        u = np.zeros((m, 3, 3 * len(loops)))
+        for n, k in enumerate(loops):
+            u[li[k], :, 3 * n : 3 * n + 3] = a[k].T
+            u[lj[k], :, 3 * n : 3 * n + 3] = b[k].T
+        solved = solve_block_tridiagonal(
+            diag, upper, np.concatenate((-grad[:, :, None], u), axis=2)
+        )
+        step = solved[:, :, 0].reshape(-1)
+        if len(loops):
+            tu = solved[:, :, 1:].reshape(3 * m, -1)
+            flat = u.reshape(3 * m, -1)
+            small = flat.T @ tu
+            for n, k in enumerate(loops):
+                small[3 * n : 3 * n + 3, 3 * n : 3 * n + 3] += np.linalg.inv(w[k])
+            step = step - tu @ np.linalg.solve(small, flat.T @ step)
+        step = step.reshape(m, 3)
+        x[first:] += step
+        x[first:, 2] = wrap(x[first:, 2])
+        if np.abs(step).max() < SOLVER_TOLERANCE:
+            break
+    return x, iteration
+
+
+class KeyframeIndex:
+    """Spatial hash of keyframe positions for loop-closure candidates"""
+
+    def __init__(self, cell=LOOP_RADIUS):
+        self.cell = cell
+        self._cells = {}  # (cx, cy) -> set of keyframe ids
+        self._where = {}  # keyframe id -> (cx, cy)
+
+    def __len__(self):
+        return len(self._where)
+
+    def _key(self, xy):
+        return int(np.floor(xy[0] / self.cell)), int(np.floor(xy[1] / self.cell))
+
+    def move(self, keyframe, xy):
+        """Insert a keyframe or move it to a new position"""
+        key = self._key(xy)
+        old = self._where.get(keyframe)
+        if old == key:
+            return
+        if old is not None:
+            self._cells[old].discard(keyframe)
+        self._cells.setdefault(key, set()).add(keyframe)
+        self._where[keyframe] = key
+
+    def near(self, xy, radius):
+        """Keyframe ids in the cells within radius of xy"""
+        reach = int(np.ceil(radius / self.cell))
+        cx, cy = self._key(xy)
+        found = []
+        for x in range(cx - reach, cx + reach + 1):
+            for y in range(cy - reach, cy + reach + 1):
+                found.extend(self._cells.get((x, y), ()))
+        return found
+
+
+class PoseGraph:
+    """Keyframe pose graph with loop closure on top of the odometry
+
+    The log callback feeds every (scan-matched) pose; a keyframe is made
+    every KEYFRAME_DISTANCE or KEYFRAME_YAW, linked to the previous one by
+    an odometry edge (raw state estimate) and, when the scan matcher
+    matched in between, a scan-match edge. A worker thread turns each
+    keyframe's last ranges into a local scan, looks for older keyframes
+    nearby through a KeyframeIndex and matches the scan against their
+    submap. An accepted closure adds an edge and re-optimizes only the
+    keyframes since the older end (optimize_window).
+
+    Map data is tagged with the keyframe it was seen from. take_update()
+    hands the render thread the per-keyframe corrections since the last
+    call, to move points and trajectory in bulk, and switches the live
+    correction (correct_record) at the same time. MapAnchor makes that
+    switch fall between two stored records (see MapAnchor.records).
+    """
+
+    def __init__(self, scan_matcher=None, capacity=CAPACITY):
+        self.scan_matcher = scan_matcher
+        self._odom = np.zeros((capacity, 3))  # Pose fed in (scan-matched)
+        self._raw = np.zeros((capacity, 3))  # Raw state estimate
+        self._est = np.zeros((capacity, 3))  # Optimized
+        self._anchored = np.zeros((capacity, 3))  # What the map data reflects
+        self._z = np.zeros(capacity)
+        self._stamps = np.zeros(capacity)
+        self._count = 0
+        self._scans = {}  # keyframe id -> local scan points (N, 2)
+        self._edges = []  # (i, j, measurement (3,), information (3,), kind)
+        self._edges_to = {}  # j -> its edges, so a solve gathers only its window
+        self._edge_counts = {"odometry": 0, "scan": 0, "loop": 0}
+        self._correction = np.zeros(3)  # Live correction (anchored frame)
+        self._dirty_from = None  # First keyframe moved since take_update()
+        self._matched = 0  # Scan matcher count at the last keyframe
+        self.tag = -1  # Latest keyframe, for tagging map data
+        self.index = KeyframeIndex()
+        self.search = CorrelativeSearch(
+            cells=LOOP_SEARCH_CELLS, yaw=LOOP_SEARCH_YAW, yaw_steps=LOOP_YAW_STEPS
+        )
+        self._rows = np.zeros((KEYFRAME_SAMPLES, 12))
+        self._head = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._last_loop = -LOOP_COOLDOWN
+
+        self.closures = 0
+        self.rejected = 0
+        self.window = 0
+        self.solve_time = RollingStats(capacity=256)
+        self.match_time = RollingStats(capacity=256)
+
+    def __len__(self):
+        return self._count
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="pose-graph", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def add_sample(self, timestamp, data, raw):
+        """Feed one log record (runs on the radio thread)
+
+        data carries the pose the graph builds on (scan-matched when a
+        scan matcher runs), raw the uncorrected state estimate.
+        """
+        fill_scan_row(self._rows[self._head], data)
+        self._head = (self._head + 1) % len(self._rows)
+        odom = np.array(
+            (
+                data.get("stateEstimate.x", 0),
+                data.get("stateEstimate.y", 0),
+                np.radians(data.get("stabilizer.yaw", 0)),
+            )
+        )
+        n = self._count
+        if n:
+            step = between(self._odom[n - 1], odom)
+            if (
+                np.hypot(step[0], step[1]) < KEYFRAME_DISTANCE
+                and abs(np.degrees(step[2])) < KEYFRAME_YAW
+            ):
+                return
+        raw_pose = np.array(
+            (
+                raw.get("stateEstimate.x", 0),
+                raw.get("stateEstimate.y", 0),
+                np.radians(raw.get("stabilizer.yaw", 0)),
+            )
+        )
+        self._add_keyframe(timestamp, odom, raw_pose, data.get("stateEstimate.z", 0))
+
+    def _add_keyframe(self, timestamp, odom, raw, z):
+        with self._lock:
+            k = self._count
+            if k == len(self._odom):
+                self._grow()
+            self._odom[k], self._raw[k] = odom, raw
+            self._z[k], self._stamps[k] = z, timestamp
+            self._anchored[k] = compose(self._correction, odom)
+            if k == 0:
+                self._est[k] = self._anchored[k]
+            else:
+                # Chain from the previous estimate, so keyframes made while
+                # a correction is pending follow it
+                step = between(self._odom[k - 1], odom)
+                self._est[k] = compose(self._est[k - 1], step)
+                self._add_edge(
+                    (
+                        k - 1,
+                        k,
+                        between(self._raw[k - 1], raw),
+                        *self._odometry_info(step),
+                    )
+                )
+                matched = self.scan_matcher.matched if self.scan_matcher else 0
+                if matched != self._matched:
+                    self._matched = matched
+                    self._add_edge(
+                        (
+                            k - 1,
+                            k,
+                            step,
+                            _information(SCAN_SIGMA_XY, SCAN_SIGMA_YAW),
+                            "scan",
+                        )
+                    )
+            self._count = k + 1
+            self.tag = k
+        rows = np.roll(self._rows, -self._head, axis=0)  # Chronological
+        self._queue.put((k, rows))
+
+    @staticmethod
+    def _odometry_info(step):
+        distance = np.hypot(step[0], step[1])
+        return (
+            _information(
+                max(ODOMETRY_SIGMA_XY * distance, MIN_SIGMA_XY),
+                max(ODOMETRY_SIGMA_YAW * distance, MIN_SIGMA_YAW),
+            ),
+            "odometry",
+        )
+
+    def _add_edge(self, edge):
+        """Record an edge (i, j, ...) with i < j; call with the lock held"""
+        self._edges.append(edge)
+        self._edges_to.setdefault(edge[1], []).append(edge)
+        self._edge_counts[edge[4]] += 1
+
+    def _grow(self):
+        for name in ("_odom", "_raw", "_est", "_anchored", "_z", "_stamps"):
+            old = getattr(self, name)
+            grown = np.zeros((2 * len(old),) + old.shape[1:])
+            grown[: len(old)] = old
+            setattr(self, name, grown)
+
+    def correction(self):
+        """Live (x, y, yaw rad) correction from the input frame to the map"""
+        with self._lock:
+            return self._correction.copy()
+
+    def correct_record(self, data):
+        """Copy of a log record with the pose moved into the map frame"""
+        correction = self.correction()
+        pose = compose(
+            correction,
+            np.array(
+                (
+                    data.get("stateEstimate.x", 0),
+                    data.get("stateEstimate.y", 0),
+                    np.radians(data.get("stabilizer.yaw", 0)),
+                )
+            ),
+        )
+        corrected = dict(data)
+        corrected["stateEstimate.x"] = pose[0]
+        corrected["stateEstimate.y"] = pose[1]
+        corrected["stabilizer.yaw"] = data.get("stabilizer.yaw", 0) + np.degrees(
+            correction[2]
+        )
+        return corrected
+
+    def take_update(self):
+        """Corrections since the last call, or None (render thread)
+
+        Returns (first keyframe, keyframe stamps, deltas (K, 3)): delta k
+        moves data tagged first + k from where it was drawn to where it
+        belongs. The live correction switches at the same time.
+        """
+        with self._lock:
+            first = self._dirty_from
+            if first is None:
+                return None
+            self._dirty_from = None
+            n = self._count
+            deltas = compose(self._est[first:n], inverse(self._anchored[first:n]))
+            self._anchored[first:n] = self._est[first:n]
+            self._correction = compose(self._est[n - 1], inverse(self._odom[n - 1]))
+            return first, self._stamps[first:n].copy(), deltas
+
+    def positions(self):
+        """Anchored keyframe positions (N, 3), matching the map data"""
+        with self._lock:
+            n = self._count
+            return np.column_stack((self._anchored[:n, :2], self._z[:n]))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            k, rows = item
+            try:
+                self._process(k, rows)
+            except Exception as e:
+                print(f"[ERROR] Pose graph keyframe {k}: {e}")
+
+    def _process(self, k, rows):
+        with self._lock:
+            odom, est = self._odom[k].copy(), self._est[k].copy()
+        # Scan in the keyframe frame, from the poses the graph was fed
+        scan = transform_points(inverse(odom), scan_points(rows))
+        self._scans[k] = thin(scan, self.search.resolution / 2)
+        self.index.move(k, est[:2])
+        if len(scan) >= LOOP_MIN_POINTS and k - self._last_loop >= LOOP_COOLDOWN:
+            self._close_loop(k)
+
+    def _close_loop(self, k):
+        with self._lock:
+            est = self._est[: self._count].copy()
+        candidates = [
+            c
+            for c in self.index.near(est[k, :2], LOOP_RADIUS)
+            if c <= k - LOOP_MIN_GAP
+            and np.hypot(*(est[c, :2] - est[k, :2])) <= LOOP_RADIUS
+        ]
+        if not candidates:
+            return
+        c = min(candidates, key=lambda i: np.hypot(*(est[i, :2] - est[k, :2])))
+
+        # Submap to submap: one keyframe's scan spans too little travel to
+        # pin down yaw, so the last LOOP_SUBMAP keyframes are matched together
+        start = time.perf_counter()
+        field = LikelihoodField()
+        field.add(self._submap(est, c, range(c - LOOP_SUBMAP, c + LOOP_SUBMAP + 1)))
+        guess = between(est[c], est[k])
+        points = thin(
+            transform_points(
+                guess, self._submap(est, k, range(k - LOOP_SUBMAP, k + 1))
+            ),
+            self.search.resolution / 2,
+        )
+        d_yaw, d_xy, score, covariance = self.search.search(field, points, guess[:2])
+        moved = rotate(points, d_yaw, guess[:2]) + d_xy
+        overlap = (field.values(moved) > KNOWN_LIKELIHOOD).mean()
+        self.match_time.add(time.perf_counter() - start)
+        # A corridor or a single wall pins the match in one direction only
+        if (
+            score < LOOP_MIN_SCORE
+            or overlap < LOOP_MIN_OVERLAP
+            or np.linalg.eigvalsh(covariance[:2, :2]).max() > LOOP_MAX_SPREAD**2
+        ):
+            self.rejected += 1
+            return
+
+        # The scan was rotated about the keyframe position, then shifted
+        measured = np.array(
+            (guess[0] + d_xy[0], guess[1] + d_xy[1], wrap(guess[2] + d_yaw))
+        )
+        # Weighted by how well the match pinned each direction down
+        information = np.linalg.inv(
+            covariance + np.linalg.inv(_information(LOOP_SIGMA_XY, LOOP_SIGMA_YAW))
+        )
+        with self._lock:
+            self._add_edge((c, k, measured, information, "loop"))
+        self._last_loop = k
+        self.closures += 1
+        self._optimize(max(c + 1, k + 1 - MAX_WINDOW))
+
+    def _submap(self, est, frame, keyframes):
+        """Scans of the given keyframes (N, 2) in the frame of one of them"""
+        scans = [
+            transform_points(between(est[frame], est[i]), self._scans[i])
+            for i in keyframes
+            if i in self._scans
+        ]
+        return np.concatenate(scans) if scans else np.zeros((0, 2))
+
+    def _optimize(self, first):
+        start = time.perf_counter()
+        with self._lock:
+            n = self._count
+            # Only edges into the window matter, and of the fixed poses only
+            # those they reach back to; they go first in a compact array
+            edges = [e for j in range(first, n) for e in self._edges_to.get(j, ())]
+            fixed = sorted({e[0] for e in edges if e[0] < first})
+            poses = np.concatenate(
+                (self._est[fixed].reshape(-1, 3), self._est[first:n])
+            )
+        compact = {i: k for k, i in enumerate(fixed)}
+        offset = len(fixed) - first
+        arrays = (
+            np.array([compact.get(e[0], e[0] + offset) for e in edges], dtype=np.int64),
+            np.array([e[1] + offset for e in edges], dtype=np.int64),
+            np.array([e[2] for e in edges]).reshape(-1, 3),
+            np.array([e[3] for e in edges]).reshape(-1, 3, 3),
+        )
+        solved, _ = optimize_window(poses, len(fixed), arrays)
+        solved, poses = solved[len(fixed) :], poses[len(fixed) :]
+        with self._lock:
+            self._est[first:n] = solved
+            # Keyframes added during the solve follow the last one solved
+            latest = self._count
+            if latest > n:
+                delta = compose(solved[-1], inverse(poses[-1]))
+                self._est[n:latest] = compose(delta, self._est[n:latest])
+            self._dirty_from = (
+                first if self._dirty_from is None else min(first, self._dirty_from)
+            )
+            moved = self._est[first:latest].copy()
+        for i, pose in enumerate(moved):
+            self.index.move(first + i, pose[:2])
+        self.window = n - first
+        self.solve_time.add(time.perf_counter() - start)
+
+    def trajectory(self):
+        """Optimized keyframe poses (N, 3) and edges, for drawing the graph"""
+        with self._lock:
+            return self._est[: self._count].copy(), list(self._edges)
+
+    def stats(self):
+        solve = self.solve_time.summary(1000.0)
+        match = self.match_time.summary(1000.0)
+        with self._lock:
+            counts = dict(self._edge_counts)
+        return {
+            "keyframes": self._count,
+            "odometry_edges": counts["odometry"],
+            "scan_edges": counts["scan"],
+            "loop_edges": counts["loop"],
+            "closures": self.closures,
+            "rejected": self.rejected,
+            "last_window": self.window,
+            "solve_p50_ms": solve["p50"],
+            "solve_max_ms": solve["max"],
+            "loop_match_p50_ms": match["p50"],
+        }
+
+
+def _information(sigma_xy, sigma_yaw_deg):
+    """Information matrix (3, 3) for independent x, y and yaw noise"""
+    return np.diag((sigma_xy**-2, sigma_xy**-2, np.radians(sigma_yaw_deg) ** -2))
+
+
+class MapAnchor:
+    """Apply pose-graph corrections to the stored map and trajectory
+
+    apply() runs on the render thread: points and trajectory poses are
+    moved in one vectorized pass each, by the correction of the keyframe
+    they belong to (tag for points, timestamp for poses). The occupancy
+    grid cannot be moved cell by cell, so it is rebuilt in the background
+    from the re-anchored points, with rays from their keyframes.
+
+    The log callback holds records from correct_record() until the record
+    is in the trajectory and the mapping batch. apply() takes it to switch
+    the correction, flush the rows still batched and move the trajectory,
+    so everything corrected the old way is moved exactly once and nothing
+    corrected the new way is. Points only reach the store in flush() on
+    the render thread, so they are moved after the lock is released.
+    """
+
+    def __init__(self, graph, store, trajectory=None, occupancy=None, mapping=None):
+        self.graph = graph
+        self.store = store
+        self.trajectory = trajectory
+        self.occupancy = occupancy
+        self.mapping = mapping
+        self.records = threading.Lock()
+        self._rebuild = threading.Event()
+        self._thread = None
+        self.updates = 0
+        self.last_apply_ms = 0.0
+        self.last_rebuild_ms = 0.0
+        self.rebuilds = 0
+
+    def apply(self):
+        """Take and apply any pending correction; returns True if one was"""
+        with self.records:
+            update = self.graph.take_update()
+            if update is None:
+                return False
+            start = time.perf_counter()
+            first, stamps, deltas = update
+            if self.mapping is not None:
+                self.mapping.flush()  # Rows corrected the old way
+            if self.trajectory is not None:
+
+                def move_poses(timestamps, positions):
+                    rows = np.searchsorted(stamps, timestamps, side="right") - 1
+                    moved = rows >= 0
+                    return _apply_deltas(positions, deltas[rows[moved]], moved)
+
+                self.trajectory.remap(move_poses)
+
+        def move_points(points, tags):
+            rows = tags - first
+            moved = (rows >= 0) & (rows < len(deltas))
+            return _apply_deltas(points, deltas[rows[moved]], moved)
+
+        self.store.remap(move_points)
+        self.updates += 1
+        self.last_apply_ms = (time.perf_counter() - start) * 1000.0
+        if self.occupancy is not None:
+            self._start_rebuild()
+        return True
+
+    def _start_rebuild(self):
+        self._rebuild.set()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._rebuild_loop, name="occupancy-rebuild", daemon=True
+            )
+            self._thread.start()
+
+    def _rebuild_loop(self):
+        # Corrections that arrive during a rebuild are folded into one more
+        while self._rebuild.is_set():
+            self._rebuild.clear()
+            start = time.perf_counter()
+            points, tags = self.store.tagged()
+            keyframes = self.graph.positions()
+            # Untagged points come from a saved map, whose blocks the rebuild
+            # starts from; replaying them would count their hits twice
+            tagged = (tags >= 0) & (tags < len(keyframes))
+            points = points[tagged]
+            origins = keyframes[tags[tagged]]
+            self.occupancy.rebuild(origins, points, np.ones(len(points), dtype=bool))
+            self.rebuilds += 1
+            self.last_rebuild_ms = (time.perf_counter() - start) * 1000.0
+
+    def stats(self):
+        return {
+            "updates": self.updates,
+            "apply_ms": self.last_apply_ms,
+            "occupancy_rebuilds": self.rebuilds,
+            "rebuild_ms": self.last_rebuild_ms,
+        }
+
+
+def _apply_deltas(points, deltas, mask):
+    """Copy of points (N, 3) with the rows in mask moved by 2D deltas"""
+    points = np.array(points, dtype=np.float64)
+    c, s = np.cos(deltas[:, 2]), np.sin(deltas[:, 2])
+    x, y = points[mask, 0], points[mask, 1]
+    points[mask, 0] = c * x - s * y + deltas[:, 0]
+    points[mask, 1] = s * x + c * y + deltas[:, 1]
+    return points
@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+POSE_CAPACITY = 60000  # ~10 min at 100 Hz
+POSE_COLUMNS = ("x", "y", "z", "roll", "pitch", "yaw", "front")
+LOOKUP_TOLERANCE = 0.05  # Seconds a lookup may fall outside the stored span
+
+
+class ClockSync:
+    """Map drone log timestamps (ms since boot) to host wall-clock seconds
+
+    Each packet gives receive_time - drone_time = offset + link delay. The
+    smallest value over a sliding window is the packet with the least delay,
+    so it is used as the offset; the window lets it follow clock drift.
+    """
+
+    def __init__(self, window=500):
+        self.window = window
+        self._samples = deque()  # (index, offset), increasing offsets
+        self._index = 0
+        self.offset = None
+
+    def update(self, drone_ms, host_time=None):
+        """Feed one packet and return its time on the host clock"""
+        host_time = time.time() if host_time is None else host_time
+        offset = host_time - drone_ms / 1000.0
+        # Monotonic deque: O(1) amortized sliding-window minimum
+        samples = self._samples
+        while samples and samples[-1][1] >= offset:
+            samples.pop()
+        samples.append((self._index, offset))
+        if samples[0][0] <= self._index - self.window:
+            samples.popleft()
+        self._index += 1
+        self.offset = samples[0][1]
+        return drone_ms / 1000.0 + self.offset
+
+    def to_host(self, drone_ms):
+        return drone_ms / 1000.0 + self.offset
+
+
+class PoseHistory:
+    """Thread-safe, time-indexed pose history with interpolated lookup
+
+    Timestamps are kept in one contiguous, sorted array (twice the capacity,
+    compacted when the end is reached), so lookups are a binary search.
+    Rows hold POSE_COLUMNS: position (m), roll/pitch/yaw as logged (deg)
+    and the front range (m, NaN when there is no return).
+    """
+
+    def __init__(self, capacity=POSE_CAPACITY):
+        self.capacity = int(capacity)
+        self._times = np.zeros(2 * self.capacity, dtype=np.float64)
+        self._poses = np.zeros((2 * self.capacity, len(POSE_COLUMNS)), dtype=np.float64)
+        self._start = 0
+        self._end = 0
+        self._lock = threading.Lock()
+        self.out_of_order = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def append(self, t, pose):
+        """Store one pose row at host time t (O(1) amortized)"""
+        with self._lock:
+            if self._end > self._start and t < self._times[self._end - 1]:
+                self.out_of_order += 1
+                return
+            if self._end == len(self._times):
+                # Move the newest capacity - 1 rows to the front
+                keep = self.capacity - 1
+                self._times[:keep] = self._times[self._end - keep : self._end]
+                self._poses[:keep] = self._poses[self._end - keep : self._end]
+                self._start, self._end = 0, keep
+            self._times[self._end] = t
+            self._poses[self._end] = pose
+            self._end += 1
+            if self._end - self._start > self.capacity:
+                self._start += 1
+
+    def span(self):
+        """(oldest, newest) stored time, or None when empty"""
+        with self._lock:
+            if self._end == self._start:
+                return None
+            return self._times[self._start], self._times[self._end - 1]
+
+    def lookup(self, t, tolerance=LOOKUP_TOLERANCE):
+        """Interpolated pose at time t, or None outside the stored span"""
+        poses = self.lookup_many(np.array([t], dtype=np.float64), tolerance)
+        return None if np.isnan(poses[0, 0]) else poses[0]
+
+    def lookup_many(self, times, tolerance=LOOKUP_TOLERANCE):
+        """Interpolated poses (N, len(POSE_COLUMNS)); NaN rows where unknown"""
+        times = np.asarray(times, dtype=np.float64)
+        out = np.full((len(times), len(POSE_COLUMNS)), np.nan)
+        with self._lock:
+            ts = self._times[self._start : self._end]
+            poses = self._poses[self._start : self._end]
+            if len(ts) == 0:
+                return out
+            known = (times >= ts[0] - tolerance) & (times <= ts[-1] + tolerance)
+            t = np.clip(times[known], ts[0], ts[-1])
+            hi = np.clip(np.searchsorted(ts, t), 1, max(len(ts) - 1, 1))
+            lo = hi - 1 if len(ts) > 1 else hi * 0
+            a, b = poses[lo], poses[hi]
+            span = ts[hi] - ts[lo]
+            offset = t - ts[lo]
+        w = np.divide(offset, span, out=np.zeros_like(t), where=span > 0)[:, None]
+        result = a + (b - a) * w
+        # Angles interpolate along the shortest way round
+        angles = slice(3, 6)
+        delta = (b[:, angles] - a[:, angles] + 180.0) % 360.0 - 180.0
+        result[:, angles] = a[:, angles] + delta * w
+        out[known] = result
+        return out
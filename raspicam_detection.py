@@ -1,9 +1,16 @@
-from ultralytics import YOLO
 from picamera2 import Picamera2
 import cv2, os
 
+from inference_backend import DetectorBackend
+from camera_pipeline import CaptureStage, InferenceWorker, PipelineStats
+
 os.system('clear')
-model = YOLO("yolo_models/yolo11n.pt")  # use smallest model
+# YOLO_BACKEND=onnx or openvino runs an exported copy of the model (cached in
+# yolo_models/exports); YOLO_INT8=1 uses an int8 quantized export
+BACKEND = os.environ.get("YOLO_BACKEND", "torch")
+INT8 = os.environ.get("YOLO_INT8", "0") == "1"
+detector = DetectorBackend(BACKEND, imgsz=256, int8=INT8,
+                           model_path="yolo_models/yolo11n.pt").load()  # smallest model
 
 picam2 = Picamera2()
 config = picam2.create_preview_configuration(
@@ -13,21 +20,32 @@ config = picam2.create_preview_configuration(
 picam2.configure(config)
 picam2.start()
 
-frame_count = 0
-skip_frames = 2
+# Capture and inference run on their own threads and only ever hand over the
+# newest frame; the display loop draws the latest detections on live frames.
+capture = CaptureStage(picam2.capture_array).start()
+inference = InferenceWorker(detector, capture.frames).start()
+stats = PipelineStats(capture, inference)
 
+seq = 0
 while True:
-    # Capture low-res for inference
-    image = picam2.capture_array()
-    # image_convert = cv2.cvtColor(image, cv2.COLOR_YUV420p2RGB)
+    seq, frame = capture.frames.wait_newer(seq, timeout=1.0)
+    if frame is None:
+        continue
 
-    if frame_count % skip_frames == 0:
-        annotated_frame = model(image, imgsz=256, verbose=False)[0].plot()
+    _, detection = inference.results.latest()
+    if detection is not None:
+        detected_frame, result = detection
+        shown = result.plot(img=frame.image.copy())
+    else:
+        detected_frame, shown = None, frame.image
 
-    cv2.imshow("Frame", annotated_frame if 'annotated_frame' in locals() else image)
+    cv2.imshow("Frame", shown)
+    stats.displayed(frame, detected_frame)
+    stats.maybe_print()
     if cv2.waitKey(1) & 0xFF == ord("q"):
         break
-    frame_count += 1
 
+inference.stop()
+capture.stop()
 picam2.stop()
 cv2.destroyAllWindows()
@@ -1,48 +1,145 @@
-from ultralytics import YOLO
-from picamera2 import Picamera2
-import cv2, os
-from flask import Flask, Response
+import time
+START = time.perf_counter()  # Reference for the startup timings
+
+import os, threading
+from flask import Flask, Response, jsonify, request
+
+from inference_backend import DetectorBackend
+from camera_pipeline import (CaptureStage, InferenceWorker, MjpegHub, PipelineStats,
+                             ServiceStartup)
+
+# Model, camera and OpenCV are loaded on a startup thread so the HTTP server
+# answers right away; /health reports when the stream is ready
 
 os.system("clear")
-model = YOLO("yolo_models/yolo11n.pt")  # smallest model for speed
+# YOLO_BACKEND=onnx or openvino runs an exported copy of the model (cached in
+# yolo_models/exports); YOLO_INT8=1 uses an int8 quantized export
+BACKEND = os.environ.get("YOLO_BACKEND", "torch")
+INT8 = os.environ.get("YOLO_INT8", "0") == "1"
+# INFERENCE_MAX_BUSY=0.8 caps inference at that share of wall time, leaving
+# CPU for capture and JPEG encoding when many viewers are connected
+MAX_BUSY = float(os.environ.get("INFERENCE_MAX_BUSY", "1.0"))
+FRAME_SIZE = (640, 480)
+WARMUP_RUNS = 2
 
 # Flask app
 app = Flask(__name__)
+startup = ServiceStartup(START)
+pipeline = {}  # capture, inference, hub and stats once started
+
+def load_model():
+    detector = DetectorBackend(BACKEND, imgsz=320, int8=INT8,
+                               model_path="yolo_models/yolo11n.pt").load()  # smallest model
+    # Take the first-inference allocation / JIT cost before anyone is watching
+    detector.warmup(WARMUP_RUNS, shape=(FRAME_SIZE[1], FRAME_SIZE[0], 3))
+    return detector
 
-# Pi Camera setup
-picam2 = Picamera2()
-config = picam2.create_preview_configuration(
-    main={"format": "RGB888", "size": (640, 480)}
-)
-picam2.configure(config)
-picam2.start()
+def start_camera():
+    from picamera2 import Picamera2
+    import cv2  # Import OpenCV here too, in parallel with the model
+    # Pi Camera setup
+    picam2 = Picamera2()
+    config = picam2.create_preview_configuration(
+        main={"format": "RGB888", "size": FRAME_SIZE}
+    )
+    picam2.configure(config)
+    picam2.start()
+    return picam2
 
-frame_count = 0
-skip_frames = 2
+def annotate(frame, detection):
+    # Draw the latest detections on the live frame
+    if detection is None:
+        return frame.image
+    _, result = detection
+    return result.plot(img=frame.image.copy())
 
-def generate_frames():
-    global frame_count
-    while True:
-        image = picam2.capture_array()
+def encode(image, quality):
+    import cv2
+    # quality is a camera_pipeline.QualityLevel picked per client
+    if quality.scale != 1.0:
+        image = cv2.resize(image, None, fx=quality.scale, fy=quality.scale,
+                           interpolation=cv2.INTER_AREA)
+    ret, buffer = cv2.imencode('.jpg', image,
+                               [cv2.IMWRITE_JPEG_QUALITY, quality.jpeg_quality])
+    return buffer.tobytes()
 
-        if frame_count % skip_frames == 0:
-            results = model(image, imgsz=320, verbose=False)
-            annotated_frame = results[0].plot()
-        frame_count += 1
+def start_pipeline():
+    try:
+        loaded = startup.run_parallel({"model": load_model, "camera": start_camera})
+        # One producer for every viewer: capture, inference and JPEG encoding
+        # each happen once per frame, however many clients are connected
+        with startup.phase("pipeline"):
+            capture = CaptureStage(loaded["camera"].capture_array).start()
+            inference = InferenceWorker(loaded["model"], capture.frames,
+                                        max_busy=MAX_BUSY).start()
+            pipeline["capture"] = capture
+            pipeline["inference"] = inference
+            pipeline["hub"] = MjpegHub(capture, inference, annotate, encode).start()
+            pipeline["stats"] = PipelineStats(capture, inference)
+        # Ready means a detection exists, so /video and /detections have
+        # something to serve as soon as /health says 200
+        inference.results.wait_newer(0)
+        print(f"[INFO] First annotated frame after {startup.mark('first_frame'):.2f} s")
+        startup.ready.set()
+        print(f"[INFO] Ready after {startup.mark('ready'):.2f} s")
+    except Exception as e:
+        startup.error = e
+        print(f"[ERROR] Startup failed: {e}")
 
-        # Encode frame as JPEG
-        ret, buffer = cv2.imencode('.jpg', annotated_frame if 'annotated_frame' in locals() else image)
-        frame = buffer.tobytes()
+def not_ready():
+    return jsonify(startup.status()), 503, {"Retry-After": "1"}
 
-        # Yield frame in multipart format for MJPEG
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+@app.route('/health')
+def health():
+    # 200 once the model is warm and the first frame has been through
+    # inference, 503 until then
+    if not startup.ready.is_set():
+        return not_ready()
+    return jsonify(startup.status())
 
 @app.route('/video')
 def video():
-    return Response(generate_frames(),
+    if not startup.ready.is_set():
+        return not_ready()
+    # /video?adaptive=1 lowers quality, size and frame rate on a slow link
+    adaptive = request.args.get('adaptive', '0') == '1'
+    return Response(pipeline["hub"].stream(adaptive=adaptive),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/stats')
+def stream_stats():
+    if not startup.ready.is_set():
+        return not_ready()
+    # Stage rates plus each client's quality level and measured bandwidth
+    return jsonify(pipeline=pipeline["stats"].snapshot(), stream=pipeline["hub"].stats(),
+                   startup=startup.status())
+
+def detection_boxes(result):
+    boxes = result.boxes
+    return [{"xyxy": [round(float(v), 1) for v in xyxy], "conf": round(float(conf), 3),
+             "label": result.names[int(cls)]}
+            for xyxy, conf, cls in zip(boxes.xyxy.tolist(), boxes.conf.tolist(),
+                                       boxes.cls.tolist())]
+
+@app.route('/detections')
+def detections():
+    if not startup.ready.is_set():
+        return not_ready()
+    # Long poll: /detections?after=<seq> waits up to 1 s for a newer result.
+    # The reply's seq is always the service's own counter, so after a restart
+    # a client polling with a larger seq sees it drop and starts over.
+    # "captured" is the frame's wall-clock time, so a ground station with a
+    # synced clock can look up where the drone was when the frame was taken
+    after = request.args.get('after', 0, type=int)
+    seq, detection = pipeline["inference"].results.wait_newer(after, timeout=1.0)
+    if detection is None:
+        return jsonify(seq=seq, boxes=[])
+    frame, result = detection
+    height, width = frame.image.shape[:2]
+    return jsonify(seq=seq, captured=frame.wall, width=width, height=height,
+                   boxes=detection_boxes(result))
+
 if __name__ == "__main__":
+    threading.Thread(target=start_pipeline, name="startup", daemon=True).start()
     # Run Flask on all network interfaces so you can view it from other devices
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
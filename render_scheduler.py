@@ -0,0 +1,126 @@
+import threading
+import time
+
+from perf_stats import RollingStats
+
+DEFAULT_FPS = 30.0
+
+
+class RateLimiter:
+    """Allow an action at most once per interval (e.g. console output)"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = float("-inf")
+
+    def ready(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now - self._last >= self.interval:
+            self._last = now
+            return True
+        return False
+
+
+class RenderScheduler:
+    """Coalesce telemetry samples and publish the latest one at a fixed FPS
+
+    The receive thread only calls submit(), which stores the sample in a
+    single "latest state" slot. A background thread hands the newest sample
+    to render_fn at most `fps` times per second; samples overwritten before
+    they are rendered are counted as coalesced.
+    """
+
+    def __init__(self, render_fn, fps=DEFAULT_FPS, name="render-scheduler"):
+        self.render_fn = render_fn
+        self.fps = fps
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._latest = None
+        self._latest_time = 0.0
+        self._pending = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.received = 0
+        self.coalesced = 0
+        self.rendered = 0
+        self.render_errors = 0
+        self.last_latency = 0.0
+        self.latency = RollingStats()  # Sample arrival to scene update (s)
+        self.render_time = RollingStats()  # Time spent in render_fn (s)
+        self.cpu_time = 0.0  # Thread CPU seconds spent in render_fn
+
+    def submit(self, state):
+        """Store the newest sample (O(1), safe to call from the radio thread)"""
+        now = time.monotonic()
+        with self._lock:
+            if self._pending:
+                self.coalesced += 1
+            self._latest = state
+            self._latest_time = now
+            self._pending = True
+            self.received += 1
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        thread = self._thread
+        if thread is None:
+            return
+        self._stop_event.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        """Return a snapshot of the scheduler counters"""
+        return {
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "rendered": self.rendered,
+            "render_errors": self.render_errors,
+            "last_latency_ms": self.last_latency * 1000.0,
+            "latency_ms": self.latency.summary(1000.0),
+            "render_ms": self.render_time.summary(1000.0),
+            "cpu_s": self.cpu_time,
+        }
+
+    def _take(self):
+        with self._lock:
+            if not self._pending:
+                return None, 0.0
+            self._pending = False
+            return self._latest, self._latest_time
+
+    def _run(self):
+        period = 1.0 / self.fps
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            state, stamp = self._take()
+            if state is not None:
+                cpu_start = time.thread_time()
+                start = time.monotonic()
+                try:
+                    self.render_fn(state)
+                    self.rendered += 1
+                    end = time.monotonic()
+                    self.last_latency = end - stamp
+                    self.latency.add(end - stamp)
+                    self.render_time.add(end - start)
+                except Exception as e:
+                    self.render_errors += 1
+                    print(f"[ERROR] Scene update failed: {e}")
+                self.cpu_time += time.thread_time() - cpu_start
+
+            # Sleep until the next absolute deadline, skipping missed frames
+            deadline += period
+            now = time.monotonic()
+            if deadline < now:
+                deadline = now
+            self._stop_event.wait(deadline - now)
@@ -0,0 +1,402 @@
+# Hardware-free stand-in for SyncCrazyflie / MotionCommander, selected by URI:
+#   replay://flights/flight-20260101-120000?speed=2   replay a recorded session at 2x
+#   replay://flights/flight-20260101-120000?speed=0   replay as fast as possible
+#   sim://?room=6x4x3                                 kinematic model in a box room
+#   sim://?room=6x4x3&start=1,0                       ... taking off from (1, 0)
+# Log configs added to the stand-in receive data through their usual
+# data_received_cb callbacks. Setpoints from the motion commander drive a simple
+# kinematic model; in sim mode the model also produces the telemetry.
+import math
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from cflib.crazyflie import Crazyflie
+from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
+from cflib.positioning.motion_commander import MotionCommander
+from cflib.utils.callbacks import Caller
+
+from flight_recorder import load_session
+
+REPLAY_SCHEME = "replay"
+SIM_SCHEME = "sim"
+
+SIM_RATE = 100.0  # Model integration / log dispatch rate (Hz)
+SIM_MAX_RANGE_MM = 4000
+SIM_OUT_OF_RANGE_MM = 8000
+VELOCITY_TIME_CONSTANT = 0.15  # First-order lag of the velocity response (s)
+
+
+def is_simulated(uri):
+    return urlparse(uri).scheme in (REPLAY_SCHEME, SIM_SCHEME)
+
+
+def open_link(uri, rw_cache="./cache"):
+    """Return a SyncCrazyflie, or the stand-in for replay:// and sim:// URIs"""
+    if is_simulated(uri):
+        return SimSyncCrazyflie(uri)
+    return SyncCrazyflie(uri, cf=Crazyflie(rw_cache=rw_cache))
+
+
+def make_motion_commander(scf, default_height=0.3):
+    """Return a MotionCommander that matches the link returned by open_link"""
+    if isinstance(scf, SimSyncCrazyflie):
+        return SimMotionCommander(scf, default_height=default_height)
+    return MotionCommander(scf, default_height=default_height)
+
+
+class KinematicModel:
+    """Point-mass drone following body-frame velocity setpoints"""
+
+    def __init__(self):
+        self.position = np.zeros(3)
+        self.velocity = np.zeros(3)
+        self.yaw = 0.0  # Degrees, counter-clockwise positive
+        self.target_velocity = np.zeros(3)  # Body frame: forward, left, up
+        self.yaw_rate = 0.0  # Degrees/s, clockwise positive like MotionCommander
+        self.flying = False
+        self._lock = threading.Lock()
+
+    def set_velocity(self, vx, vy, vz, yaw_rate):
+        with self._lock:
+            self.target_velocity[:] = (vx, vy, vz)
+            self.yaw_rate = yaw_rate
+
+    def step(self, dt):
+        with self._lock:
+            if not self.flying:
+                # Motors off: resting on the ground
+                self.velocity[:] = 0.0
+                self.position[2] = 0.0
+                return
+            yaw = math.radians(self.yaw)
+            c, s = math.cos(yaw), math.sin(yaw)
+            vx, vy, vz = self.target_velocity
+            world = np.array((c * vx - s * vy, s * vx + c * vy, vz))
+            alpha = min(1.0, dt / VELOCITY_TIME_CONSTANT)
+            self.velocity += alpha * (world - self.velocity)
+            self.position += self.velocity * dt
+            self.position[2] = max(0.0, self.position[2])
+            self.yaw = (self.yaw - self.yaw_rate * dt + 180.0) % 360.0 - 180.0
+
+    def state(self):
+        with self._lock:
+            return self.position.copy(), self.velocity.copy(), self.yaw
+
+
+class _SimLog:
+    def __init__(self, cf):
+        self.cf = cf
+        self.configs = []
+
+    def add_config(self, logconf):
+        # With cf.link set to None, LogConfig.start() becomes a no-op; the
+        # stand-in streams data to every added config instead.
+        for name in logconf.default_fetch_as:
+            logconf.add_variable(name, "float")
+        logconf.default_fetch_as = []
+        logconf.cf = self.cf
+        logconf.valid = True
+        logconf._added = True
+        self.configs.append(logconf)
+        self.cf.source.add_config(logconf)
+
+
+class _SimParam:
+    def __init__(self):
+        self.values = {}
+
+    def add_update_callback(self, group=None, name=None, cb=None):
+        # Every deck reads as attached so deck checks pass immediately
+        value = self.values.get(f"{group}.{name}", "1")
+        if cb is not None:
+            cb(f"{group}.{name}", value)
+
+    def set_value(self, complete_name, value):
+        self.values[complete_name] = str(value)
+
+
+class SimCrazyflie:
+    """Subset of the Crazyflie API used by the scripts in this repo"""
+
+    def __init__(self, uri):
+        self.link_uri = uri
+        self.link = None
+        self.model = KinematicModel()
+        self.log = _SimLog(self)
+        self.param = _SimParam()
+        self.link_quality_updated = Caller()
+
+        parsed = urlparse(uri)
+        query = parse_qs(parsed.query)
+        if parsed.scheme == REPLAY_SCHEME:
+            path = parsed.netloc + parsed.path
+            speed = float(query.get("speed", ["1"])[0])
+            self.source = ReplaySource(path, speed)
+        else:
+            room = query.get("room", ["6x4x3"])[0]
+            self.source = ModelSource(self.model, [float(v) for v in room.split("x")])
+            # Take-off spot, e.g. start=1,-0.5 to keep simulated swarms apart
+            start = query.get("start", ["0,0"])[0]
+            self.model.position[:2] = [float(v) for v in start.split(",")]
+
+    def is_connected(self):
+        return True
+
+
+class SimSyncCrazyflie:
+    """Drop-in for SyncCrazyflie backed by SimCrazyflie"""
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.cf = SimCrazyflie(uri)
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def __enter__(self):
+        self.open_link()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close_link()
+
+    def open_link(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="sim-link", daemon=True)
+        self._thread.start()
+
+    def close_link(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+
+    def is_link_open(self):
+        return self._thread is not None
+
+    def _run(self):
+        period = 1.0 / SIM_RATE
+        start = deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            self.cf.model.step(period)
+            self.cf.source.dispatch(time.monotonic() - start)
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._stop_event.wait(delay)
+            elif self.cf.source.as_fast_as_possible:
+                deadline = time.monotonic()
+
+
+class SimMotionCommander:
+    """MotionCommander replacement driving the KinematicModel"""
+
+    VELOCITY = 0.2
+
+    def __init__(self, scf, default_height=0.3):
+        self._model = scf.cf.model
+        self.default_height = default_height
+        self._is_flying = False
+
+    def take_off(self, height=None, velocity=VELOCITY):
+        if self._is_flying:
+            raise Exception("Already flying")
+        self._is_flying = True
+        self._model.flying = True
+        self._move_to_height(
+            self.default_height if height is None else height, velocity
+        )
+
+    def land(self, velocity=VELOCITY):
+        if self._is_flying:
+            self._move_to_height(0.0, velocity)
+            self._model.set_velocity(0, 0, 0, 0)
+            self._model.flying = False
+            self._is_flying = False
+
+    def stop(self):
+        self._set_vel_setpoint(0.0, 0.0, 0.0, 0.0)
+
+    def _set_vel_setpoint(self, velocity_x, velocity_y, velocity_z, rate_yaw):
+        if not self._is_flying:
+            raise Exception("Can not move on the ground. Take off first!")
+        self._model.set_velocity(velocity_x, velocity_y, velocity_z, rate_yaw)
+
+    def _move_to_height(self, height, velocity):
+        position, _, _ = self._model.state()
+        distance = height - position[2]
+        self._model.set_velocity(0, 0, math.copysign(velocity, distance), 0)
+        time.sleep(abs(distance) / velocity)
+        self._model.set_velocity(0, 0, 0, 0)
+
+
+class ModelSource:
+    """Generate telemetry for each log config from the kinematic model"""
+
+    as_fast_as_possible = False
+
+    def __init__(self, model, room):
+        self.model = model
+        self.room = np.asarray(room, dtype=np.float64)  # Width, depth, height
+        self._configs = []  # [logconf, period_s, next_due]
+        self._lock = threading.Lock()
+
+    def add_config(self, logconf):
+        with self._lock:
+            self._configs.append([logconf, logconf.period_in_ms / 1000.0, 0.0])
+
+    def dispatch(self, now):
+        with self._lock:
+            due = [c for c in self._configs if now >= c[2]]
+            for c in due:
+                c[2] = max(c[2] + c[1], now)
+        if not due:
+            return
+        values = self.sample()
+        timestamp = int(now * 1000) & 0xFFFFFFFF
+        for logconf, _, _ in due:
+            data = {v.name: values.get(v.name, 0) for v in logconf.variables}
+            logconf.data_received_cb.call(timestamp, data, logconf)
+
+    def sample(self):
+        """Return the current value of every variable the model can produce"""
+        position, velocity, yaw = self.model.state()
+        position, velocity = position.tolist(), velocity.tolist()
+        values = {
+            "stateEstimate.x": position[0],
+            "stateEstimate.y": position[1],
+            "stateEstimate.z": position[2],
+            "stateEstimate.vx": velocity[0],
+            "stateEstimate.vy": velocity[1],
+            "stateEstimate.vz": velocity[2],
+            "stateEstimate.yaw": yaw,
+            "stateEstimateZ.x": round(position[0] * 1000),
+            "stateEstimateZ.y": round(position[1] * 1000),
+            "stateEstimateZ.z": round(position[2] * 1000),
+            "stateEstimateZ.vx": round(velocity[0] * 1000),
+            "stateEstimateZ.vy": round(velocity[1] * 1000),
+            "stateEstimateZ.vz": round(velocity[2] * 1000),
+            "stabilizer.roll": 0.0,
+            "stabilizer.pitch": 0.0,
+            "stabilizer.yaw": yaw,
+        }
+        values.update(self._ranges(position, yaw))
+        return values
+
+    def _ranges(self, position, yaw):
+        """Distances (mm) from the drone to the walls of an axis-aligned room"""
+        half = self.room[:2] / 2.0
+        ranges = {}
+        for name, offset in (("front", 0), ("left", 90), ("back", 180), ("right", -90)):
+            a = math.radians(yaw + offset)
+            d = np.array((math.cos(a), math.sin(a)))
+            with np.errstate(divide="ignore"):
+                t = np.where(
+                    d > 0, (half - position[:2]) / d, (-half - position[:2]) / d
+                )
+            ranges[f"range.{name}"] = float(np.min(np.where(d != 0, t, np.inf)))
+        ranges["range.up"] = self.room[2] - position[2]
+        ranges["range.zrange"] = position[2]
+        for name, metres in ranges.items():
+            mm = int(metres * 1000)
+            ranges[name] = mm if 0 <= mm < SIM_MAX_RANGE_MM else SIM_OUT_OF_RANGE_MM
+        return ranges
+
+
+class ReplaySource:
+    """Replay a recorded session into the log configs added to the link
+
+    Each log config is fed from the recording that holds its first
+    variable; variables recorded in other streams are filled in from the
+    sample nearest in time. speed=0 replays as fast as possible.
+    """
+
+    def __init__(self, directory, speed=1.0):
+        streams = load_session(directory)
+        if not streams:
+            raise ValueError(f"No recordings found in {directory}")
+        # A stream with no samples (e.g. a flight aborted before the first
+        # log packet) counts as not recorded
+        self.streams = {name: r for name, r in streams.items() if len(r)}
+        if not self.streams:
+            raise ValueError(f"Recordings in {directory} hold no samples")
+        self.speed = speed
+        self.as_fast_as_possible = speed <= 0
+        self._timelines = []  # [logconf, records, columns, cursor]
+        self._lock = threading.Lock()
+        self._t0 = min(int(r["timestamp"][0]) for r in self.streams.values())
+        self.finished = threading.Event()
+
+    def add_config(self, logconf):
+        names = [v.name for v in logconf.variables]
+        found = self._find_stream(names[0]) if names else None
+        if found is None:
+            print(f"[WARNING] Nothing recorded for log config '{logconf.name}'")
+            return
+        primary = found[0]
+        timestamps = primary["timestamp"].astype(np.int64)
+        columns = {}
+        for name in names:
+            found = self._find_stream(name)
+            if found is None:
+                continue
+            stream, field, scale = found
+            if stream is primary:
+                column = primary[field]
+            else:
+                # Nearest sample: the one at or after each time, or the one
+                # before it when that is closer
+                stamps = stream["timestamp"].astype(np.int64)
+                after = np.searchsorted(stamps, timestamps).clip(0, len(stream) - 1)
+                before = (after - 1).clip(0)
+                closer = np.abs(timestamps - stamps[before]) <= np.abs(
+                    stamps[after] - timestamps
+                )
+                column = stream[field][np.where(closer, before, after)]
+            if scale != 1:
+                column = np.round(column * scale).astype(np.int64)
+            columns[name] = column
+        with self._lock:
+            self._timelines.append([logconf, timestamps, columns, 0])
+
+    def dispatch(self, elapsed):
+        # Recording time (ms) that should have been replayed by now
+        if self.as_fast_as_possible:
+            horizon = float("inf")
+        else:
+            horizon = self._t0 + elapsed * 1000.0 * self.speed
+
+        with self._lock:
+            timelines = list(self._timelines)
+        pending = False
+        for timeline in timelines:
+            logconf, timestamps, columns, cursor = timeline
+            end = (
+                min(cursor + 100, len(timestamps))  # Bounded burst per tick
+                if self.as_fast_as_possible
+                else int(np.searchsorted(timestamps, horizon, side="right"))
+            )
+            for i in range(cursor, end):
+                data = {name: column[i].item() for name, column in columns.items()}
+                logconf.data_received_cb.call(int(timestamps[i]), data, logconf)
+            timeline[3] = max(cursor, end)
+            pending |= timeline[3] < len(timestamps)
+        if timelines and not pending and not self.finished.is_set():
+            self.finished.set()
+            print("[INFO] Replay finished")
+
+    def _find_stream(self, name):
+        """Return (records, field, scale) holding name, or None
+
+        Compressed stateEstimateZ.* variables (int16 mm) are derived from
+        stateEstimate.* floats when only those were recorded.
+        """
+        aliases = [(name, 1)]
+        if name.startswith("stateEstimateZ."):
+            aliases.append((name.replace("stateEstimateZ.", "stateEstimate."), 1000))
+        for field, scale in aliases:
+            for records in self.streams.values():
+                if field in records.dtype.names:
+                    return records, field, scale
+        return None
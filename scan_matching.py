@@ -0,0 +1,474 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from mapping import RANGE_VARIABLES, ranges_to_rays
+from perf_stats import RollingStats
+
+FIELD_RESOLUTION = 0.05  # Metres per likelihood-field cell
+FIELD_SIGMA = 0.10  # Metres; how quickly the likelihood falls off near a wall
+FIELD_MARGIN = 4.0  # Metres of padding added when the field grows
+# Four rangers give four points per sample, so a scan is a sliding window of
+# samples (odometry is accurate over a second); one is matched every STEP
+SCAN_SAMPLES = 100  # 1 s at 100 Hz, up to 400 points
+SCAN_STEP = 20  # Samples between matches (5 matches per second)
+MIN_SCAN_POINTS = 40  # Horizontal returns needed to attempt a match
+MIN_MAP_CELLS = 200  # Cells in the field before matching starts
+MIN_SCORE = 0.35  # Mean likelihood for a match to be accepted
+MIN_GAIN = 0.01  # Score gain over the current correction needed to move it
+MIN_OVERLAP = 0.5  # Fraction of scan points near mapped walls needed to match
+KNOWN_LIKELIHOOD = 0.5  # Points scoring less are on walls not mapped yet
+SEARCH_CELLS = 3  # +/- field cells searched around the current correction
+SEARCH_YAW = 3.0  # +/- degrees
+YAW_STEPS = 7  # Yaw candidates in the coarse pass
+PRIOR_WEIGHT = 0.05  # Score penalty for a full-range correction step
+# Match uncertainty comes from how fast the coarse score falls off around
+# the best step; along a corridor it does not, and steps in directions
+# spread wider than this are not trusted
+SCORE_TEMPERATURE = 0.05  # Score drop making a step e times less likely
+DEGENERATE_CELLS = 1.0
+DEGENERATE_YAW_STEPS = 1.0  # Coarse yaw steps
+LATENCY_BUDGET = 0.005  # Seconds per scan; 100 Hz samples arrive in 0.2 s windows
+QUEUE_SIZE = 4  # Scans waiting for the matcher before new ones are dropped
+
+# Horizontal rangers only; up and zrange do not constrain x, y or yaw
+HORIZONTAL = np.array([name in RANGE_VARIABLES[:4] for name in RANGE_VARIABLES])
+
+
+def fill_scan_row(row, data):
+    """Write a log record's pose and horizontal ranges into a (12,) row"""
+    row[0] = data.get("stateEstimate.x", 0)
+    row[1] = data.get("stateEstimate.y", 0)
+    row[2] = data.get("stateEstimate.z", 0)
+    row[3] = data.get("stabilizer.roll", 0)
+    row[4] = -data.get("stabilizer.pitch", 0)  # Firmware pitch is inverted
+    row[5] = data.get("stabilizer.yaw", 0)
+    for i, name in enumerate(RANGE_VARIABLES):
+        row[6 + i] = data.get(name, 0) if HORIZONTAL[i] else 0
+
+
+def scan_points(rows):
+    """Horizontal wall points (N, 2) of scan rows (M, 12)"""
+    _, endpoints, hits = ranges_to_rays(rows[:, :3], rows[:, 3:6], rows[:, 6:12])
+    return endpoints[hits][:, :2]
+
+
+def thin(points, spacing):
+    """Keep one 2D point per spacing-sized cell"""
+    _, keep = np.unique(np.floor(points / spacing), axis=0, return_index=True)
+    return points[keep]
+
+
+def _away_from(points, others, distance):
+    """Points (N, 2) further than distance from every one of others (M, 2)"""
+    if len(others) == 0 or len(points) == 0:
+        return points
+    near = np.zeros(len(points), dtype=bool)
+    for chunk in np.array_split(others, max(1, len(others) // 256)):
+        gaps = points[:, None] - chunk[None]
+        near |= ((gaps**2).sum(axis=2) < distance**2).any(axis=1)
+    return points[~near]
+
+
+def rotate(points, angle, center):
+    """Rotate 2D points (..., 2) by angle (rad) about center"""
+    c, s = np.cos(angle), np.sin(angle)
+    d = points - center
+    return (
+        np.stack((c * d[..., 0] - s * d[..., 1], s * d[..., 0] + c * d[..., 1]), -1)
+        + center
+    )
+
+
+class LikelihoodField:
+    """2D likelihood field over the horizontal scan map
+
+    Each cell holds exp(-d^2 / 2 sigma^2), d being the distance to the
+    nearest wall point within 3 sigma, so scoring a candidate pose is one
+    array lookup per scan point. Adding points only touches the cells
+    around them; the grid grows as the map does.
+    """
+
+    def __init__(self, resolution=FIELD_RESOLUTION, sigma=FIELD_SIGMA):
+        self.resolution = resolution
+        self.field = np.zeros((0, 0), dtype=np.float32)
+        self.origin = np.zeros(2)  # World position of cell (0, 0)
+        self._walls = set()
+        radius = self._radius = int(np.ceil(3.0 * sigma / resolution))
+        offsets = np.arange(-radius, radius + 1)
+        dx, dy = np.meshgrid(offsets, offsets, indexing="ij")
+        keep = (dx**2 + dy**2) * resolution**2 <= (3.0 * sigma + resolution) ** 2
+        self._offsets = np.stack((dx[keep], dy[keep]), axis=1)
+        self.sigma = sigma
+
+    @property
+    def cells(self):
+        return len(self._walls)
+
+    def add(self, points):
+        """Add wall points (N, 2); returns the number of new wall cells"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) == 0:
+            return 0
+        self._ensure(points.min(axis=0), points.max(axis=0))
+        cells, first = np.unique(self._cells(points), axis=0, return_index=True)
+        fresh = np.fromiter(
+            (c not in self._walls for c in map(tuple, cells.tolist())),
+            dtype=bool,
+            count=len(cells),
+        )
+        cells, points = cells[fresh], points[first[fresh]]
+        self._walls.update(map(tuple, cells.tolist()))
+        if len(cells):
+            # Distances from the point itself (not its cell) to the cell
+            # centres around it, so the field peaks exactly on the wall
+            idx = cells[:, None, :] + self._offsets[None]  # (N, K, 2)
+            centres = self.origin + (idx + 0.5) * self.resolution
+            dist2 = ((centres - points[:, None, :]) ** 2).sum(axis=-1)
+            weights = np.exp(-dist2 / (2.0 * self.sigma**2)).astype(np.float32)
+            idx = idx.reshape(-1, 2)
+            np.maximum.at(self.field, (idx[:, 0], idx[:, 1]), weights.reshape(-1))
+        return len(cells)
+
+    def score(self, points):
+        """Mean likelihood of point sets (..., P, 2) -> (...)"""
+        return self.values(points).mean(axis=-1)
+
+    def values(self, points):
+        """Likelihood at each point (..., 2) -> (...)"""
+        # Bilinear between cell centres, so sub-cell shifts change the score.
+        # The border cells are always zero, so clipping stands in for bounds
+        pos = (points - self.origin) / self.resolution - 0.5
+        base = np.floor(pos).astype(np.int64)
+        frac = pos - base
+        h, w = self.field.shape
+        values = 0.0
+        for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            x = np.clip(base[..., 0] + dx, 0, h - 1)
+            y = np.clip(base[..., 1] + dy, 0, w - 1)
+            weight = (frac[..., 0] if dx else 1 - frac[..., 0]) * (
+                frac[..., 1] if dy else 1 - frac[..., 1]
+            )
+            values = values + self.field[x, y] * weight
+        return values
+
+    def score_shifts(self, points, shifts):
+        """Mean likelihood of point sets (Y, P, 2) moved by whole cells (O, 2)
+
+        Nearest-cell lookups with integer shifts, for the coarse search.
+        Returns (Y, O).
+        """
+        idx = self._cells(points)
+        h, w = self.field.shape
+        x = np.clip(idx[:, None, :, 0] + shifts[None, :, None, 0], 0, h - 1)
+        y = np.clip(idx[:, None, :, 1] + shifts[None, :, None, 1], 0, w - 1)
+        return self.field[x, y].mean(axis=-1)
+
+    def _cells(self, points):
+        return np.floor((points - self.origin) / self.resolution).astype(np.int64)
+
+    def _ensure(self, lo, hi):
+        """Grow the grid so [lo, hi] plus the kernel radius is inside it"""
+        pad = (self._radius + 1) * self.resolution
+        h, w = self.field.shape
+        end = self.origin + np.array([h, w]) * self.resolution
+        if h and np.all(lo - pad >= self.origin) and np.all(hi + pad < end):
+            return
+        new_lo, new_hi = lo - FIELD_MARGIN, hi + FIELD_MARGIN
+        if h:
+            new_lo, new_hi = np.minimum(new_lo, self.origin), np.maximum(new_hi, end)
+        new_lo = np.floor(new_lo / self.resolution) * self.resolution
+        shape = np.ceil((new_hi - new_lo) / self.resolution).astype(int)
+        grown = np.zeros(shape, dtype=np.float32)
+        if h:
+            off = np.round((self.origin - new_lo) / self.resolution).astype(int)
+            grown[off[0] : off[0] + h, off[1] : off[1] + w] = self.field
+            self._walls = {(x + off[0], y + off[1]) for x, y in self._walls}
+        self.field = grown
+        self.origin = new_lo
+
+
+class CorrelativeSearch:
+    """Coarse-to-fine search for the (yaw, x, y) step fitting points to a field
+
+    The coarse pass scores whole-cell shifts for every yaw candidate in one
+    vectorized lookup; the fine pass refines the best one with half steps
+    and bilinear scores. A small prior prefers short steps when candidates
+    fit equally well.
+    """
+
+    def __init__(
+        self,
+        resolution=FIELD_RESOLUTION,
+        cells=SEARCH_CELLS,
+        yaw=SEARCH_YAW,
+        yaw_steps=YAW_STEPS,
+        prior_weight=PRIOR_WEIGHT,
+    ):
+        self.resolution = resolution
+        self.yaw = yaw
+        self.prior_weight = prior_weight
+        offsets = np.arange(-cells, cells + 1)
+        gx, gy = np.meshgrid(offsets, offsets, indexing="ij")
+        self._shifts = np.stack((gx.ravel(), gy.ravel()), axis=1)
+        self._yaws = np.radians(np.linspace(-yaw, yaw, yaw_steps))
+        self._step_yaw = self._yaws[1] - self._yaws[0]
+        self._range_xy = cells * resolution
+
+    def search(self, field, points, center):
+        """Best step rotating about center
+
+        Returns (yaw step rad, xy step (2,), score, covariance (3, 3)) with
+        the covariance over x, y and yaw.
+        """
+        # Coarse: whole-cell shifts for every yaw; fine: bilinear around it
+        rotated = np.stack([rotate(points, a, center) for a in self._yaws])
+        scores = field.score_shifts(rotated, self._shifts)
+        d_xy = self._shifts * self.resolution
+        y, o = np.unravel_index(
+            np.argmax(scores - self._prior(self._yaws, d_xy)), scores.shape
+        )
+        half = np.array([-0.5, 0.0, 0.5])
+        fine_yaw = self._yaws[y] + half * self._step_yaw
+        fx, fy = np.meshgrid(half, half, indexing="ij")
+        fine_xy = d_xy[o] + np.stack((fx.ravel(), fy.ravel()), axis=1) * (
+            self.resolution
+        )
+        d_yaw, step, score = self._refine(field, points, center, fine_yaw, fine_xy)
+        covariance = np.zeros((3, 3))
+        covariance[:2, :2] = _spread(scores[y], d_xy) + np.eye(2) * (
+            self.resolution**2 / 12
+        )
+        covariance[2, 2] = _spread(scores.max(axis=1), self._yaws[:, None])[0, 0] + (
+            self._step_yaw**2 / 12
+        )
+        return d_yaw, step, score, covariance
+
+    def constrained(self, d_yaw, d_xy, covariance):
+        """The step without its parts along poorly constrained directions"""
+        if covariance[2, 2] > (DEGENERATE_YAW_STEPS * self._step_yaw) ** 2:
+            d_yaw = 0.0
+        values, vectors = np.linalg.eigh(covariance[:2, :2])
+        for value, vector in zip(values, vectors.T):
+            if value > (DEGENERATE_CELLS * self.resolution) ** 2:
+                d_xy = d_xy - (d_xy @ vector) * vector
+        return d_yaw, d_xy
+
+    def _refine(self, field, points, center, yaws, offsets):
+        """Best (yaw, xy offset, score) over all combinations of candidates"""
+        rotated = np.stack([rotate(points, a, center) for a in yaws])  # (Y, P, 2)
+        candidates = rotated[:, None] + offsets[None, :, None, :]  # (Y, O, P, 2)
+        scores = field.score(candidates)
+        y, o = np.unravel_index(
+            np.argmax(scores - self._prior(yaws, offsets)), scores.shape
+        )
+        return yaws[y], offsets[o], scores[y, o]
+
+    def _prior(self, yaws, offsets):
+        """Penalty (Y, O) preferring small steps when candidates fit equally"""
+        prior = (offsets**2).sum(axis=1)[None] / (2 * self._range_xy**2)
+        prior = prior + (np.degrees(yaws)[:, None] / self.yaw) ** 2 / 2
+        return self.prior_weight * prior
+
+
+def _spread(scores, steps):
+    """Covariance of candidate steps (N, D) weighted by their scores (N,)"""
+    weights = np.exp((scores - scores.max()) / SCORE_TEMPERATURE)
+    weights /= weights.sum()
+    spread = steps - weights @ steps
+    return (spread * weights[:, None]).T @ spread
+
+
+class ScanMatcher:
+    """Correct odometry drift by matching range scans against the scan map
+
+    The log callback only appends the raw pose and ranges to a ring (O(1));
+    every SCAN_STEP samples the last SCAN_SAMPLES go to a worker thread,
+    which searches the (x, y, yaw)
+    correction that best fits the scan into a LikelihoodField (correlative
+    search, coarse then fine, fully vectorized) and then adds the corrected
+    scan to the field. correct() applies the latest correction to any raw
+    pose, so a corrected pose is available for every sample.
+    """
+
+    def __init__(
+        self, samples=SCAN_SAMPLES, step=SCAN_STEP, latency_budget=LATENCY_BUDGET
+    ):
+        self.field = LikelihoodField()
+        self.step = step
+        self.latency_budget = latency_budget
+        self._rows = np.zeros((samples, 12), dtype=np.float64)
+        self._head = 0
+        self._filled = 0
+        self._since = 0  # Samples since the last scan was queued
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+        # Correction: corrected_xy = R(yaw) @ raw_xy + offset
+        self._yaw = 0.0  # Radians
+        self._offset = np.zeros(2)
+        self.latency = RollingStats(capacity=1024)
+        self.scans = 0
+        self.matched = 0
+        self.rejected = 0
+        self.held = 0
+        self.dropped = 0
+        self.over_budget = 0
+        self.last_score = 0.0
+        self.search = CorrelativeSearch(self.field.resolution)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="scan-matcher", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def add_sample(self, data):
+        """Append one merged log record (runs on the radio thread)"""
+        fill_scan_row(self._rows[self._head], data)
+        self._head = (self._head + 1) % len(self._rows)
+        self._filled = min(self._filled + 1, len(self._rows))
+        self._since += 1
+        if self._since >= self.step and self._filled == len(self._rows):
+            self._since = 0
+            # Chronological copy of the window
+            scan = np.roll(self._rows, -self._head, axis=0)
+            try:
+                self._queue.put_nowait(scan)
+            except queue.Full:
+                self.dropped += 1
+
+    def correction(self):
+        """(yaw rad, offset (2,)) mapping raw odometry into the map frame"""
+        with self._lock:
+            return self._yaw, self._offset.copy()
+
+    def correct(self, x, y, yaw):
+        """Corrected (x, y, yaw in degrees) for a raw pose"""
+        angle, offset = self.correction()
+        c, s = np.cos(angle), np.sin(angle)
+        return (
+            c * x - s * y + offset[0],
+            s * x + c * y + offset[1],
+            yaw + np.degrees(angle),
+        )
+
+    def correct_record(self, data):
+        """Copy of a log record with corrected position and yaw"""
+        corrected = dict(data)
+        x, y, yaw = self.correct(
+            data.get("stateEstimate.x", 0),
+            data.get("stateEstimate.y", 0),
+            data.get("stabilizer.yaw", 0),
+        )
+        corrected["stateEstimate.x"] = x
+        corrected["stateEstimate.y"] = y
+        corrected["stabilizer.yaw"] = yaw
+        return corrected
+
+    def _run(self):
+        while True:
+            rows = self._queue.get()
+            if rows is None:
+                return
+            start = time.perf_counter()
+            self.match(rows)
+            elapsed = time.perf_counter() - start
+            self.latency.add(elapsed)
+            if elapsed > self.latency_budget:
+                self.over_budget += 1
+
+    def match(self, rows):
+        """Match one scan of raw rows (N, 12) and update the correction"""
+        self.scans += 1
+        angle, offset = self.correction()
+        c, s = np.cos(angle), np.sin(angle)
+        poses = rows[:, :6].copy()
+        poses[:, 0] = c * rows[:, 0] - s * rows[:, 1] + offset[0]
+        poses[:, 1] = s * rows[:, 0] + c * rows[:, 1] + offset[1]
+        poses[:, 5] += np.degrees(angle)
+        points = scan_points(np.column_stack((poses, rows[:, 6:12])))
+
+        if self.field.cells < MIN_MAP_CELLS:
+            self.field.add(points)  # Bootstrap the map from odometry
+            return False
+        if len(points) < MIN_SCAN_POINTS:
+            return False
+
+        # Points on walls that are not mapped yet cannot be matched; a scan
+        # that is mostly new geometry only extends the map
+        # Only walls that are not mapped yet are added to the field, so the
+        # map does not thicken or creep with the odometry
+        known = self.field.values(points) > KNOWN_LIKELIHOOD
+        new_walls, points = points[~known], points[known]
+        if known.mean() < MIN_OVERLAP:
+            self.held += 1
+            self.field.add(new_walls)
+            return False
+        # Mapped points next to new walls sit at the edge of the map, and
+        # shifting them back onto it always scores better; leave them out
+        points = _away_from(points, new_walls, SEARCH_CELLS * self.field.resolution)
+        if len(points) < MIN_SCAN_POINTS:
+            self.held += 1
+            self.field.add(new_walls)
+            return False
+        # One point per half cell is plenty to score a pose
+        points = thin(points, self.field.resolution / 2)
+        center = poses[:, :2].mean(axis=0)
+        d_yaw, d_xy, score, covariance = self.search.search(self.field, points, center)
+        step = self.search.constrained(d_yaw, d_xy, covariance)
+        if step[0] != d_yaw or not np.allclose(step[1], d_xy):
+            # E.g. along a corridor only the across part of the step is known
+            d_yaw, d_xy = step
+            score = self.field.score(rotate(points, d_yaw, center) + d_xy)
+        current = self.field.score(points[None])[0]
+        self.last_score = float(max(score, current))
+        if score < MIN_SCORE:
+            self.rejected += 1
+            return False
+        if score - current < MIN_GAIN:
+            # No clear improvement: keep the correction
+            self.held += 1
+            self.field.add(new_walls)
+            return False
+
+        # Compose the step (rotation about the scan centre, then shift)
+        c, s = np.cos(d_yaw), np.sin(d_yaw)
+        rel = offset - center
+        with self._lock:
+            self._yaw = angle + d_yaw
+            self._offset = (
+                np.array([c * rel[0] - s * rel[1], s * rel[0] + c * rel[1]])
+                + center
+                + d_xy
+            )
+        self.field.add(rotate(new_walls, d_yaw, center) + d_xy)
+        self.matched += 1
+        return True
+
+    def stats(self):
+        angle, offset = self.correction()
+        latency = self.latency.summary(1000.0)
+        return {
+            "scans": self.scans,
+            "matched": self.matched,
+            "rejected": self.rejected,
+            "held": self.held,
+            "dropped": self.dropped,
+            "over_budget": self.over_budget,
+            "score": self.last_score,
+            "latency_p50_ms": latency["p50"],
+            "latency_p99_ms": latency["p99"],
+            "correction_xy_m": float(np.hypot(*offset)),
+            "correction_yaw_deg": float(np.degrees(angle)),
+        }
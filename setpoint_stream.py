@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import deque
+
+from perf_stats import RollingStats
+
+SETPOINT_RATE = 50.0  # Hz; 100 is also supported by the firmware
+
+
+class VelocityCommand:
+    """Body-frame velocity (m/s) and yaw rate (deg/s) held for a duration"""
+
+    def __init__(self, vx, vy, vz, yaw_rate, duration):
+        self.velocity = (float(vx), float(vy), float(vz), float(yaw_rate))
+        self.duration = duration
+        self.expires = None  # Set when the command becomes active
+
+
+class SetpointStreamer:
+    """Stream velocity setpoints at a fixed rate from a dedicated thread
+
+    Inputs (GUI buttons, keyboard) submit timed commands and return at once.
+    The streamer sends the active command on a monotonic-deadline schedule,
+    moves on to the next queued command when it expires and sends a single
+    zero setpoint when the queue runs dry.
+
+    Submit modes:
+      replace - drop the active and queued commands and start this one now
+      extend  - lengthen the last command if it has the same velocity,
+                otherwise queue this one after it
+    """
+
+    def __init__(self, send_fn, rate_hz=SETPOINT_RATE, name="setpoint-stream"):
+        self.send_fn = send_fn
+        self.rate_hz = rate_hz
+        self.name = name
+
+        self._queue = deque()
+        self._active = None
+        self._stopped = True  # A zero setpoint has been sent since the last move
+        self._lock = threading.Lock()
+        self._idle = threading.Event()  # Set while nothing is left to send
+        self._idle.set()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        # Statistics
+        self.sent = 0
+        self.send_errors = 0
+        self.commands = 0
+        self.interval = RollingStats()  # Time between consecutive sends (s)
+        self._last_send = None
+
+    def submit(self, vx, vy, vz, yaw_rate, duration, mode="replace"):
+        command = VelocityCommand(vx, vy, vz, yaw_rate, duration)
+        with self._lock:
+            self._idle.clear()
+            self.commands += 1
+            if mode == "replace":
+                self._queue.clear()
+                self._active = None
+                self._queue.append(command)
+            elif mode == "extend":
+                tail = self._queue[-1] if self._queue else self._active
+                if tail is not None and tail.velocity == command.velocity:
+                    tail.duration += duration
+                    if tail.expires is not None:
+                        tail.expires += duration
+                else:
+                    self._queue.append(command)
+            else:
+                raise ValueError(f"Unknown submit mode '{mode}'")
+        self._wake.set()
+
+    def cancel(self, wait=False, timeout=1.0):
+        """Drop all commands; the next tick sends a zero setpoint
+
+        With wait=True, return only once that zero has been sent and the
+        thread is idle. Call it that way before land(): a zero arriving
+        after the landing descent started would replace it.
+        """
+        with self._lock:
+            self._queue.clear()
+            self._active = None
+        self._wake.set()
+        thread = self._thread
+        if wait and thread is not None and thread is not threading.current_thread():
+            if not self._idle.wait(timeout):
+                print("[WARNING] Setpoint stream did not go idle")
+
+    def current(self):
+        """Velocity tuple of the active command, or None when idle"""
+        with self._lock:
+            return self._active.velocity if self._active else None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        thread = self._thread
+        if thread is None:
+            return
+        self.cancel()
+        self._stop_event.set()
+        self._wake.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        """Return send counters and measured send-rate jitter"""
+        interval = self.interval.summary(1000.0)
+        period_ms = 1000.0 / self.rate_hz
+        return {
+            "rate_hz": self.rate_hz,
+            "measured_hz": 1000.0 / interval["mean"] if interval["mean"] else 0.0,
+            "sent": self.sent,
+            "send_errors": self.send_errors,
+            "commands": self.commands,
+            "interval_ms": interval,
+            "jitter_p99_ms": max(0.0, interval["p99"] - period_ms),
+        }
+
+    def _next_velocity(self, now):
+        """Return the velocity to send now, or None when idle"""
+        with self._lock:
+            if self._active is not None and now >= self._active.expires:
+                self._active = None
+            if self._active is None and self._queue:
+                self._active = self._queue.popleft()
+                self._active.expires = now + self._active.duration
+            if self._active is not None:
+                self._stopped = False
+                return self._active.velocity
+            if not self._stopped:
+                self._stopped = True
+                return (0.0, 0.0, 0.0, 0.0)
+            self._idle.set()
+            return None
+
+    def _send(self, velocity, now):
+        try:
+            self.send_fn(*velocity)
+            self.sent += 1
+        except Exception as e:
+            self.send_errors += 1
+            print(f"[ERROR] Setpoint send failed: {e}")
+            self.cancel()
+        if self._last_send is not None:
+            self.interval.add(now - self._last_send)
+        self._last_send = now
+
+    def _run(self):
+        period = 1.0 / self.rate_hz
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            velocity = self._next_velocity(now)
+            if velocity is not None:
+                self._send(velocity, now)
+                deadline += period
+                if deadline < now:
+                    deadline = now + period  # Fell behind; don't burst
+                if self._wake.wait(deadline - time.monotonic()):
+                    # New command: apply it now and restart the schedule
+                    self._wake.clear()
+                    self._last_send = None
+                    deadline = time.monotonic()
+            else:
+                # Idle: sleep until a command arrives, then restart the schedule
+                self._last_send = None
+                self._wake.wait()
+                self._wake.clear()
+                deadline = time.monotonic()
@@ -0,0 +1,410 @@
+import os
+import re
+import threading
+import time
+
+import numpy as np
+import viser
+
+from fast_connect import FastConnect
+from flight_recorder import RECORD_DIR, FlightRecorder
+from instrumentation import Instrumentation, PerfPanel
+from log_planner import StreamMerger
+from mapping import MappingPipeline, VoxelPointStore
+from occupancy import OccupancyGrid
+from point_octree import LodStreamer
+from render_scheduler import RateLimiter, RenderScheduler
+from replay_link import make_motion_commander
+from setpoint_stream import SETPOINT_RATE, SetpointStreamer
+from trajectory import TrajectoryBuffer
+from viser_keyboard import (
+    DEFAULT_HEIGHT,
+    MAP_FPS,
+    MAP_VOXEL_SIZE,
+    MOVE_DURATION,
+    OCCUPANCY_FPS,
+    OCCUPANCY_RESOLUTION,
+    PRINT_INTERVAL,
+    RENDER_FPS,
+    TELEMETRY_RATE,
+    TRAIL_FPS,
+    TRAIL_MAX_SEGMENTS,
+    telemetry_plan,
+)
+
+# URIs separated by ";" or whitespace (sim:// URIs contain commas), e.g.
+# CFLIB_SWARM_URIS="sim://?start=0,0;sim://?start=1,0"
+DEFAULT_URIS = "radio://0/80/2M/E7E7E7E7E7;radio://0/80/2M/E7E7E7E7E8"
+SWARM_URIS = [
+    uri
+    for uri in re.split(r"[;\s]+", os.environ.get("CFLIB_SWARM_URIS", DEFAULT_URIS))
+    if uri
+]
+TRAJECTORY_CAPACITY = 10000  # Poses kept per drone
+DRONE_COLORS = [
+    (0, 150, 255),
+    (255, 120, 0),
+    (40, 180, 60),
+    (200, 40, 200),
+    (230, 200, 0),
+    (0, 200, 200),
+]
+
+
+class SwarmMember:
+    """One drone of the swarm: link, telemetry pipeline and setpoint stream
+
+    Log callbacks only store into this drone's buffers; the shared render
+    thread of SwarmVisualizer reads them once per frame.
+    """
+
+    def __init__(self, index, uri, visualizer):
+        self.index = index
+        self.uri = uri
+        self.name = f"cf{index}"
+        self.color = DRONE_COLORS[index % len(DRONE_COLORS)]
+        self.visualizer = visualizer
+        self.perf = visualizer.perf
+
+        self.startup = FastConnect(uri, prepare=False)
+        self.scf = None
+        self.mc_instance = None
+        self.motors_on = False
+        self.ready = False
+
+        self.trajectory = TrajectoryBuffer(TRAJECTORY_CAPACITY)
+        self.mapping = MappingPipeline(
+            voxel_size=MAP_VOXEL_SIZE,
+            occupancy=visualizer.occupancy,
+            store=visualizer.store,
+        )
+        self.setpoints = SetpointStreamer(
+            self._send_setpoint, rate_hz=SETPOINT_RATE, name=f"setpoint-{self.name}"
+        )
+        self.latest = None  # Latest (timestamp, x, y, z), read by the render thread
+        self.merger = None
+
+    def setup_logging(self, scf):
+        """Plan and start this drone's telemetry, recorded with the others"""
+        plan = telemetry_plan(name=self.name)
+        self.merger = StreamMerger(
+            plan, self.perf.timed(f"log.{self.name}", self._telemetry_callback)
+        )
+        for lg in plan.create_logconfs():
+            scf.cf.log.add_config(lg)
+            self.visualizer.recorder.subscribe(lg)
+        self.merger.attach()
+        for block in plan.blocks:
+            block.logconf.start()
+
+    def _telemetry_callback(self, timestamp, data, logconf):
+        """Store one merged record (runs on the radio thread)"""
+        x = data.get("stateEstimate.x", 0)
+        y = data.get("stateEstimate.y", 0)
+        z = data.get("stateEstimate.z", 0)
+        self.trajectory.append(timestamp, x, y, z)
+        self.mapping.pose_callback(timestamp, data, logconf)
+        self.mapping.range_callback(timestamp, data, logconf)
+        self.latest = (timestamp, x, y, z)
+        self.visualizer.scheduler.submit(self.index)
+
+    def _send_setpoint(self, vx, vy, vz, yaw_rate):
+        if self.motors_on and self.mc_instance:
+            self.mc_instance._set_vel_setpoint(vx, vy, vz, yaw_rate)
+
+    def connect(self):
+        """Wait for the link, then run the deck check and log setup together"""
+        try:
+            self.scf = self.startup.wait_link()
+            if not self.startup.ready({"logging": self.setup_logging}):
+                print(f"[ERROR] {self.name}: no Flowdeck detected, leaving it out")
+                return
+        except Exception as e:
+            print(f"[ERROR] {self.name}: could not connect to {self.uri}: {e}")
+            return
+        self.mc_instance = make_motion_commander(
+            self.scf, default_height=DEFAULT_HEIGHT
+        )
+        self.setpoints.start()
+        self.ready = True
+
+    def take_off(self, height):
+        if self.ready and not self.motors_on:
+            self.mc_instance.take_off(height)
+            self.motors_on = True
+
+    def land(self):
+        if self.motors_on:
+            # Wait for the final zero setpoint so it can't cut into the descent
+            self.setpoints.cancel(wait=True)
+            self.mc_instance.land()
+            self.motors_on = False
+
+    def close(self):
+        self.setpoints.stop()
+        self.startup.close()
+
+
+class SwarmVisualizer:
+    """Fly several Crazyflies from one viser server
+
+    Links are opened in parallel. Each drone keeps its own telemetry pipeline
+    and setpoint stream, while one render thread updates every drone in a
+    single batched scene update per frame. Range data from all drones builds
+    one shared map.
+    """
+
+    def __init__(self, uris, render_fps=RENDER_FPS):
+        self.uris = list(uris)
+        self.running = True
+        self.server = viser.ViserServer()
+        self.perf = Instrumentation()
+        self.recorder = None
+        self.scheduler = RenderScheduler(self._render_frame, fps=render_fps)
+        self.occupancy = OccupancyGrid(resolution=OCCUPANCY_RESOLUTION)
+        self.store = VoxelPointStore(MAP_VOXEL_SIZE)
+        self.members = [SwarmMember(i, uri, self) for i, uri in enumerate(self.uris)]
+        self._trail_limiter = RateLimiter(1.0 / TRAIL_FPS)
+        self._map_limiter = RateLimiter(1.0 / MAP_FPS)
+        self._occupancy_limiter = RateLimiter(1.0 / OCCUPANCY_FPS)
+        self._print_limiter = RateLimiter(PRINT_INTERVAL)
+        self._setup_scene()
+
+    def _setup_scene(self):
+        """Initialize the shared 3D scene and one marker per drone"""
+        self.server.scene.add_grid("grid", width=10, height=10, cell_size=0.1)
+        self.drones = [
+            self.server.scene.add_box(
+                f"/swarm/{m.name}",
+                dimensions=(0.1, 0.1, 0.05),
+                position=(0, 0, 0),
+                color=m.color,
+            )
+            for m in self.members
+        ]
+        self.map_streamer = LodStreamer(self.server, voxel_size=MAP_VOXEL_SIZE)
+        self._setup_gui()
+
+        self.perf.add_provider("scheduler", self.scheduler.stats)
+        self.perf.add_provider("map", self._map_stats)
+        self.perf.add_provider("map_lod", self.map_streamer.stats)
+        expected = {"render.frames": self.scheduler.fps}
+        expected.update({f"log.{m.name}": TELEMETRY_RATE for m in self.members})
+        self.perf_panel = PerfPanel(self.server, self.perf, expected_rates=expected)
+
+    def _setup_gui(self):
+        """Swarm controls: a target selector plus the usual flight buttons"""
+        self.target = self.server.gui.add_dropdown(
+            "Drone", options=["All"] + [m.name for m in self.members], order=0
+        )
+        self.height_slider = self.server.gui.add_slider(
+            "Target Height (m)",
+            min=0.2,
+            max=3.0,
+            step=0.1,
+            initial_value=DEFAULT_HEIGHT,
+            order=1,
+        )
+        self.speed_slider = self.server.gui.add_slider(
+            "Speed (m/s)", min=0.05, max=1.0, step=0.05, initial_value=0.35, order=2
+        )
+        buttons = [
+            ("Takeoff", "green", self.handle_takeoff),
+            ("Land", "orange", self.handle_land),
+            ("EMERGENCY STOP", "red", self.handle_emergency),
+        ]
+        moves = [
+            ("Forward", (0.5, 0, 0, 0)),
+            ("Backward", (-0.5, 0, 0, 0)),
+            ("Left", (0, 0.5, 0, 0)),
+            ("Right", (0, -0.5, 0, 0)),
+            ("Up", (0, 0, 0.3, 0)),
+            ("Down", (0, 0, -0.3, 0)),
+            ("Rotate Left", (0, 0, 0, -90)),
+            ("Rotate Right", (0, 0, 0, 90)),
+        ]
+        for label, velocity in moves:
+            buttons.append(
+                (
+                    label,
+                    "blue",
+                    lambda velocity=velocity: self.handle_movement(*velocity),
+                )
+            )
+        for order, (label, color, handler) in enumerate(buttons, start=3):
+            button = self.server.gui.add_button(label, color=color, order=order)
+            button.on_click(lambda _, handler=handler: handler())
+
+    def _targets(self):
+        """Connected drones the GUI controls currently apply to"""
+        selected = self.target.value
+        return [m for m in self.members if m.ready and selected in ("All", m.name)]
+
+    def _for_each(self, targets, fn, action):
+        """Run fn(member) for all targets in parallel (takeoff/land block)"""
+
+        def run(member):
+            try:
+                fn(member)
+            except Exception as e:
+                print(f"[ERROR] {member.name}: {action} failed: {e}")
+
+        threads = [
+            threading.Thread(target=run, args=(m,), daemon=True) for m in targets
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def handle_takeoff(self):
+        height = self.height_slider.value
+        print("[INFO] Taking off...")
+        self._for_each(self._targets(), lambda m: m.take_off(height), "takeoff")
+
+    def handle_land(self):
+        print("[INFO] Landing...")
+        self._for_each(self._targets(), lambda m: m.land(), "landing")
+
+    def handle_emergency(self):
+        """Land every drone regardless of the selection and stop"""
+        print("[INFO] Emergency stop!")
+        threads = self._for_each(self.members, lambda m: m.land(), "emergency landing")
+
+        def wait_and_stop():
+            for thread in threads:
+                thread.join()
+            self.running = False
+
+        threading.Thread(target=wait_and_stop, daemon=True).start()
+
+    def handle_movement(self, vx, vy, vz, yaw):
+        speed = self.speed_slider.value
+        velocity = (vx * speed, vy * speed, vz * speed, yaw)
+        for m in self._targets():
+            if m.motors_on:
+                mode = "extend" if m.setpoints.current() == velocity else "replace"
+                m.setpoints.submit(*velocity, duration=MOVE_DURATION, mode=mode)
+
+    def _render_frame(self, _):
+        """Update every drone in one batched scene update (scheduler thread)"""
+        self.perf.count("render.frames")
+        trails = self._trail_limiter.ready()
+        with self.server.atomic():
+            for member, drone in zip(self.members, self.drones):
+                if member.latest is not None:
+                    drone.position = member.latest[1:]
+            if trails:
+                self._update_trails()
+
+        # Every pipeline is flushed from this thread, so the shared store and
+        # occupancy grid see one writer
+        with self.perf.timer("map.flush"):
+            for member in self.members:
+                member.mapping.flush()
+        if self._map_limiter.ready():
+            self.map_streamer.publish(self.store)
+        if self._occupancy_limiter.ready():
+            self._update_occupancy()
+
+        if self._print_limiter.ready():
+            positions = ", ".join(
+                f"{m.name} ({m.latest[1]:.2f}, {m.latest[2]:.2f}, {m.latest[3]:.2f})"
+                for m in self.members
+                if m.latest is not None
+            )
+            print(f"[INFO] Swarm: {positions}")
+
+    def _update_trails(self):
+        """Draw all trails as one line-segment node with per-drone colours"""
+        per_drone = max(1, TRAIL_MAX_SEGMENTS // len(self.members))
+        segments, colors = [], []
+        for member in self.members:
+            s = member.trajectory.segments(max_segments=per_drone)
+            if len(s):
+                segments.append(s)
+                colors.append(
+                    np.broadcast_to(np.array(member.color, np.uint8), s.shape)
+                )
+        if not segments:
+            return
+        self.server.scene.add_line_segments(
+            "/swarm/trails",
+            points=np.concatenate(segments),
+            colors=np.concatenate(colors),
+            thickness=2.0,
+            thickness_units="screen",
+        )
+
+    def _update_occupancy(self):
+        centers = self.occupancy.occupied_centers()
+        if len(centers) == 0:
+            return
+        self.server.scene.add_point_cloud(
+            "/map/occupied",
+            points=centers,
+            colors=(200, 60, 60),
+            point_size=OCCUPANCY_RESOLUTION,
+        )
+
+    def _map_stats(self):
+        return {
+            "drones": sum(m.ready for m in self.members),
+            "points": len(self.store),
+            "occupancy_blocks": len(self.occupancy.blocks),
+            "occupancy_mb": self.occupancy.memory_bytes / 1e6,
+        }
+
+    def connect(self):
+        """Open every link in parallel; returns the drones that are ready"""
+        start = time.perf_counter()
+        self.members[0].startup.prepare_links(self.uris)
+        self.recorder = FlightRecorder(RECORD_DIR)
+        for member in self.members:
+            member.startup.start()
+        threads = [
+            threading.Thread(target=m.connect, name=f"connect-{m.name}", daemon=True)
+            for m in self.members
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for member in self.members:
+            print(f"[INFO] {member.name} ({member.uri}):")
+            member.startup.report()
+        ready = [m for m in self.members if m.ready]
+        print(
+            f"[INFO] {len(ready)}/{len(self.members)} drones ready in "
+            f"{time.perf_counter() - start:.2f} s"
+        )
+        return ready
+
+    def run(self):
+        """Main execution loop"""
+        print(f"\n[INFO] Crazyflie swarm of {len(self.members)} drones")
+        print("  Control the swarm using the GUI at http://localhost:8080\n")
+        self.scheduler.start()
+        try:
+            if self.connect():
+                self.perf_panel.start()
+                while self.running:
+                    time.sleep(0.1)
+        except KeyboardInterrupt:
+            print("\n[INFO] Keyboard interrupt received...")
+
+        # Cleanup
+        for thread in self._for_each(self.members, lambda m: m.land(), "landing"):
+            thread.join()
+        self.perf_panel.stop()
+        self.scheduler.stop()
+        for member in self.members:
+            member.close()
+        if self.recorder:
+            self.recorder.close()
+        print("\n[INFO] Flight Ended. Shutdown complete.")
+
+
+if __name__ == "__main__":
+    visualizer = SwarmVisualizer(SWARM_URIS)
+    visualizer.run()
@@ -0,0 +1,79 @@
+import threading
+
+import numpy as np
+
+# Default number of poses kept for the trajectory trail (~5 min at 100 Hz)
+DEFAULT_CAPACITY = 30000
+
+
+class TrajectoryBuffer:
+    """Fixed-capacity ring buffer of timestamped positions"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        if capacity < 2:
+            raise ValueError("Trajectory capacity must be at least 2")
+        self.capacity = int(capacity)
+        self._timestamps = np.zeros(self.capacity, dtype=np.float64)
+        self._positions = np.zeros((self.capacity, 3), dtype=np.float32)
+        self._head = 0  # Next slot to write
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, x, y, z):
+        """Store one pose, overwriting the oldest once full (O(1))"""
+        with self._lock:
+            i = self._head
+            self._timestamps[i] = timestamp
+            self._positions[i, 0] = x
+            self._positions[i, 1] = y
+            self._positions[i, 2] = z
+            self._head = (i + 1) % self.capacity
+            if self._count < self.capacity:
+                self._count += 1
+
+    def clear(self):
+        with self._lock:
+            self._head = 0
+            self._count = 0
+
+    def remap(self, fn):
+        """Move every stored position with fn(timestamps, positions) -> positions"""
+        with self._lock:
+            n = self._count
+            self._positions[:n] = fn(self._timestamps[:n], self._positions[:n])
+
+    def latest(self):
+        """Return the most recent (timestamp, position) or None if empty"""
+        with self._lock:
+            if self._count == 0:
+                return None
+            i = (self._head - 1) % self.capacity
+            return self._timestamps[i], self._positions[i].copy()
+
+    def snapshot(self):
+        """Return (timestamps, positions) copies in chronological order"""
+        with self._lock:
+            if self._count < self.capacity:
+                return (
+                    self._timestamps[: self._count].copy(),
+                    self._positions[: self._count].copy(),
+                )
+            order = np.r_[self._head : self.capacity, 0 : self._head]
+            return self._timestamps[order], self._positions[order]
+
+    def segments(self, max_segments=None):
+        """Return line segments (N, 2, 3) joining consecutive poses
+
+        When max_segments is given the history is decimated evenly so the
+        rendered trail stays bounded regardless of buffer capacity.
+        """
+        _, points = self.snapshot()
+        if len(points) < 2:
+            return np.zeros((0, 2, 3), dtype=np.float32)
+        if max_segments is not None and len(points) - 1 > max_segments:
+            idx = np.linspace(0, len(points) - 1, max_segments + 1).astype(np.int64)
+            points = points[idx]
+        return np.stack((points[:-1], points[1:]), axis=1)
@@ -1,42 +1,168 @@
 import logging
+import os
 import threading
 import time
-from threading import Event
 
-import cflib
-import cflib.crtp
+import numpy as np
 import viser
-from cflib.crazyflie import Crazyflie
-from cflib.crazyflie.log import LogConfig
-from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
-from cflib.positioning.motion_commander import MotionCommander
+from cflib.utils import uri_helper
+
+from detection_fusion import DetectionFusion
+from exploration import Explorer, FrontierTracker
+from fast_connect import FastConnect
+from flight_recorder import RECORD_DIR, FlightRecorder
+from instrumentation import Instrumentation, PerfPanel
+from log_planner import LogPlan, StreamMerger, VariableRequest
+from map_tiles import MAP_DIR, MapSession
+from mapping import (
+    ATTITUDE_VARIABLES,
+    MAX_RANGE,
+    MIN_RANGE,
+    POSE_VARIABLES,
+    RANGE_VARIABLES,
+    MappingPipeline,
+)
+from occupancy import OccupancyGrid
+from path_planner import GoToController
+from point_octree import LodStreamer
+from pose_graph import MapAnchor, PoseGraph
+from pose_history import ClockSync, PoseHistory
+from render_scheduler import RateLimiter, RenderScheduler
+from scan_matching import ScanMatcher
+from replay_link import make_motion_commander
+from setpoint_stream import SetpointStreamer
+from trajectory import TrajectoryBuffer
 
 # Configure logging to show only errors
 logging.basicConfig(level=logging.ERROR)
 
-# Connection URI and flight control constants
-URI = "radio://0/80/2M/E7E7E7E7E7"
+# Connection URI (replay:// and sim:// select the hardware-free stand-in)
+URI = uri_helper.uri_from_env(default="radio://0/80/2M/E7E7E7E7E7")
+
+# Flight control constants
 DEFAULT_HEIGHT = 0.5
 BASE_SPEED = 0.35
 SPEED_STEP = 0.05
 TURN_STEP = 5
-RUNNING = True
-motors_on = False
 speed = BASE_SPEED
 turn_speed = 500
 
-# Track Flowdeck presence
-deck_attached_event = Event()
+# GUI movement: each click moves for MOVE_DURATION, streamed at SETPOINT_RATE
+MOVE_DURATION = 0.5  # Seconds
+SETPOINT_RATE = 50.0  # Hz (50 or 100)
+
+# Trajectory trail settings
+TRAJECTORY_CAPACITY = 30000  # Poses kept in memory (~5 min at 100 Hz)
+TRAIL_FPS = 10.0  # Max trail refreshes per second
+TRAIL_MAX_SEGMENTS = 2000  # Segments sent to the browser per refresh
+
+# Scene publishing and console output rates
+RENDER_FPS = 30.0
+PRINT_INTERVAL = 1.0  # Seconds between position prints
+
+# Telemetry log rate; log_planner packs the variables into log blocks
+TELEMETRY_RATE = 100.0  # Hz for pose, attitude and ranges
+
+# LiDAR mapping settings
+MAP_VOXEL_SIZE = 0.05  # Metres; one stored point per voxel
+MAP_FPS = 5.0  # Max point cloud refreshes per second
+OCCUPANCY_RESOLUTION = 0.05  # Metres per occupancy voxel
+OCCUPANCY_FPS = 1.0  # Max occupied-voxel refreshes per second
+
+# Scan-to-map matching corrects odometry drift in the map and trajectory;
+# SCAN_MATCHING=0 uses the raw state estimate
+SCAN_MATCHING = os.environ.get("SCAN_MATCHING", "1") == "1"
+
+# Keyframe pose graph with loop closure; corrections re-anchor the stored
+# map and trajectory (POSE_GRAPH=0 disables it)
+POSE_GRAPH = os.environ.get("POSE_GRAPH", "1") == "1"
+
+# Camera detections (raspicam_detection_wireless.py), e.g.
+# DETECTION_URL=http://raspberrypi.local:5000/detections
+DETECTION_URL = os.environ.get("DETECTION_URL")
+DETECTION_FPS = 2.0  # Max marker refreshes per second
+
+# Maps are saved as tiles under ./maps; MAP_PATH=maps/<name> resumes a saved
+# map (view one without a drone with: python map_tiles.py maps/<name>)
+MAP_PATH = os.environ.get("MAP_PATH") or os.path.join(
+    MAP_DIR, f"map-{time.strftime('%Y%m%d-%H%M%S')}"
+)
+
+
+def telemetry_plan(name="Telemetry", rate=TELEMETRY_RATE):
+    """Pose, attitude and ranges packed into log blocks by the planner"""
+    requests = [
+        VariableRequest(name, rate, precision=0.001, max_abs=30.0)
+        for name in POSE_VARIABLES
+    ]
+    requests += [
+        VariableRequest(name, rate, precision=0.2, max_abs=180.0)
+        for name in ATTITUDE_VARIABLES
+    ]
+    requests += [
+        VariableRequest(name, rate, ctype="uint16_t") for name in RANGE_VARIABLES
+    ]
+    return LogPlan(requests, name=name)
 
 
 class DroneVisualizer:
-    def __init__(self, uri):
+    def __init__(
+        self, uri, trajectory_capacity=TRAJECTORY_CAPACITY, render_fps=RENDER_FPS
+    ):
         self.uri = uri
         self.server = viser.ViserServer()
         self.mc_instance = None
+        self.motors_on = False
+        self.running = True
+        self.recorder = None
+        self.perf = Instrumentation()
         self.vx, self.vy, self.vz, self.yaw_rate = 0.0, 0.0, 0.0, 0.0
+        self.trajectory = TrajectoryBuffer(trajectory_capacity)
+        self.scheduler = RenderScheduler(self._render_state, fps=render_fps)
+        self.setpoints = SetpointStreamer(self._send_setpoint, rate_hz=SETPOINT_RATE)
+        self._trail_limiter = RateLimiter(1.0 / TRAIL_FPS)
+        self._print_limiter = RateLimiter(PRINT_INTERVAL)
+        self.occupancy = OccupancyGrid(resolution=OCCUPANCY_RESOLUTION)
+        self.mapping = MappingPipeline(
+            voxel_size=MAP_VOXEL_SIZE, occupancy=self.occupancy
+        )
+        self._map_limiter = RateLimiter(1.0 / MAP_FPS)
+        self._occupancy_limiter = RateLimiter(1.0 / OCCUPANCY_FPS)
+        # Frontiers at flight height, kept up to date after every map flush
+        self.frontiers = FrontierTracker(self.occupancy, DEFAULT_HEIGHT)
+        self.explorer = Explorer(self.frontiers, self.setpoints)
+        self.goto = GoToController(self.frontiers, self.setpoints)
+        self._goto_drawn = None  # Path last drawn for the goal
+        self.scan_matcher = ScanMatcher() if SCAN_MATCHING else None
+        self.pose_graph = PoseGraph(self.scan_matcher) if POSE_GRAPH else None
+        self.map_anchor = (
+            MapAnchor(
+                self.pose_graph,
+                self.mapping.store,
+                self.trajectory,
+                self.occupancy,
+                self.mapping,
+            )
+            if self.pose_graph is not None
+            else None
+        )
+        self._raw_position = (0.0, 0.0, 0.0)
+        self.map_session = MapSession(MAP_PATH, self.mapping.store, self.occupancy)
+        if self.map_session.resumed:
+            print(
+                f"[INFO] Resuming map {MAP_PATH} "
+                f"({self.map_session.resumed} tiles, loaded around the drone)"
+            )
+        # Poses on the host wall clock, for placing camera detections
+        self.clock = ClockSync()
+        self.poses = PoseHistory()
+        self._detection_limiter = RateLimiter(1.0 / DETECTION_FPS)
         self._setup_scene()
 
+    @property
+    def _corrected(self):
+        return self.scan_matcher is not None or self.pose_graph is not None
+
     def _setup_scene(self):
         """Initialize the 3D scene"""
         # self.origin = self.server.scene.add_icosphere(
@@ -54,15 +180,35 @@ class DroneVisualizer:
             position=(0, 0, 0.5),
             color=(0, 150, 255),
         )
+        # Raw state estimate, when scan matching or the pose graph corrects
+        # the drone pose
+        self.drone_raw = self.server.scene.add_box(
+            "drone_raw",
+            dimensions=(0.1, 0.1, 0.05),
+            position=(0, 0, 0.5),
+            color=(160, 160, 160),
+            visible=self._corrected,
+        )
         self.grid = self.server.scene.add_grid(
             "grid", width=10, height=10, cell_size=0.1
         )
 
-        # Add trajectory trail
-        self.trajectory_points = []
+        # Trajectory trail, drawn as one line-segment node
+        self.trail = None
+        self.explore_path = None
+        self.goto_path = None
+
+        # LiDAR point cloud, streamed per tab by level of detail
+        self.map_streamer = LodStreamer(self.server, voxel_size=MAP_VOXEL_SIZE)
+
+        # Camera detections merged into world-frame markers
+        self.detections = DetectionFusion(
+            self.server.scene, self.poses, url=DETECTION_URL
+        )
 
         # Setup GUI controls
         self._setup_gui()
+        self._setup_perf_panel()
 
     def _setup_gui(self):
         """Setup GUI controls in Viser"""
@@ -140,10 +286,28 @@ class DroneVisualizer:
             "Rotate Right", color="violet", hint="Rotate clockwise", order=13
         )
 
+        # Autonomous exploration
+        self.explore_button = self.server.gui.add_button(
+            "Explore",
+            color="teal",
+            hint="Fly to unmapped space until none is left; press again "
+            "or use any movement button to stop",
+            order=14,
+        )
+        self.goto_button = self.server.gui.add_button(
+            "Go To",
+            color="indigo",
+            hint="Then click the floor to fly there around obstacles; "
+            "any movement button stops",
+            order=15,
+        )
+
         # Setup button callbacks
         self.takeoff_button.on_click(lambda _: self.handle_takeoff())
         self.land_button.on_click(lambda _: self.handle_land())
         self.emergency_button.on_click(lambda _: self.handle_emergency())
+        self.explore_button.on_click(lambda _: self.handle_explore())
+        self.goto_button.on_click(lambda _: self.handle_goto())
 
         self.forward_button.on_click(lambda _: self.handle_movement(0.5, 0, 0, 0))
         self.backward_button.on_click(lambda _: self.handle_movement(-0.5, 0, 0, 0))
@@ -154,38 +318,121 @@ class DroneVisualizer:
         self.rotate_left_button.on_click(lambda _: self.handle_movement(0, 0, 0, -90))
         self.rotate_right_button.on_click(lambda _: self.handle_movement(0, 0, 0, 90))
 
+    def _setup_perf_panel(self):
+        """Performance folder with log rates, timings, link quality and map size"""
+        self.perf.add_provider("scheduler", self.scheduler.stats)
+        self.perf.add_provider("setpoints", self.setpoints.stats)
+        self.perf.add_provider("map", self._map_stats)
+        self.perf.add_provider("detections", self.detections.stats)
+        self.perf.add_provider("map_lod", self.map_streamer.stats)
+        self.perf.add_provider("map_tiles", self.map_session.stats)
+        self.perf.add_provider("frontiers", self.frontiers.stats)
+        self.perf.add_provider("explore", self.explorer.stats)
+        self.perf.add_provider("goto", self.goto.stats)
+        if self.scan_matcher:
+            self.perf.add_provider("scan_match", self.scan_matcher.stats)
+        if self.pose_graph is not None:
+            self.perf.add_provider("pose_graph", self.pose_graph.stats)
+            self.perf.add_provider("map_anchor", self.map_anchor.stats)
+        self.perf_panel = PerfPanel(
+            self.server,
+            self.perf,
+            expected_rates={"render.frames": self.scheduler.fps},
+        )
+
+    def _map_stats(self):
+        occupancy = self.occupancy.last_stats
+        return {
+            "points": len(self.mapping.store),
+            "points_mb": self.mapping.store.nbytes / 1e6,
+            "occupancy_blocks": len(self.occupancy.blocks),
+            "occupancy_mb": self.occupancy.memory_bytes / 1e6,
+            "occupancy_update_ms": occupancy.get("update_ms", 0.0),
+        }
+
+    def _link_quality_callback(self, quality):
+        self.perf.set_gauge("link.quality_percent", quality)
+
     def handle_takeoff(self):
         """Handle takeoff button click"""
-        global motors_on
-        if not motors_on and self.mc_instance:
+        if not self.motors_on and self.mc_instance:
             print("[INFO] Taking off...")
             try:
                 height = self.height_slider.value
                 self.mc_instance.take_off(height)
-                motors_on = True
+                self.motors_on = True
             except Exception as e:
                 print(f"[ERROR] Takeoff failed: {e}")
 
     def handle_land(self):
         """Handle land button click"""
-        global motors_on
-        if motors_on and self.mc_instance:
+        if self.motors_on and self.mc_instance:
             print("[INFO] Landing...")
+            self.explorer.stop()
+            self.goto.cancel()
+            # Wait for the final zero setpoint so it can't cut into the descent
+            self.setpoints.cancel(wait=True)
             try:
                 self.mc_instance.land()
-                motors_on = False
+                self.motors_on = False
             except Exception as e:
                 print(f"[ERROR] Landing failed: {e}")
 
     def handle_emergency(self):
         """Handle emergency stop"""
         print("[INFO] Emergency stop!")
+        self.explorer.stop()
+        self.goto.cancel()
+        self.setpoints.cancel(wait=True)
         threading.Thread(target=self.safe_stop, daemon=True).start()
 
+    def handle_explore(self):
+        """Start or stop autonomous exploration"""
+        if self.explorer.active:
+            print("[INFO] Exploration stopped")
+            self.explorer.stop()
+        elif self.motors_on and self.mc_instance:
+            print("[INFO] Exploring...")
+            self.goto.cancel()
+            self.explorer.start(self.height_slider.value)
+        else:
+            print("[WARNING] Take off before exploring")
+
+    def handle_goto(self):
+        """Arm a single scene click that picks the goal"""
+        if not (self.motors_on and self.mc_instance):
+            print("[WARNING] Take off before picking a goal")
+            return
+        print("[INFO] Click the floor to pick a goal")
+        self.server.scene.remove_click_callback(self._on_goal_click)
+        self.server.scene.on_click()(self._on_goal_click)
+
+    def _on_goal_click(self, event):
+        """Fly to where the clicked ray meets the floor"""
+        self.server.scene.remove_click_callback(self._on_goal_click)
+        origin = np.asarray(event.ray_origin)
+        direction = np.asarray(event.ray_direction)
+        if direction[2] >= -1e-6:
+            print("[WARNING] Click the floor to pick a goal")
+            return
+        x, y, _ = origin - direction * (origin[2] / direction[2])
+        if self.explorer.active:
+            print("[INFO] Exploration stopped (goal picked)")
+            self.explorer.stop()
+        print(f"[INFO] Flying to ({x:.2f}, {y:.2f})")
+        self.goto.go_to(x, y, self.height_slider.value)
+
     def handle_movement(self, vx, vy, vz, yaw):
         """Handle movement button clicks"""
-        if motors_on and self.mc_instance:
+        if self.motors_on and self.mc_instance:
             try:
+                if self.explorer.active:
+                    print("[INFO] Exploration stopped (manual control)")
+                    self.explorer.stop()
+                if self.goto.active:
+                    print("[INFO] Go to stopped (manual control)")
+                    self.goto.cancel()
+
                 speed = self.speed_slider.value
                 turn_speed = self.turn_slider.value
 
@@ -195,58 +442,225 @@ class DroneVisualizer:
                 scaled_vz = vz * speed if vz != 0 else 0
                 scaled_yaw = yaw * (turn_speed / 90) if yaw != 0 else 0
 
-                # Send command for duration
-                duration = 0.5  # seconds
-                end_time = time.time() + duration
-                while time.time() < end_time and motors_on:
-                    self.mc_instance._set_vel_setpoint(
-                        scaled_vx, scaled_vy, scaled_vz, scaled_yaw
-                    )
-                    time.sleep(0.01)
-
-                # Stop movement
-                self.mc_instance._set_vel_setpoint(0, 0, 0, 0)
+                # Repeated clicks of the same button extend the move, a
+                # different button replaces it
+                velocity = (scaled_vx, scaled_vy, scaled_vz, scaled_yaw)
+                mode = "extend" if self.setpoints.current() == velocity else "replace"
+                self.setpoints.submit(*velocity, duration=MOVE_DURATION, mode=mode)
 
             except Exception as e:
                 print(f"[ERROR] Movement failed: {e}")
 
+    def _send_setpoint(self, vx, vy, vz, yaw_rate):
+        """Send one velocity setpoint (runs on the setpoint stream thread)"""
+        if self.motors_on and self.mc_instance:
+            self.mc_instance._set_vel_setpoint(vx, vy, vz, yaw_rate)
+
     def _position_callback(self, timestamp, data, logconf):
-        """Update drone position from Crazyflie data"""
+        """Store drone position from Crazyflie data (runs on the radio thread)"""
         x = data.get("stateEstimate.x", 0)
         y = data.get("stateEstimate.y", 0)
         z = data.get("stateEstimate.z", 0)
 
+        self.trajectory.append(timestamp, x, y, z)
+        self.mapping.pose_callback(timestamp, data, logconf)
+        self.scheduler.submit((timestamp, x, y, z))
+
+    def _render_state(self, state):
+        """Push the latest pose to the scene (runs on the scheduler thread)"""
+        timestamp, x, y, z = state
+        self.perf.count("render.frames")
         self.drone.position = (x, y, z)
+        if self._corrected:
+            self.drone_raw.position = self._raw_position
+
+        if self._trail_limiter.ready():
+            self._update_trail()
+            self._update_goto_path()
+
+        with self.perf.timer("map.load"):
+            self.map_session.load_around((x, y, z))
+        with self.perf.timer("map.flush"):
+            self.mapping.flush()
+        if self.map_anchor:
+            with self.perf.timer("map.reanchor"):
+                self.map_anchor.apply()
+        with self.perf.timer("frontier.update"):
+            self.frontiers.update()
+        if self._map_limiter.ready():
+            self.map_streamer.publish(self.mapping.store)
+        if self._occupancy_limiter.ready():
+            self._update_occupancy()
+            self._update_frontiers()
+        if self._detection_limiter.ready():
+            self.detections.render()
+
+        if self._print_limiter.ready():
+            stats = self.scheduler.stats()
+            print(
+                f"[{timestamp}] Position: ({x:.2f}, {y:.2f}, {z:.2f}) "
+                f"| received {stats['received']}, coalesced {stats['coalesced']}"
+            )
+            occ = self.occupancy.last_stats
+            if occ:
+                print(
+                    f"[INFO] Occupancy: {occ['rays']} rays in {occ['update_ms']:.1f} ms, "
+                    f"{occ['blocks']} blocks, {occ['memory_mb']:.1f} MB"
+                )
+
+    def _update_trail(self):
+        """Redraw the trajectory trail as a single batched node"""
+        segments = self.trajectory.segments(max_segments=TRAIL_MAX_SEGMENTS)
+        if len(segments) == 0:
+            return
+        self.trail = self.server.scene.add_line_segments(
+            "trajectory",
+            points=segments,
+            colors=(255, 120, 0),
+            thickness=2.0,
+            thickness_units="screen",
+        )
 
-        # Add to trajectory
-        self.trajectory_points.append((x, y, z))
-        if len(self.trajectory_points) > 500:  # Keep last 500 points
-            self.trajectory_points.pop(0)
+    def _update_goto_path(self):
+        """Redraw the go-to path when it changed"""
+        path = self.goto.path()
+        drawn = self._goto_drawn
+        if path is drawn or (
+            path is not None
+            and drawn is not None
+            and path.shape == drawn.shape
+            and np.array_equal(path, drawn)
+        ):
+            return
+        self._goto_drawn = path
+        if path is not None and len(path) > 1:
+            self.goto_path = self.server.scene.add_line_segments(
+                "/goto/path",
+                points=np.stack((path[:-1], path[1:]), axis=1),
+                colors=(120, 80, 220),
+                thickness=2.0,
+                thickness_units="screen",
+            )
+        elif self.goto_path is not None:
+            self.goto_path.remove()
+            self.goto_path = None
+
+    def _update_occupancy(self):
+        """Redraw occupied voxels as one point cloud"""
+        centers = self.occupancy.occupied_centers()
+        if len(centers) == 0:
+            return
+        self.server.scene.add_point_cloud(
+            "/map/occupied",
+            points=centers,
+            colors=(200, 60, 60),
+            point_size=OCCUPANCY_RESOLUTION,
+        )
 
-        print(f"[{timestamp}] Position: ({x:.2f}, {y:.2f}, {z:.2f})")
+    def _update_frontiers(self):
+        """Redraw frontier cells and the exploration path"""
+        cells = self.frontiers.cells()
+        if len(cells):
+            self.server.scene.add_point_cloud(
+                "/map/frontiers",
+                points=cells,
+                colors=(40, 200, 220),
+                point_size=OCCUPANCY_RESOLUTION,
+            )
+        path = self.explorer.path()
+        if path is not None and len(path) > 1:
+            self.explore_path = self.server.scene.add_line_segments(
+                "/explore/path",
+                points=np.stack((path[:-1], path[1:]), axis=1),
+                colors=(40, 200, 220),
+                thickness=2.0,
+                thickness_units="screen",
+            )
+        elif self.explore_path is not None:
+            self.explore_path.remove()
+            self.explore_path = None
 
     def _setup_logging(self, scf):
-        """Configure Crazyflie logging"""
-        lg_stab = LogConfig(name="State Estimate", period_in_ms=10)
-        lg_stab.add_variable("stateEstimate.x", "float")
-        lg_stab.add_variable("stateEstimate.y", "float")
-        lg_stab.add_variable("stateEstimate.z", "float")
-
-        scf.cf.log.add_config(lg_stab)
-        lg_stab.data_received_cb.add_callback(self._position_callback)
-        lg_stab.start()
-
-    def param_deck_flow(self, _, value_str):
-        """Security checking if deck is properly initialized"""
-        if int(value_str):
-            deck_attached_event.set()
-            print("[INFO] Flowdeck is attached.")
+        """Configure Crazyflie logging through the packing planner"""
+        plan = telemetry_plan()
+        print(plan.describe())
+
+        # Record every stream to disk for later analysis
+        self.recorder = FlightRecorder(RECORD_DIR)
+
+        self.merger = StreamMerger(
+            plan, self.perf.timed("log.merged", self._telemetry_callback)
+        )
+        self.perf.add_provider(
+            "log",
+            lambda: {
+                "merged": self.merger.merged,
+                "incomplete": self.merger.incomplete,
+            },
+        )
+        self.perf_panel.expected_rates["log.merged"] = TELEMETRY_RATE
+        for lg in plan.create_logconfs():
+            self.perf_panel.expected_rates[f"log.{lg.name}"] = 1000.0 / lg.period_in_ms
+            scf.cf.log.add_config(lg)
+            lg.data_received_cb.add_callback(self._count_packet)
+            self.recorder.subscribe(lg)
+        self.merger.attach()
+        for block in plan.blocks:
+            block.logconf.start()
+
+    def _count_packet(self, timestamp, data, logconf):
+        self.perf.count(f"log.{logconf.name}")
+
+    def _telemetry_callback(self, timestamp, data, logconf):
+        """Handle one merged pose + attitude + range record"""
+        # Everything downstream sees the corrected pose
+        raw = data
+        if self.scan_matcher:
+            self.scan_matcher.add_sample(raw)
+            data = self.scan_matcher.correct_record(raw)
+        if self._corrected:
+            self._raw_position = (
+                raw.get("stateEstimate.x", 0),
+                raw.get("stateEstimate.y", 0),
+                raw.get("stateEstimate.z", 0),
+            )
+        if self.pose_graph is not None:
+            self.pose_graph.add_sample(timestamp, data, raw)
+            # Held until the record is stored, so a re-anchor switches the
+            # correction between two records
+            with self.map_anchor.records:
+                data = self.pose_graph.correct_record(data)
+                self.mapping.tag = self.pose_graph.tag
+                self._position_callback(timestamp, data, logconf)
+                self.mapping.range_callback(timestamp, data, logconf)
         else:
-            print("[WARNING] Flowdeck is NOT attached!")
+            self._position_callback(timestamp, data, logconf)
+            self.mapping.range_callback(timestamp, data, logconf)
+        pose = (
+            data.get("stateEstimate.x", 0),
+            data.get("stateEstimate.y", 0),
+            data.get("stateEstimate.z", 0),
+            data.get("stabilizer.yaw", 0),
+        )
+        self.explorer.set_pose(*pose)
+        self.goto.set_pose(*pose)
+
+        front = data.get("range.front", 0) / 1000.0
+        self.poses.append(
+            self.clock.update(timestamp),
+            (
+                data.get("stateEstimate.x", 0),
+                data.get("stateEstimate.y", 0),
+                data.get("stateEstimate.z", 0),
+                data.get("stabilizer.roll", 0),
+                data.get("stabilizer.pitch", 0),
+                data.get("stabilizer.yaw", 0),
+                front if MIN_RANGE <= front < MAX_RANGE else np.nan,
+            ),
+        )
 
     def safe_stop(self):
         """Emergency stop and landing"""
-        global RUNNING, motors_on
         try:
             if self.mc_instance:
                 print("[INFO] Emergency landing...")
@@ -254,8 +668,8 @@ class DroneVisualizer:
         except Exception as e:
             print(f"[ERROR] During emergency stop: {e}")
         finally:
-            motors_on = False
-            RUNNING = False
+            self.motors_on = False
+            self.running = False
 
     def print_info(self):
         """Print control instructions"""
@@ -264,46 +678,81 @@ class DroneVisualizer:
         print("  - Use Takeoff/Land buttons to control flight")
         print("  - Adjust height and speed with sliders")
         print("  - Use directional buttons for movement")
+        print("  - Explore flies to unmapped space on its own")
+        print("  - Go To, then a click on the floor, flies there around obstacles")
         print("  - Emergency stop button for immediate landing\n")
 
-    def run(self):
+    def run(self, startup=None):
         """Main execution loop"""
-        global RUNNING
         self.print_info()
-        cflib.crtp.init_drivers()
 
-        with SyncCrazyflie(self.uri, cf=Crazyflie(rw_cache="./cache")) as scf:
-            scf.cf.param.add_update_callback(
-                group="deck", name="bcFlow2", cb=self.param_deck_flow
-            )
-            print("[INFO] Waiting for Flowdeck...")
-            if not deck_attached_event.wait(timeout=5):
+        # Connecting may already be under way (see __main__)
+        startup = startup if startup is not None else FastConnect(self.uri)
+        with startup:
+            scf = startup.wait_link()
+            self.scheduler.start()
+
+            # Logging starts while the deck parameters come in
+            if not startup.ready({"logging": self._setup_logging}):
                 print("[ERROR] No Flowdeck detected!")
+                self._shutdown()
                 return
 
-            self.mc_instance = MotionCommander(scf, default_height=DEFAULT_HEIGHT)
+            self.mc_instance = make_motion_commander(scf, default_height=DEFAULT_HEIGHT)
             print("[INFO] Connected to Crazyflie!")
-
-            # Setup logging for visualization
-            self._setup_logging(scf)
+            self.setpoints.start()
+            self.goto.start()
+            self.detections.start()
+            self.map_session.start()
+            if self.scan_matcher:
+                self.scan_matcher.start()
+            if self.pose_graph is not None:
+                self.pose_graph.start()
+
+            # Link quality moved to cf.link_statistics in newer cflib versions
+            link_stats = getattr(scf.cf, "link_statistics", scf.cf)
+            link_stats.link_quality_updated.add_callback(self._link_quality_callback)
+            self.perf_panel.start()
+            startup.report()
 
             # Main loop
             try:
-                while RUNNING:
+                while self.running:
                     time.sleep(0.1)
             except KeyboardInterrupt:
                 print("\n[INFO] Keyboard interrupt received...")
 
             # Cleanup
+            self.explorer.stop()
+            self.goto.cancel()
+            self.setpoints.cancel(wait=True)
             try:
-                if motors_on:
+                if self.motors_on:
                     self.mc_instance.land()
             except Exception as e:
                 print(f"[ERROR] During shutdown landing: {e}")
-
+            self._shutdown()
             print("\n[INFO] Flight Ended. Shutdown complete.")
 
+    def _shutdown(self):
+        self.explorer.stop()
+        self.goto.stop()
+        self.perf_panel.stop()
+        self.detections.stop()
+        self.setpoints.stop()
+        self.scheduler.stop()
+        if self.scan_matcher:
+            self.scan_matcher.stop()
+        if self.pose_graph is not None:
+            self.pose_graph.stop()
+        self.map_session.stop()
+        if self.recorder:
+            self.recorder.close()
+
 
 if __name__ == "__main__":
-    visualizer = DroneVisualizer(URI)
-    visualizer.run()
+    # Connect in the background while the viser server and scene start up
+    startup = FastConnect(URI).start()
+    with startup.phase("viser"):
+        visualizer = DroneVisualizer(URI)
+    visualizer.run(startup)
@@ -11,21 +11,19 @@ from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
 from cflib.crazyflie.syncLogger import SyncLogger
 from cflib.utils import uri_helper
 
+from flight_recorder import RECORD_DIR, FlightRecorder
+
 # URI to the Crazyflie to connect to
 uri = uri_helper.uri_from_env(default="radio://0/80/2M/E7E7E7E7E7")
 
 
-def log_stab_callback(timestamp, data, logconf):
-    print("[%d][%s]: %s" % (timestamp, logconf.name, data))
-
-
 # def viser_drone_position_callback(timestamp, data, logconf):
 
 
-def simple_log_async(scf, logconf):
+def simple_log_async(scf, logconf, recorder):
     cf = scf.cf
     cf.log.add_config(logconf)
-    logconf.data_received_cb.add_callback(log_stab_callback)
+    recorder.subscribe(logconf)
     logconf.start()
 
 
@@ -46,11 +44,15 @@ def server_start():
     lg_stab.add_variable("stateEstimate.y", "float")
     lg_stab.add_variable("stateEstimate.z", "float")
 
+    recorder = FlightRecorder(RECORD_DIR)
     with SyncCrazyflie(uri, cf=Crazyflie(rw_cache="./cache")) as scf:
-        simple_log_async(scf, lg_stab)
+        simple_log_async(scf, lg_stab, recorder)
 
-        while True:
-            time.sleep(6)
+        try:
+            while True:
+                time.sleep(6)
+        finally:
+            recorder.close()
 
 
 def main():
@@ -1,24 +1,22 @@
 import time
-from threading import Event
-
-# Crazyflie
-import cflib.crtp
 
 # Viser
 import viser
-from cflib.crazyflie import Crazyflie
 from cflib.crazyflie.log import LogConfig
-from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
-from cflib.crazyflie.syncLogger import SyncLogger
-from cflib.utils import uri_helper
 
-deck_attached_event = Event()
+from fast_connect import FastConnect
+from render_scheduler import RateLimiter, RenderScheduler
+
+RENDER_FPS = 30.0
+PRINT_INTERVAL = 1.0  # Seconds between position prints
 
 
 class DroneVisualizer:
-    def __init__(self, uri):
+    def __init__(self, uri, render_fps=RENDER_FPS):
         self.uri = uri
         self.server = viser.ViserServer()
+        self.scheduler = RenderScheduler(self._render_state, fps=render_fps)
+        self._print_limiter = RateLimiter(PRINT_INTERVAL)
         self._setup_scene()
 
     def _setup_scene(self):
@@ -32,12 +30,22 @@ class DroneVisualizer:
         self.grid = self.server.scene.add_grid("grid")
 
     def _position_callback(self, timestamp, data, logconf):
-        """Update drone position from Crazyflie data"""
+        """Store drone position from Crazyflie data (runs on the radio thread)"""
         x = data.get("stateEstimate.x", 0)
         y = data.get("stateEstimate.y", 0)
         z = data.get("stateEstimate.z", 0)
+        self.scheduler.submit((timestamp, x, y, z))
+
+    def _render_state(self, state):
+        """Push the latest pose to the scene (runs on the scheduler thread)"""
+        timestamp, x, y, z = state
         self.drone.position = (x, y, z)
-        print(f"[{timestamp}] Position: ({x:.2f}, {y:.2f}, {z:.2f})")
+        if self._print_limiter.ready():
+            stats = self.scheduler.stats()
+            print(
+                f"[{timestamp}] Position: ({x:.2f}, {y:.2f}, {z:.2f}) "
+                f"| received {stats['received']}, coalesced {stats['coalesced']}"
+            )
 
     def _setup_logging(self, scf):
         """Configure Crazyflie logging"""
@@ -50,35 +58,29 @@ class DroneVisualizer:
         lg_stab.data_received_cb.add_callback(self._position_callback)
         lg_stab.start()
 
-    def _param_deck_flow(_, value_str):
-        """Security checking if deck is properly initialized"""
-        value = int(value_str)
-        print(value)
-        if value:
-            deck_attached_event.set()
-            print("Deck is attached!")
-        else:
-            print("Deck is NOT attached!")
-
-    def run(self):
+    def run(self, startup=None):
         """Main execution loop"""
-        cflib.crtp.init_drivers()
-
-        with SyncCrazyflie(self.uri, cf=Crazyflie(rw_cache="./cache")) as scf:
-            self._setup_logging(scf)
-            scf.cf.param.add_update_callback(
-                group="deck", name="bcFlow2", cb=self._param_deck_flow
-            )
-            time.sleep(1)
-
+        startup = startup if startup is not None else FastConnect(self.uri)
+        with startup:
+            startup.wait_link()
+            self.scheduler.start()
             try:
+                # Logging starts while the deck parameters come in; view-only,
+                # so a missing deck is reported but does not stop the viewer
+                if not startup.ready({"logging": self._setup_logging}):
+                    print("[WARNING] Deck is NOT attached!")
+                startup.report()
                 while True:
                     time.sleep(0.1)
             except KeyboardInterrupt:
                 print("Shutting down...")
+            finally:
+                self.scheduler.stop()
 
 
 if __name__ == "__main__":
     uri = "radio://0/80/2M"  # Your URI here
-    visualizer = DroneVisualizer(uri)
-    visualizer.run()
+    startup = FastConnect(uri).start()
+    with startup.phase("viser"):
+        visualizer = DroneVisualizer(uri)
+    visualizer.run(startup)